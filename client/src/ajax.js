@@ -7,6 +7,170 @@ var Ajax = (function($, window, undefined) {
       var pending = 0;
       var count = 0;
       var pendingList = {};
+      // type configurations received, by their etag
+      var typeConfigurations = {};
+      var lastTypeConfigurationEtag = undefined;
+      var TYPE_CONFIGURATION_KEYS = ['event_types', 'entity_types',
+          'relation_types', 'event_attribute_types',
+          'relation_attribute_types', 'entity_attribute_types',
+          'unconfigured_types', 'ui_names', 'visual_options'];
+      var TYPE_CONFIGURATION_ACTIONS = {
+        getCollectionInformation: true,
+        getConfiguration: true
+      };
+      // the document last received, with its collection and version
+      var lastDocument = undefined;
+      // actions responding with the annotations of the edited document,
+      // only the changes to them if we send the version we have
+      var EDIT_ACTIONS = {
+        createSpan: true,
+        createArc: true,
+        reverseArc: true,
+        deleteArc: true,
+        deleteSpan: true,
+        splitSpan: true,
+        createComment: true,
+        tag: true,
+        undo: true
+      };
+      // annotation data keyed by annotation id, see applyAnnotationsDelta
+      var ID_KEYED_ANNOTATIONS = ['entities', 'triggers', 'events',
+          'relations', 'attributes', 'normalizations'];
+      // parts of a getDocument response that aren't document data
+      var RESPONSE_ONLY_KEYS = ['action', 'messages', 'protocol',
+          'document_version', 'document_unchanged'];
+
+      // the server omits the type configuration from the response if
+      // it is the one with the etag we send
+      var sendTypeConfigurationEtag = function(data) {
+        if (data.toString() == '[object FormData]' ||
+            !TYPE_CONFIGURATION_ACTIONS[data.action] ||
+            lastTypeConfigurationEtag === undefined ||
+            data.type_configuration_etag !== undefined) return;
+        data.type_configuration_etag = lastTypeConfigurationEtag;
+      };
+
+      // responses are modified by their users, so keep copies
+      var copyTypeConfiguration = function(from, to) {
+        $.each(TYPE_CONFIGURATION_KEYS, function(keyNo, key) {
+          to[key] = JSON.parse(JSON.stringify(from[key]));
+        });
+        return to;
+      };
+
+      var receiveTypeConfiguration = function(response) {
+        var etag = response.type_configuration_etag;
+        if (etag === undefined) return;
+        if (response.type_configuration_unchanged) {
+          copyTypeConfiguration(typeConfigurations[etag], response);
+        } else {
+          typeConfigurations[etag] = copyTypeConfiguration(response, {});
+        }
+        lastTypeConfigurationEtag = etag;
+      };
+
+      // the server only tells that the document is unchanged, or how it
+      // changed with an edit, if it is the version we send; returns the
+      // document of that version
+      var sendDocumentVersion = function(data) {
+        if (data.toString() == '[object FormData]' ||
+            (data.action != 'getDocument' && !EDIT_ACTIONS[data.action]) ||
+            lastDocument === undefined ||
+            lastDocument.collection != data.collection ||
+            lastDocument.document != data.document ||
+            data.document_version !== undefined) return;
+        data.document_version = lastDocument.version;
+        return lastDocument;
+      };
+
+      // updated items take the place of the ones they replace, as they
+      // do in the annotation file, and new ones go last
+      var applyAnnotationsDelta = function(annotations, delta) {
+        var removed = {};
+        $.each(delta.deleted, function(idNo, id) {
+          removed[id] = true;
+        });
+        // items may also move between keys (e.g. entity to trigger)
+        $.each(delta.updated, function(key, items) {
+          $.each(items, function(itemNo, item) {
+            removed[item[0]] = true;
+          });
+        });
+        $.each(ID_KEYED_ANNOTATIONS, function(keyNo, key) {
+          var updated = {};
+          $.each(delta.updated[key] || [], function(itemNo, item) {
+            updated[item[0]] = item;
+          });
+          var items = [];
+          $.each(annotations[key] || [], function(itemNo, item) {
+            if (updated.hasOwnProperty(item[0])) {
+              items.push(updated[item[0]]);
+              delete updated[item[0]];
+            } else if (!removed[item[0]]) {
+              items.push(item);
+            }
+          });
+          $.each(delta.updated[key] || [], function(itemNo, item) {
+            if (updated.hasOwnProperty(item[0])) items.push(item);
+          });
+          annotations[key] = items;
+        });
+        $.each(delta.replaced, function(key, items) {
+          annotations[key] = items;
+        });
+        annotations.mtime = delta.mtime;
+        annotations.ctime = delta.ctime;
+        return annotations;
+      };
+
+      var receiveEdit = function(data, response, sentDocument) {
+        var version = response.document_version;
+        if (version === undefined) {
+          lastDocument = undefined;
+          return;
+        }
+        if (response.annotations_delta !== undefined) {
+          // changes to the version we sent, whatever came in since
+          var annotations = JSON.parse(sentDocument.json);
+          $.each(RESPONSE_ONLY_KEYS, function(keyNo, key) {
+            delete annotations[key];
+          });
+          response.annotations = applyAnnotationsDelta(annotations,
+              response.annotations_delta);
+          delete response.annotations_delta;
+        }
+        lastDocument = {
+          collection: data.collection,
+          document: data.document,
+          version: version,
+          json: JSON.stringify(response.annotations)
+        };
+      };
+
+      var receiveDocument = function(data, response, sentDocument) {
+        if (EDIT_ACTIONS[data.action]) {
+          receiveEdit(data, response, sentDocument);
+          return;
+        }
+        if (data.action != 'getDocument') return;
+        var version = response.document_version;
+        if (version === undefined) {
+          lastDocument = undefined;
+        } else if (response.document_unchanged) {
+          // responses are modified by their users, so keep a copy
+          delete response.document_unchanged;
+          $.each(JSON.parse(lastDocument.json), function(key, value) {
+            if (response[key] === undefined) response[key] = value;
+          });
+        } else {
+          lastDocument = {
+            collection: data.collection,
+            document: data.document,
+            version: version,
+            json: JSON.stringify(response)
+          };
+        }
+      };
 
       // merge data will get merged into the response data
       // before calling the callback
@@ -27,6 +191,8 @@ var Ajax = (function($, window, undefined) {
           // TODO: Extract the protocol version somewhere global
           data['protocol'] = PROTOCOL_VERSION;
         }
+        sendTypeConfigurationEtag(data);
+        var sentDocument = sendDocumentVersion(data);
 
         options = {
             url: 'ajax.cgi',
@@ -70,6 +236,11 @@ var Ajax = (function($, window, undefined) {
 
                 delete pendingList[id];
 
+                if (response.exception == undefined) {
+                  receiveTypeConfiguration(response);
+                  receiveDocument(data, response, sentDocument);
+                }
+
                 // if .exception is just Boolean true, do not process
                 // the callback; if it is anything else, the
                 // callback is responsible for handling it
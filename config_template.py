@@ -118,5 +118,95 @@ except NameError:
 # ]
 
 ### SIMSTRING
+# Without the simstring library or executable, normalization DBs are
+# searched with an n-gram index of brat's own (built by
+# tools/norm_db_init.py as <name>.ngrams.db).
 # SIMSTRING_EXECUTABLE = ''
 SIMSTRING_DEFAULT_UNICODE = True
+
+
+# ANNOTATION_CACHE_SIZE
+# Number of parsed documents kept in memory by long-running server
+# processes (FastCGI, standalone) to avoid re-parsing annotation files
+# that have not changed on disk. (disabled if <= 0)
+
+ANNOTATION_CACHE_SIZE = 32
+
+
+# DOCUMENT_JSON_CACHE_SIZE
+# Number of documents kept in memory by long-running server processes in
+# the form sent to the client, ready to be sent again as long as neither
+# the document nor the configuration of its collection change.
+# (disabled if <= 0)
+
+DOCUMENT_JSON_CACHE_SIZE = 32
+
+
+# ANNOTATION_JOURNAL
+# If True, saving an edit appends the changed annotation lines to a
+# journal file next to the ".ann" file (e.g. "1000.ann.journal")
+# instead of rewriting the whole file. The journal is merged into the
+# ".ann" file once it grows large and before collection downloads, so
+# that downloading a collection may write to its annotation files.
+# NOTE: tools reading ".ann" files directly (not through the server
+# annotation module) will not see the journaled changes until then.
+
+ANNOTATION_JOURNAL = False
+
+
+# DOCUMENT_WORKERS
+# Number of worker processes used to parse the documents of a collection
+# in parallel for search and statistics generation. 1 parses the documents
+# in the server process itself, 0 uses one process per CPU. The processes
+# are started on first use and kept for later requests, so this mostly
+# pays off with a long-running server (FastCGI, standalone).
+
+DOCUMENT_WORKERS = 1
+
+
+# CONFIG_CACHE_SIZE
+# Number of collection configurations (annotation.conf, visual.conf,
+# etc.) kept parsed in memory by long-running server processes. Changed
+# configuration files are picked up without a restart. (disabled if <= 0)
+
+CONFIG_CACHE_SIZE = 64
+
+
+# APP_SERVER_WORKERS
+# Number of persistent worker processes serving requests for the
+# standalone and FastCGI servers. 0 uses one process per CPU. Sending
+# SIGHUP to the server replaces the workers once they are idle, e.g. to
+# pick up an updated brat or config.py.
+
+APP_SERVER_WORKERS = 0
+
+
+# APP_SERVER_MAX_REQUESTS
+# Number of requests after which a worker process is replaced by a fresh
+# one. (never if <= 0)
+
+APP_SERVER_MAX_REQUESTS = 1000
+
+
+# ASYNC_SERVER_THREADS
+# Number of threads serving the actions that can't wait asynchronously when
+# running the standalone server with --async.
+
+ASYNC_SERVER_THREADS = 8
+
+
+# OFFSET_CACHE_DIR
+# Directory in which the token and sentence offsets of the document texts
+# are kept once computed, "offsets" in WORK_DIR by default. Set to None to
+# always tokenise and sentence split anew.
+
+#OFFSET_CACHE_DIR = None
+
+
+# OFFSET_CACHE_MAX_FILES
+# Number of files (one per document and tokeniser or sentence splitter)
+# kept in OFFSET_CACHE_DIR. The oldest ones beyond it are removed in a
+# check made at most once an hour, so the directory may exceed it in
+# between.
+
+OFFSET_CACHE_MAX_FILES = 10000
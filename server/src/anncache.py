@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+"""In-process cache of parsed document annotations.
+
+Building a TextAnnotations object reads the text, parses every line of the
+annotation file and runs the post-parse sanity checks, which is costly for
+large documents. Long-lived server processes (FastCGI, standalone) keep a
+bounded number of parsed documents around and only re-parse when the size or
+modification time of the ".ann" file, its journal or the ".txt" file changes.
+For CGI the cache simply never gets a hit.
+
+Cached objects are shared between read-only users. A writer checks the
+object out of the cache, holding the per-document lock for the duration of
+the edit, and puts it back only once it has been successfully saved.
+The messages of parsing a document (e.g. of the sanity checks) are kept
+with it and given again on every hit, as a fresh parse would. The hit,
+miss and eviction counters are written to the server log every
+STATISTICS_LOG_INTERVAL lookups.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from logging import info as log_info
+from os import stat
+from os.path import normpath
+from threading import Lock
+
+from annotation import (JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF,
+                        TEXT_FILE_SUFFIX, TextAnnotations, compact_journal)
+from message import Messager
+
+# Maximum number of parsed documents to keep in memory (disabled if <= 0)
+try:
+    from config import ANNOTATION_CACHE_SIZE
+except ImportError:
+    ANNOTATION_CACHE_SIZE = 32
+
+# The counters are written to the server log every this many lookups
+STATISTICS_LOG_INTERVAL = 1000
+
+
+def file_signature(file_path):
+    """Returns the modification time and size of the given file, or None if
+    it doesn't exist."""
+    try:
+        st = stat(file_path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def document_signature(document):
+    """Returns a value that changes whenever the annotations or text of the
+    given document (path without extension) change on disk."""
+    ann_file_path = document + '.' + JOINED_ANN_FILE_SUFF
+    return (file_signature(ann_file_path),
+            file_signature(ann_file_path + '.' + JOURNAL_FILE_SUFF),
+            file_signature(document + '.' + TEXT_FILE_SUFFIX))
+
+
+class _CacheEntry(object):
+    def __init__(self, ann_obj, signature, read_only, messages):
+        self.ann_obj = ann_obj
+        self.signature = signature
+        # The messages (e.g. of the sanity checks) that parsing the document
+        # gives, for every request that gets the object
+        self.messages = messages
+        # Whether the document itself is read-only (e.g. file permissions),
+        # the cached object is always flagged read-only while shared
+        self.read_only = read_only
+        self.readers = 0
+
+
+class AnnotationCache(object):
+    def __init__(self, max_size=ANNOTATION_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        # One lock per document path ever written through the cache; these
+        # are tiny and never removed to avoid racing on their creation
+        self._document_locks = {}
+
+    def statistics(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+            }
+
+    def _log_statistics(self):
+        # Assumes that self._lock is held
+        if (self.hits + self.misses) % STATISTICS_LOG_INTERVAL == 0:
+            log_info('annotation cache: %d hits, %d misses, %d evictions, '
+                     '%d/%d documents' % (self.hits, self.misses,
+                                          self.evictions, len(self._entries),
+                                          self.max_size))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _document_lock(self, document):
+        with self._lock:
+            try:
+                return self._document_locks[document]
+            except KeyError:
+                lock = Lock()
+                self._document_locks[document] = lock
+                return lock
+
+    def _cacheable(self, document, ann_obj):
+        # Only plain joined annotation files are tracked by the signature
+        # and documents that failed to parse are re-parsed every time so
+        # that the errors keep getting reported to the client
+        return (self.max_size > 0 and
+                not ann_obj.failed_lines and
+                ann_obj._input_files == [
+                    document + '.' + JOINED_ANN_FILE_SUFF])
+
+    def _parse(self, document):
+        signature = document_signature(document)
+        mark = Messager.mark()
+        ann_obj = TextAnnotations(document)
+        return ann_obj, signature, Messager.messages_since(mark)
+
+    def _insert(self, document, entry):
+        # Assumes that self._lock is held
+        self._entries[document] = entry
+        self._entries.move_to_end(document)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _acquire_shared(self, document):
+        with self._lock:
+            entry = self._entries.get(document)
+            if (entry is not None and
+                    entry.signature == document_signature(document)):
+                self.hits += 1
+                self._log_statistics()
+                entry.readers += 1
+                self._entries.move_to_end(document)
+                Messager.add_messages(entry.messages)
+                return entry.ann_obj
+            self.misses += 1
+            self._log_statistics()
+
+        ann_obj, signature, messages = self._parse(document)
+        if ann_obj.is_modified() and not ann_obj._read_only:
+            signature, messages = self._save_fixes(document, ann_obj,
+                                                   signature, messages)
+        read_only = ann_obj._read_only
+        ann_obj._read_only = True
+        if self._cacheable(document, ann_obj):
+            with self._lock:
+                entry = _CacheEntry(ann_obj, signature, read_only, messages)
+                entry.readers += 1
+                self._insert(document, entry)
+        return ann_obj
+
+    def _save_fixes(self, document, ann_obj, signature, messages):
+        # Writes back the fixes made in parsing (e.g. filled in texts), as
+        # a writable open would, unless the document has changed since.
+        # Returns the signature of the version the object reflects and the
+        # messages a fresh parse of it would give
+        with self._document_lock(document):
+            if document_signature(document) != signature:
+                return signature, messages
+            try:
+                ann_obj.save()
+            except OSError:
+                # We may not write to it, the fixes are made on every parse
+                return signature, messages
+            self._update_times(document, ann_obj)
+            return document_signature(document), self._sanity_messages(ann_obj)
+
+    def _sanity_messages(self, ann_obj):
+        # The messages of the sanity checks alone, which this request has
+        # already had
+        mark = Messager.mark()
+        ann_obj._sanity()
+        return Messager.messages_since(mark, remove=True)
+
+    def _update_times(self, document, ann_obj):
+        # Match what a fresh parse of the saved file would report, returns
+        # False if the file is gone
+        try:
+            st = stat(document + '.' + JOINED_ANN_FILE_SUFF)
+        except OSError:
+            return False
+        ann_obj.ann_mtime = st.st_mtime
+        ann_obj.ann_ctime = st.st_ctime
+        return True
+
+    def _release_shared(self, document, ann_obj):
+        with self._lock:
+            entry = self._entries.get(document)
+            if entry is not None and entry.ann_obj is ann_obj:
+                entry.readers -= 1
+
+    def _acquire_exclusive(self, document):
+        # Assumes that the document lock is held, returns the object and
+        # the messages of parsing it
+        with self._lock:
+            entry = self._entries.get(document)
+            if (entry is not None and entry.readers == 0 and
+                    entry.signature == document_signature(document)):
+                self.hits += 1
+                self._log_statistics()
+                del self._entries[document]
+                entry.ann_obj._read_only = entry.read_only
+                Messager.add_messages(entry.messages)
+                return entry.ann_obj, entry.messages
+            self.misses += 1
+            self._log_statistics()
+
+        ann_obj, _, messages = self._parse(document)
+        return ann_obj, messages
+
+    def _release_exclusive(self, document, ann_obj, messages):
+        # Assumes that the document lock is held and that the object has
+        # been saved, thus reflecting what is on disk
+        if not self._cacheable(document, ann_obj):
+            return
+        if not ann_obj._read_only:
+            # Any fixes made in parsing are saved by now, leaving what the
+            # sanity checks of a fresh parse would report; this request
+            # has had its messages already
+            messages = self._sanity_messages(ann_obj)
+        signature = document_signature(document)
+        if not self._update_times(document, ann_obj):
+            return
+        read_only = ann_obj._read_only
+        ann_obj._read_only = True
+        with self._lock:
+            entry = self._entries.get(document)
+            if entry is not None and entry.readers != 0:
+                # Someone parsed and is still reading a version of their
+                # own, it will be replaced on their next miss
+                return
+            self._insert(document, _CacheEntry(ann_obj, signature, read_only,
+                                               messages))
+
+    @contextmanager
+    def annotations(self, document, read_only=False):
+        """Context manager providing the TextAnnotations for the given
+        document (path without extension).
+
+        Read-only objects may be shared with other requests and must not be
+        modified. Writable objects are saved on exit, as with the
+        TextAnnotations context manager, and only returned to the cache if
+        the block exits without an exception.
+        """
+        document = normpath(document)
+
+        if read_only:
+            ann_obj = self._acquire_shared(document)
+            try:
+                yield ann_obj
+            finally:
+                self._release_shared(document, ann_obj)
+            return
+
+        with self._document_lock(document):
+            ann_obj, messages = self._acquire_exclusive(document)
+            with ann_obj:
+                yield ann_obj
+            self._release_exclusive(document, ann_obj, messages)
+
+    def compact_journal(self, document):
+        """Merge the journal of the given document (path without
+        extension), if any, into its annotation file while no edit through
+        the cache is in progress (see annotation.compact_journal())."""
+        document = normpath(document)
+        with self._document_lock(document):
+            compact_journal(document)
+
+
+ANNOTATION_CACHE = AnnotationCache()
+
+
+def cached_annotations(document, read_only=False):
+    return ANNOTATION_CACHE.annotations(document, read_only=read_only)
@@ -12,6 +12,7 @@ Version:    2011-11-22
 import logging
 from os.path import join as path_join
 from os.path import isabs
+from threading import Lock
 
 from config import DATA_DIR
 
@@ -37,35 +38,40 @@ def ann_logger(directory):
     Returns None if annotation logging is not configured for the given
     directory and a logger otherwise.
     """
-    if not ann_logger.__logger:
-        # not initialized
-        annlogfile = options_get_annlogfile(directory)
-        if annlogfile == '<NONE>':
-            # not configured
-            ann_logger.__logger = None
-        else:
-            # initialize
-            try:
-                l = logging.getLogger('annotation')
-                l.setLevel(logging.INFO)
-                handler = logging.FileHandler(annlogfile)
-                handler.setLevel(logging.INFO)
-                formatter = logging.Formatter('%(asctime)s\t%(message)s')
-                handler.setFormatter(formatter)
-                l.addHandler(handler)
-                ann_logger.__logger = l
-            except IOError as e:
-                Messager.error("""Error: failed to initialize annotation log %s: %s.
+    annlogfile = options_get_annlogfile(directory)
+    if annlogfile == '<NONE>':
+        # not configured
+        return None
+
+    # Loggers are shared by all the requests (and threads) of the process,
+    # one for each log file
+    with ann_logger.__lock:
+        if annlogfile in ann_logger.__loggers:
+            return ann_logger.__loggers[annlogfile]
+
+        # initialize
+        try:
+            l = logging.getLogger('annotation.%d' % len(ann_logger.__loggers))
+            l.setLevel(logging.INFO)
+            handler = logging.FileHandler(annlogfile)
+            handler.setLevel(logging.INFO)
+            formatter = logging.Formatter('%(asctime)s\t%(message)s')
+            handler.setFormatter(formatter)
+            l.addHandler(handler)
+        except IOError as e:
+            Messager.error("""Error: failed to initialize annotation log %s: %s.
 Edit action not logged.
 Please check the Annotation-log logfile setting in tools.conf""" % (annlogfile, e))
-                logging.error("Failed to initialize annotation log %s: %s" %
-                              (annlogfile, e))
-                ann_logger.__logger = None
+            logging.error("Failed to initialize annotation log %s: %s" %
+                          (annlogfile, e))
+            # not remembered, so that the error keeps getting reported
+            return None
+        ann_logger.__loggers[annlogfile] = l
+        return l
 
-    return ann_logger.__logger
 
-
-ann_logger.__logger = False
+ann_logger.__loggers = {}
+ann_logger.__lock = Lock()
 
 # local abbrev; can't have literal tabs in log fields
 
@@ -34,7 +34,10 @@
 # # .get_triggers()
 # # .add_annotation(ann)
 # # .del_annotation(ann)
+# # .update_annotation(ann)   # call after modifying an added annotation
+# # .is_modified()
 # # .get_ann_by_id(id)
+# # .get_referrers(id)
 # # .get_new_id(prefix, suffix=None)
 # # .get_document_text()
 # # .save(document=None)
@@ -119,11 +122,11 @@
 from __future__ import with_statement
 
 from codecs import open as codecs_open
-from itertools import chain, takewhile
+from itertools import takewhile
 from os import close as os_close
-from os import access, W_OK
+from os import access, remove, replace, utime, W_OK
 from os.path import join as path_join
-from os.path import splitext, dirname, isfile, isdir, exists
+from os.path import splitext, dirname, getsize, isfile, isdir, exists
 from re import compile as re_compile
 from re import match as re_match
 from time import time
@@ -179,6 +182,18 @@ JOINED_ANN_FILE_SUFF = 'ann'
 PARTIAL_ANN_FILE_SUFF = ['a1', 'a2', 'co', 'rel']
 KNOWN_FILE_SUFF = [JOINED_ANN_FILE_SUFF] + PARTIAL_ANN_FILE_SUFF
 TEXT_FILE_SUFFIX = 'txt'
+# Suffix appended to the joined annotation file name for its journal
+# (e.g. "1000.ann.journal"), see Annotations.save()
+JOURNAL_FILE_SUFF = 'journal'
+# Journal record prefixes: add or replace the annotation on the line, delete
+# the annotation with the id (or the identical line if it has no id) and
+# commit the records since the previous commit
+JOURNAL_SET = '+'
+JOURNAL_DEL = '-'
+JOURNAL_COMMIT = '.'
+# The journal is compacted into the annotation file once its size exceeds
+# this fraction of the annotation file size
+JOURNAL_COMPACTION_RATIO = 0.5
 # String used to catenate texts of discontinuous annotations in reference text
 DISCONT_SEP = ' '
 ###
@@ -195,6 +210,13 @@ BIONLP_ST_2013_NORMALIZATION_RES = [
     (re_compile(r'^(Reference) Referent:(\S+) Annotation:(\S+)'), r'\1 \3 \2'),
 ]
 
+# If True, saving appends the changes to a journal next to the annotation
+# file instead of rewriting the whole file (see Annotations.save())
+try:
+    from config import ANNOTATION_JOURNAL
+except ImportError:
+    ANNOTATION_JOURNAL = False
+
 
 class AnnotationLineSyntaxError(Exception):
     def __init__(self, line, line_num, filepath):
@@ -367,6 +389,32 @@ def open_textfile(filename, mode='rU'):
     return codecs_open(filename, mode, encoding='utf8', errors='strict')
 
 
+def _journal_path(ann_file_path):
+    return ann_file_path + '.' + JOURNAL_FILE_SUFF
+
+
+def _remove_journal(ann_file_path):
+    try:
+        remove(_journal_path(ann_file_path))
+    except FileNotFoundError:
+        pass
+
+
+def _default_lock_dir():
+    if PROGRAMMATIC:
+        from tempfile import gettempdir
+        return gettempdir()
+    return WORK_DIR
+
+
+def _file_save_lock(lock_dir, ann_file_path):
+    if PROGRAMMATIC:
+        return contextlib.suppress()
+    return FileLock(path_join(
+            lock_dir, str(hash(ann_file_path.replace('/', '_'))) + '.lock'
+    ))
+
+
 def __split_annotation_id(id):
     m = re_match(r'^([A-Za-z]+|#[A-Za-z]*)([0-9]+)(.*?)$', id)
     if m is None:
@@ -386,6 +434,13 @@ def annotation_id_number(id):
     return __split_annotation_id(id)[1]
 
 
+def annotation_id_parts(id):
+    """Return the (prefix, number, suffix) of the given id, with the number
+    as an integer, e.g. ("T", 12, "") for "T12"."""
+    pre, num_str, suf = __split_annotation_id(id)
+    return pre, int(num_str), suf
+
+
 def is_valid_id(id):
     # special case: '*' is acceptable as an "ID"
     if id == '*':
@@ -476,11 +531,7 @@ class Annotations(object):
     # TODO: DOC!
     def __init__(self, document=None, read_only=False, lock_dir=None, source=None):
         if lock_dir is None:
-            if PROGRAMMATIC:
-                from tempfile import gettempdir
-                lock_dir = gettempdir()
-            else:
-                lock_dir = WORK_DIR
+            lock_dir = _default_lock_dir()
 
         self._init_messager()
 
@@ -502,7 +553,6 @@ class Annotations(object):
         # TODO: DOC!
         # TODO: Incorparate file locking! Is the destructor called upon inter
         # crash?
-        from collections import defaultdict
         from os.path import getctime, getmtime
         #from fileinput import FileInput, hook_encoded
 
@@ -513,16 +563,36 @@ class Annotations(object):
         self.externally_referenced_triggers = set()
 
         # Here be dragons, these objects need constant updating and syncing
-        # Annotation for each line of the file
+        # Annotation for each line of the file, deleted lines are left as
+        # None until they make up half of the list (see _compact_lines)
         self._lines = []
+        self._deleted_line_count = 0
         # Mapping between annotation objects and which line they occur on
         # Range: [0, inf.) unlike [1, inf.) which is common for files
         self._line_by_ann = {}
-        # Maximum id number used for each id prefix, to speed up id generation
-        # XXX: This is effectively broken by the introduction of id suffixes
-        self._max_id_num_by_prefix = defaultdict(lambda: 1)
+        # Maximum id number used for each (id prefix, id suffix) pair, for
+        # id generation (see get_new_id)
+        self._max_id_num_by_affixes = {}
         # Annotation by id, not includid non-ided annotations
         self._ann_by_id = {}
+        # Annotations by class (see _INDEXED_CLASSES), in line order
+        self._anns_by_class = dict((c, {}) for c in _INDEXED_CLASSES)
+        # Number of events referencing each trigger id, and the trigger
+        # id each event was indexed under (triggers can be reassigned)
+        self._trigger_ref_count = {}
+        self._trigger_by_event = {}
+        # Annotations referencing each id (in their get_deps()), and the
+        # ids each annotation was indexed under
+        self._referrers = {}
+        self._deps_by_ann = {}
+        # Whether anything has changed since the last save, and the changes
+        # as (JOURNAL_SET or JOURNAL_DEL, ann) pairs, or None if they can
+        # only be saved by rewriting the whole annotation file
+        self._modified = False
+        self._journal = []
+        # Ids of annotations fixed up while parsing (e.g. filled text),
+        # these differ from what is on disk
+        self._fixed_on_parse = []
         ###
 
         # We use some heuristics to find the appropriate annotation files
@@ -531,8 +601,11 @@ class Annotations(object):
             input_files = self._select_input_files(document)
 
             if not input_files:
-                with open('{}.{}'.format(document, JOINED_ANN_FILE_SUFF), 'w'):
+                ann_file_path = '{}.{}'.format(document, JOINED_ANN_FILE_SUFF)
+                with open(ann_file_path, 'w'):
                     pass
+                # A journal left behind by a removed file is not ours
+                _remove_journal(ann_file_path)
 
                 input_files = self._select_input_files(document)
                 if not input_files and not PROGRAMMATIC:
@@ -549,8 +622,16 @@ class Annotations(object):
         self.ann_line_num = -1
         if input_files:
             self._parse_ann_file(input_files)
+            if (len(input_files) == 1 and
+                    input_files[0].endswith(JOINED_ANN_FILE_SUFF)):
+                self._replay_journal(_journal_path(input_files[0]))
         elif source:
             self._parse_ann_lines(source.splitlines(keepends=True))
+        # What we just read is what is on disk, except for any fixes
+        self._journal = [(JOURNAL_SET, self._ann_by_id[id])
+                         for id in self._fixed_on_parse
+                         if id in self._ann_by_id]
+        self._modified = bool(self._journal)
 
         # Sanity checking that can only be done post-parse
         self._sanity()
@@ -569,17 +650,16 @@ class Annotations(object):
         # Beware, we ONLY do format checking, leave your semantics hat at home
 
         # Check that referenced IDs are defined
-        for ann in self:
-            for rid in chain(*ann.get_deps()):
-                try:
-                    self.get_ann_by_id(rid)
-                except AnnotationNotFoundError:
-                    # TODO: do more than just send a message for this error?
-                    self.messages.error(
-                        'ID ' +
-                        rid +
-                        ' not defined, referenced from annotation ' +
-                        str(ann))
+        for rid in list(self._referrers):
+            if rid in self._ann_by_id:
+                continue
+            for ann in self.get_referrers(rid):
+                # TODO: do more than just send a message for this error?
+                self.messages.error(
+                    'ID ' +
+                    rid +
+                    ' not defined, referenced from annotation ' +
+                    str(ann))
 
         # Check that each event has a trigger
         for e_ann in self.get_events():
@@ -594,78 +674,148 @@ class Annotations(object):
                 raise EventWithoutTriggerError(e_ann)
 
         # Check that every trigger is only referenced by events
-
-        # Create a map for non-event references
-        referenced_to_referencer = {}
-        for non_e_ann in (a for a in self
-                          if not isinstance(a, EventAnnotation)
-                          and isinstance(a, IdedAnnotation)):
-            for ref in chain(*non_e_ann.get_deps()):
-                try:
-                    referenced_to_referencer[ref].add(non_e_ann.id)
-                except KeyError:
-                    referenced_to_referencer[ref] = set((non_e_ann.id, ))
-
-        # Ensure that no non-event references a trigger
         for tr_ann in self.get_triggers():
-            if tr_ann.id in referenced_to_referencer:
-                conflict_ann_ids = referenced_to_referencer[tr_ann.id]
-                if BIONLP_ST_2013_COMPATIBILITY:
-                    # Special-case processing for BioNLP ST 2013: allow
-                    # Relations to reference event triggers (#926).
-                    remaining_confict_ann_ids = set()
-                    for rid in conflict_ann_ids:
-                        referencer = self.get_ann_by_id(rid)
-                        if not isinstance(
-                                referencer, BinaryRelationAnnotation):
-                            remaining_confict_ann_ids.add(rid)
-                        else:
-                            self.externally_referenced_triggers.add(tr_ann.id)
-                    conflict_ann_ids = remaining_confict_ann_ids
-                # Note: Only reporting one of the conflicts (TODO)
-                if conflict_ann_ids:
-                    referencer = self.get_ann_by_id(list(conflict_ann_ids)[0])
-                    raise TriggerReferenceError(tr_ann, referencer)
+            conflict_anns = [a for a in self.get_referrers(tr_ann.id)
+                             if not isinstance(a, EventAnnotation)
+                             and isinstance(a, IdedAnnotation)]
+            if BIONLP_ST_2013_COMPATIBILITY:
+                # Special-case processing for BioNLP ST 2013: allow
+                # Relations to reference event triggers (#926).
+                remaining_conflict_anns = []
+                for referencer in conflict_anns:
+                    if not isinstance(referencer, BinaryRelationAnnotation):
+                        remaining_conflict_anns.append(referencer)
+                    else:
+                        self.externally_referenced_triggers.add(tr_ann.id)
+                conflict_anns = remaining_conflict_anns
+            # Note: Only reporting one of the conflicts (TODO)
+            if conflict_anns:
+                raise TriggerReferenceError(tr_ann, conflict_anns[0])
+
+    def _get_by_class(self, cls):
+        # Copy, the caller may well delete annotations while iterating
+        return iter(list(self._anns_by_class[cls]))
 
     def get_events(self):
-        return (a for a in self if isinstance(a, EventAnnotation))
+        return self._get_by_class(EventAnnotation)
 
     def get_attributes(self):
-        return (a for a in self if isinstance(a, AttributeAnnotation))
+        return self._get_by_class(AttributeAnnotation)
 
     def get_equivs(self):
-        return (a for a in self if isinstance(a, EquivAnnotation))
+        return self._get_by_class(EquivAnnotation)
 
     def get_textbounds(self):
-        return (a for a in self if isinstance(a, TextBoundAnnotation))
+        return self._get_by_class(TextBoundAnnotation)
 
     def get_relations(self):
-        return (a for a in self if isinstance(a, BinaryRelationAnnotation))
+        return self._get_by_class(BinaryRelationAnnotation)
 
     def get_normalizations(self):
-        return (a for a in self if isinstance(a, NormalizationAnnotation))
+        return self._get_by_class(NormalizationAnnotation)
 
     def get_entities(self):
         # Entities are textbounds that are not triggers
-        triggers = [t for t in self.get_triggers()]
-        return (a for a in self if (isinstance(a, TextBoundAnnotation) and
-                                    a not in triggers))
+        triggers = self._trigger_ref_count
+        return (a for a in self._get_by_class(TextBoundAnnotation)
+                if a.id not in triggers)
 
     def get_oneline_comments(self):
         # XXX: The status exception is for the document status protocol
         #       which is yet to be formalised
-        return (a for a in self if isinstance(a, OnelineCommentAnnotation)
-                and a.type != 'STATUS')
+        return (a for a in self._get_by_class(OnelineCommentAnnotation)
+                if a.type != 'STATUS')
 
     def get_statuses(self):
-        return (a for a in self if isinstance(a, OnelineCommentAnnotation)
-                and a.type == 'STATUS')
+        return (a for a in self._get_by_class(OnelineCommentAnnotation)
+                if a.type == 'STATUS')
 
     def get_triggers(self):
         # Triggers are text-bounds referenced by events
         # TODO: this omits entity triggers that lack a referencing event
         # (for one reason or another -- brat shouldn't define any.)
-        return (self.get_ann_by_id(e.trigger) for e in self.get_events())
+        return (self.get_ann_by_id(t) for t in list(self._trigger_ref_count))
+
+    def _index_trigger(self, e_ann):
+        trigger = e_ann.trigger
+        self._trigger_by_event[e_ann] = trigger
+        self._trigger_ref_count[trigger] = (
+            self._trigger_ref_count.get(trigger, 0) + 1)
+
+    def _unindex_trigger(self, e_ann):
+        trigger = self._trigger_by_event.pop(e_ann)
+        self._trigger_ref_count[trigger] -= 1
+        if not self._trigger_ref_count[trigger]:
+            del self._trigger_ref_count[trigger]
+
+    def _index_deps(self, ann):
+        soft_deps, hard_deps = ann.get_deps()
+        deps = soft_deps | hard_deps
+        self._deps_by_ann[ann] = deps
+        for rid in deps:
+            try:
+                self._referrers[rid][ann] = None
+            except KeyError:
+                self._referrers[rid] = {ann: None}
+
+    def _unindex_deps(self, ann):
+        for rid in self._deps_by_ann.pop(ann):
+            referrers = self._referrers[rid]
+            del referrers[ann]
+            if not referrers:
+                del self._referrers[rid]
+
+    def _index_annotation(self, ann):
+        for cls in _INDEXED_CLASSES:
+            if isinstance(ann, cls):
+                self._anns_by_class[cls][ann] = None
+        if isinstance(ann, EventAnnotation):
+            self._index_trigger(ann)
+        self._index_deps(ann)
+
+    def _unindex_annotation(self, ann):
+        for cls in _INDEXED_CLASSES:
+            if isinstance(ann, cls):
+                del self._anns_by_class[cls][ann]
+        if isinstance(ann, EventAnnotation):
+            self._unindex_trigger(ann)
+        self._unindex_deps(ann)
+
+    def update_annotation(self, ann):
+        """Update the internal indices after an annotation held by this
+        object has been modified in place (e.g. the trigger or arguments of
+        an event have been changed)."""
+        if isinstance(ann, EventAnnotation):
+            self._unindex_trigger(ann)
+            self._index_trigger(ann)
+        self._unindex_deps(ann)
+        self._index_deps(ann)
+        if hasattr(ann, 'id'):
+            self._note_change(JOURNAL_SET, ann)
+        else:
+            # Annotations without ids (equivs) can only be told apart by
+            # their line, which we no longer have
+            self._modified = True
+            self._journal = None
+
+    def _note_change(self, op, ann):
+        self._modified = True
+        if self._journal is not None:
+            self._journal.append((op, ann))
+
+    def is_modified(self):
+        """Return True if the annotations have changed since they were
+        read or last saved."""
+        return self._modified
+
+    def get_referrers(self, id):
+        """Return the annotations that reference the given id (i.e. that
+        have it among their get_deps()), in line order."""
+        try:
+            referrers = self._referrers[id]
+        except KeyError:
+            return []
+        return sorted(referrers, key=self._line_by_ann.__getitem__)
 
     # TODO: getters for other categories of annotations
     # TODO: Remove read and use an internal and external version instead
@@ -694,6 +844,7 @@ class Annotations(object):
                         for m_ent in merge_cand.entities:
                             if m_ent not in eq_ann.entities:
                                 eq_ann.entities.append(m_ent)
+                        self.update_annotation(eq_ann)
                         # Don't try to delete ann since it never was added
                         if merge_cand != ann:
                             try:
@@ -717,25 +868,38 @@ class Annotations(object):
             # It was not an Equiv, skip along
             pass
 
-        # Register the object id
-        try:
-            self._ann_by_id[ann.id] = ann
-            pre, num = annotation_id_prefix(
-                ann.id), annotation_id_number(
-                ann.id)
-            self._max_id_num_by_prefix[pre] = max(
-                int(num), int(self._max_id_num_by_prefix[pre]))
-        except AttributeError:
-            # The annotation simply lacked an id which is fine
-            pass
+        self._register_id(ann)
 
         # Add the annotation as the last line
+        self._line_by_ann[ann] = len(self._lines)
         self._lines.append(ann)
-        self._line_by_ann[ann] = len(self) - 1
+        self._index_annotation(ann)
+        if not read:
+            self._note_change(JOURNAL_SET, ann)
         # Update the modification time
         from time import time
         self.ann_mtime = time()
 
+    def _register_id(self, ann):
+        try:
+            self._ann_by_id[ann.id] = ann
+            pre, num, suf = annotation_id_parts(ann.id)
+            if num > self._max_id_num_by_affixes.get((pre, suf), 0):
+                self._max_id_num_by_affixes[(pre, suf)] = num
+        except AttributeError:
+            # The annotation simply lacked an id which is fine
+            pass
+
+    def _replace_annotation(self, old_ann, new_ann):
+        # Puts new_ann on the line of old_ann, which has the same id
+        l_num = self._line_by_ann.pop(old_ann)
+        self._unindex_annotation(old_ann)
+        self._register_id(new_ann)
+        self._lines[l_num] = new_ann
+        self._line_by_ann[new_ann] = l_num
+        self._index_annotation(new_ann)
+        return l_num
+
     def del_annotation(self, ann, tracker=None):
         # TODO: Check read only
         # TODO: Flag to allow recursion
@@ -759,12 +923,7 @@ class Annotations(object):
             return
 
         # collect annotations dependending on ann
-        ann_deps = []
-
-        for other_ann in self:
-            soft_deps, hard_deps = other_ann.get_deps()
-            if str(ann.id) in soft_deps | hard_deps:
-                ann_deps.append(other_ann)
+        ann_deps = self.get_referrers(str(ann.id))
 
         # If all depending are AttributeAnnotations or EquivAnnotations,
         # delete all modifiers recursively (without confirmation) and remove
@@ -794,6 +953,7 @@ class Annotations(object):
                         if tracker is not None:
                             before = str(d)
                         d.entities.remove(str(ann.id))
+                        self.update_annotation(d)
                         if tracker is not None:
                             tracker.change(before, d)
                 elif isinstance(d, OnelineCommentAnnotation):
@@ -829,19 +989,39 @@ class Annotations(object):
             # So, we did not have id to erase in the first place
             pass
 
-        ann_line = self._line_by_ann[ann]
-        # Erase the main annotation
-        del self._lines[ann_line]
-        # Erase the ann by line shorthand
-        del self._line_by_ann[ann]
-        # Update the line shorthand of every annotation after this one
-        # to reflect the new self._lines
-        for l_num in range(ann_line, len(self)):
-            self._line_by_ann[self[l_num]] = l_num
+        self._unindex_annotation(ann)
+        self._note_change(JOURNAL_DEL, ann)
+
+        # Erase the main annotation and the ann by line shorthand, leaving
+        # the line numbers of the annotations after it untouched
+        ann_line = self._line_by_ann.pop(ann)
+        self._lines[ann_line] = None
+        self._deleted_line_count += 1
+        if self._deleted_line_count * 2 > len(self._lines):
+            self._compact_lines()
         # Update the modification time
         from time import time
         self.ann_mtime = time()
 
+    def _compact_lines(self):
+        """Drop the lines of deleted annotations and renumber the rest."""
+        if not self._deleted_line_count:
+            return
+        new_line_by_old = {}
+        lines = []
+        for l_num, ann in enumerate(self._lines):
+            if ann is not None:
+                new_line_by_old[l_num] = len(lines)
+                self._line_by_ann[ann] = len(lines)
+                lines.append(ann)
+        # Keep the failed lines pointing at the right annotations
+        self.failed_lines = [new_line_by_old[l_num]
+                             for l_num in self.failed_lines
+                             if l_num in new_line_by_old]
+        # Note: a new list, iterators over the old one are not disturbed
+        self._lines = lines
+        self._deleted_line_count = 0
+
     def get_ann_by_id(self, id):
         # TODO: DOC
         try:
@@ -854,7 +1034,7 @@ class Annotations(object):
         prefix. No ids are re-used for traceability over time for annotations,
         but this only holds for the lifetime of the annotation object. If the
         annotation file is parsed once again into an annotation object the next
-        assigned id will be the maximum seen for a given prefix plus one which
+        assigned id will be the maximum seen for a given prefix (and suffix) plus one which
         could have been deleted during a previous annotation session.
 
         Warning: get_new_id('T') == get_new_id('T')
@@ -863,27 +1043,23 @@ class Annotations(object):
         order to reserve it.
 
         Argument(s):
-        id_pre - an annotation prefix on the format [A-Za-z]+
+        prefix - an annotation prefix on the format [A-Za-z]+
+        suffix - an optional id suffix following the number
 
         Returns:
         An id that is guaranteed to be unique for the lifetime of the
         annotation.
         """
-        # XXX: We have changed this one radically!
-        # XXX: Stupid and linear
         if suffix is None:
             suffix = ''
-        # XXX: Arbitrary constant!
-        for suggestion in (
-            prefix +
-            str(i) +
-            suffix for i in range(
-                1,
-                2**15)):
-            # This is getting more complicated by the minute, two checks since
-            # the developers no longer know when it is an id or string.
-            if suggestion not in self._ann_by_id:
-                return suggestion
+        num = self._max_id_num_by_affixes.get((prefix, suffix), 0) + 1
+        suggestion = prefix + str(num) + suffix
+        # A suffix starting with a digit could make the suggestion read as
+        # an id with some other number and suffix, make sure it is free
+        while suggestion in self._ann_by_id:
+            num += 1
+            suggestion = prefix + str(num) + suffix
+        return suggestion
 
     # XXX: This syntax is subject to change
     def _parse_attribute_annotation(
@@ -1082,72 +1258,131 @@ class Annotations(object):
         # enumerate(self._file_input):
         for self.ann_line in ann_lines:
             self.ann_line_num += 1
+            new_ann, failed = self._parse_ann_line(input_file_path)
+            if failed:
+                # NOTE: For access we start at line 0, not 1 as in files
+                self.failed_lines.append(len(self._lines))
+            self.add_annotation(new_ann, read=True)
+
+    def _parse_ann_line(self, input_file_path, replace=False):
+        """Parse self.ann_line, returning an (annotation, failed) pair.
+
+        Lines that can not be parsed give an UnparsedIdedAnnotation or an
+        UnknownAnnotation and failed set to True. Unless replace is True, an
+        id that is already in use is an error.
+        """
+        try:
+            # ID processing
             try:
-                # ID processing
-                try:
-                    id, id_tail = self.ann_line.split('\t', 1)
-                except ValueError:
-                    raise AnnotationLineSyntaxError(
-                        self.ann_line, self.ann_line_num + 1, input_file_path)
+                id, id_tail = self.ann_line.split('\t', 1)
+            except ValueError:
+                raise AnnotationLineSyntaxError(
+                    self.ann_line, self.ann_line_num + 1, input_file_path)
 
-                pre = annotation_id_prefix(id)
+            pre = annotation_id_prefix(id)
 
-                if id in self._ann_by_id and pre != '*':
-                    raise DuplicateAnnotationIdError(
-                        id, self.ann_line, self.ann_line_num + 1, input_file_path)
+            if id in self._ann_by_id and pre != '*' and not replace:
+                raise DuplicateAnnotationIdError(
+                    id, self.ann_line, self.ann_line_num + 1, input_file_path)
 
-                # if the ID is not valid, need to fail with
-                # AnnotationLineSyntaxError (not
-                # IdedAnnotationLineSyntaxError).
-                if not is_valid_id(id):
-                    raise AnnotationLineSyntaxError(
-                        self.ann_line, self.ann_line_num + 1, input_file_path)
+            # if the ID is not valid, need to fail with
+            # AnnotationLineSyntaxError (not
+            # IdedAnnotationLineSyntaxError).
+            if not is_valid_id(id):
+                raise AnnotationLineSyntaxError(
+                    self.ann_line, self.ann_line_num + 1, input_file_path)
 
-                # Cases for lines
-                try:
-                    data_delim = id_tail.index('\t')
-                    data, data_tail = (id_tail[:data_delim],
-                                        id_tail[data_delim:])
-                except ValueError:
-                    data = id_tail
-                    # No tail at all, although it should have a \t
-                    data_tail = ''
+            # Cases for lines
+            try:
+                data_delim = id_tail.index('\t')
+                data, data_tail = (id_tail[:data_delim],
+                                    id_tail[data_delim:])
+            except ValueError:
+                data = id_tail
+                # No tail at all, although it should have a \t
+                data_tail = ''
 
-                new_ann = None
+            new_ann = None
 
-                #log_info('Will evaluate prefix: ' + pre)
+            #log_info('Will evaluate prefix: ' + pre)
 
-                assert len(pre) >= 1, "INTERNAL ERROR"
-                pre_first = pre[0]
+            assert len(pre) >= 1, "INTERNAL ERROR"
+            pre_first = pre[0]
 
-                try:
-                    parse_func = self._parse_function_by_id_prefix[pre_first]
-                    new_ann = parse_func(
-                        id, data, data_tail, input_file_path)
-                except KeyError:
-                    raise IdedAnnotationLineSyntaxError(
-                        id, self.ann_line, self.ann_line_num + 1, input_file_path)
+            try:
+                parse_func = self._parse_function_by_id_prefix[pre_first]
+                new_ann = parse_func(
+                    id, data, data_tail, input_file_path)
+            except KeyError:
+                raise IdedAnnotationLineSyntaxError(
+                    id, self.ann_line, self.ann_line_num + 1, input_file_path)
+
+            assert new_ann is not None, "INTERNAL ERROR"
+            return new_ann, False
+        except IdedAnnotationLineSyntaxError as e:
+            # Could parse an ID but not the whole line; add
+            # UnparsedIdedAnnotation
+            return UnparsedIdedAnnotation(
+                e.id, e.line, source_id=e.filepath), True
+
+        except AnnotationLineSyntaxError as e:
+            # We could not parse even an ID on the line, just add
+            # it as an unknown annotation
+            return UnknownAnnotation(e.line, source_id=e.filepath), True
+
+    def _replay_journal(self, journal_path):
+        """Apply the changes recorded in the journal of the annotation file.
+
+        Only records followed by a commit line are applied, anything after
+        the last one is a save that never completed. Replaying records that
+        are already reflected in the annotation file (e.g. due to a crash
+        during compaction) is harmless.
+        """
+        try:
+            with open_textfile(journal_path) as journal_file:
+                journal_lines = journal_file.readlines()
+        except FileNotFoundError:
+            return
 
-                assert new_ann is not None, "INTERNAL ERROR"
-                self.add_annotation(new_ann, read=True)
-            except IdedAnnotationLineSyntaxError as e:
-                # Could parse an ID but not the whole line; add
-                # UnparsedIdedAnnotation
-                self.add_annotation(
-                    UnparsedIdedAnnotation(
-                        e.id, e.line, source_id=e.filepath), read=True)
-                self.failed_lines.append(e.line_num - 1)
-
-            except AnnotationLineSyntaxError as e:
-                # We could not parse even an ID on the line, just add
-                # it as an unknown annotation
-                self.add_annotation(
-                    UnknownAnnotation(
-                        e.line,
-                        source_id=e.filepath),
-                    read=True)
-                # NOTE: For access we start at line 0, not 1 as in here
-                self.failed_lines.append(e.line_num - 1)
+        records = []
+        for l_num, line in enumerate(journal_lines):
+            if line == JOURNAL_COMMIT + '\n':
+                for self.ann_line_num, op, self.ann_line in records:
+                    self._apply_journal_record(op, journal_path)
+                records = []
+            elif line[:1] in (JOURNAL_SET, JOURNAL_DEL) and line[1:2] == '\t':
+                records.append((l_num, line[0], line[2:]))
+            else:
+                self.messages.warning(
+                    'Ignoring malformed line %d in %s' % (l_num + 1, journal_path))
+
+    def _apply_journal_record(self, op, journal_path):
+        ann_id = self.ann_line.split('\t', 1)[0]
+        old_ann = self._ann_by_id.get(ann_id)
+        if old_ann is None and op == JOURNAL_DEL:
+            # Annotations without ids are identified by their line
+            ann_line = self.ann_line.rstrip('\r\n')
+            for ann in self:
+                if (not hasattr(ann, 'id') and
+                        str(ann).rstrip('\r\n') == ann_line):
+                    old_ann = ann
+                    break
+
+        if op == JOURNAL_DEL:
+            if old_ann is not None:
+                self._atomic_del_annotation(old_ann)
+            return
+
+        new_ann, failed = self._parse_ann_line(journal_path, replace=True)
+        if old_ann is None:
+            l_num = len(self._lines)
+            self.add_annotation(new_ann, read=True)
+        else:
+            l_num = self._replace_annotation(old_ann, new_ann)
+        if failed:
+            self.failed_lines.append(l_num)
+        elif l_num in self.failed_lines:
+            self.failed_lines.remove(l_num)
 
     def __str__(self):
         s = u'\n'.join(str(ann).rstrip(u'\r\n') for ann in self)
@@ -1156,11 +1391,14 @@ class Annotations(object):
         else:
             return s if s[-1] == u'\n' else s + u'\n'
 
-    def __it__(self):
+    def __iter__(self):
         for ann in self._lines:
-            yield ann
+            # Skips deleted lines, also ones deleted after a compaction
+            if ann in self._line_by_ann:
+                yield ann
 
     def __getitem__(self, val):
+        self._compact_lines()
         try:
             # First, try to use it as a slice object
             return self._lines[val.start, val.stop, val.step]
@@ -1169,7 +1407,7 @@ class Annotations(object):
             return self._lines[val]
 
     def __len__(self):
-        return len(self._lines)
+        return len(self._lines) - self._deleted_line_count
 
     def __enter__(self):
         # No need to do any handling here, the constructor handles that
@@ -1187,7 +1425,58 @@ class Annotations(object):
 
         self.save()
 
+    def _save_lock(self):
+        # Protect the write so we don't corrupt the file
+        return _file_save_lock(self.lock_dir, self._input_files[0])
+
+    def _append_journal(self):
+        """Append the changes since the last save to the journal of the
+        annotation file. Returns False, without writing anything, if the
+        journal is due for compaction or can't be safely appended to."""
+        ann_file_path = self._input_files[0]
+        journal_path = _journal_path(ann_file_path)
+
+        records = u''.join(u'%s\t%s\n' % (op, str(ann).rstrip(u'\r\n'))
+                           for op, ann in self._journal)
+        records += JOURNAL_COMMIT + u'\n'
+
+        try:
+            journal_size = getsize(journal_path)
+        except FileNotFoundError:
+            journal_size = 0
+        if (journal_size + len(records) >
+                getsize(ann_file_path) * JOURNAL_COMPACTION_RATIO):
+            return False
+
+        try:
+            if journal_size:
+                # Don't append to the tail of a save that never completed
+                with open(journal_path, 'rb') as journal_file:
+                    journal_file.seek(-2, 2)
+                    if journal_file.read() != (JOURNAL_COMMIT + '\n').encode():
+                        return False
+            with open_textfile(journal_path, 'a') as journal_file:
+                journal_file.write(records)
+        except (IOError, OSError) as e:
+            self.messages.warning(
+                'Failed to append to annotation journal, rewriting: %s' % e)
+            return False
+
+        # Anyone watching for changes goes by the annotation file
+        utime(ann_file_path)
+        return True
+
     def save(self, document=None):
+        """Write the changes since the last save to the annotation file.
+
+        Nothing is written unless something has changed, which is known
+        from add_annotation, del_annotation and update_annotation (call the
+        latter after modifying an annotation in place). If
+        ANNOTATION_JOURNAL is set, the changes are appended to a journal
+        next to the annotation file (see _append_journal), which is applied
+        when parsing and compacted into the annotation file once large
+        enough. Otherwise the file is rewritten.
+        """
         if document is None:
             document = self._document
 
@@ -1199,76 +1488,107 @@ class Annotations(object):
 
         assert len(self._input_files) == 1, 'more than one valid outfile'
 
-        # We are hitting the disk a lot more than we should here, what we
-        # should have is a modification flag in the object but we can't
-        # due to how we change the annotations.
-
-        out_str = str(self)
-        with open_textfile(self._input_files[0], 'r') as old_ann_file:
-            old_str = old_ann_file.read()
-
-        # Was it changed?
-        if out_str == old_str:
-            # Then just return
+        if not self._modified:
             return
 
-        # Protect the write so we don't corrupt the file
-        if PROGRAMMATIC:
-            lock_file = contextlib.suppress()
-        else:
-            lock_file = FileLock(path_join(
-                    self.lock_dir, str(hash(self._input_files[0].replace('/', '_'))) + '.lock'
-            ))
-        with lock_file:
-            #from tempfile import NamedTemporaryFile
-            from tempfile import mkstemp
-            # TODO: XXX: Is copyfile really atomic?
-            from shutil import copyfile
-            # XXX: NamedTemporaryFile only supports encoding for Python 3
-            #       so we hack around it.
-            # with NamedTemporaryFile('w', suffix='.ann') as tmp_file:
-            # Grab the filename, but discard the handle
+        if ANNOTATION_JOURNAL and self._journal is not None:
+            with self._save_lock():
+                if self._append_journal():
+                    self._modified = False
+                    self._journal = []
+                    return
+
+        with self._save_lock():
+            self._rewrite()
+        self._modified = False
+        self._journal = []
+
+    def _rewrite(self):
+        # Replace the annotation file (and journal) with all annotations,
+        # assumes that the save lock is held
+        ann_file_path = self._input_files[0]
+        out_str = str(self)
+        #from tempfile import NamedTemporaryFile
+        from tempfile import mkstemp
+        from shutil import copyfile, copymode
+        # XXX: NamedTemporaryFile only supports encoding for Python 3
+        #       so we hack around it.
+        # with NamedTemporaryFile('w', suffix='.ann') as tmp_file:
+        # Grab the filename, but discard the handle
+        try:
+            # Next to the file, so that it can be atomically replaced
+            tmp_fh, tmp_fname = mkstemp(
+                prefix='.', suffix='.ann',
+                dir=dirname(ann_file_path) or None)
+            atomic = True
+        except OSError:
+            # We may not write to the directory, only to the file
             tmp_fh, tmp_fname = mkstemp(suffix='.ann')
-            os_close(tmp_fh)
+            atomic = False
+        os_close(tmp_fh)
+        try:
+            with open_textfile(tmp_fname, 'w') as tmp_file:
+                # XXX: Temporary hack to make sure we don't write corrupted
+                #       files, but the client will already have the version
+                #       at this stage leading to potential problems upon
+                #       the next change to the file.
+                tmp_file.write(out_str)
+                tmp_file.flush()
+
             try:
-                with open_textfile(tmp_fname, 'w') as tmp_file:
-                    # XXX: Temporary hack to make sure we don't write corrupted
-                    #       files, but the client will already have the version
-                    #       at this stage leading to potential problems upon
-                    #       the next change to the file.
-                    tmp_file.write(out_str)
-                    tmp_file.flush()
-
-                    try:
-                        # read only, because we write manually using copyfile; this prevents certain reentrant errors
-                        with Annotations(tmp_file.name, read_only=True) as ann:
-                            # Move the temporary file onto the old file
-                            copyfile(tmp_file.name, self._input_files[0])
-                            # As a matter of convention we adjust the modified
-                            # time of the data dir when we write to it. This
-                            # helps us to make back-ups
-                            # time()
-                            # XXX: Disabled for now!
-                            #utime(DATA_DIR, (now, now))
-                    except Exception as e:
-                        self.messages.error(
-                            'ERROR writing changes: generated annotations cannot be read back in!\n(This is almost certainly a system error, please contact the developers.)\n%s' %
-                            e, -1)
-                        raise
-            finally:
-                try:
-                    from os import remove
+                # read only, because we write manually; this prevents certain reentrant errors
+                with Annotations(tmp_fname, read_only=True) as ann:
+                    # Move the temporary file onto the old file
+                    if atomic:
+                        copymode(ann_file_path, tmp_fname)
+                        replace(tmp_fname, ann_file_path)
+                    else:
+                        copyfile(tmp_fname, ann_file_path)
+                    # The journal is now part of the file
+                    _remove_journal(ann_file_path)
+                    # As a matter of convention we adjust the modified
+                    # time of the data dir when we write to it. This
+                    # helps us to make back-ups
+                    # time()
+                    # XXX: Disabled for now!
+                    #utime(DATA_DIR, (now, now))
+            except Exception as e:
+                self.messages.error(
+                    'ERROR writing changes: generated annotations cannot be read back in!\n(This is almost certainly a system error, please contact the developers.)\n%s' %
+                    e, -1)
+                raise
+        finally:
+            try:
+                if exists(tmp_fname):
                     remove(tmp_fname)
-                except Exception as e:
-                    self.messages.error(
-                        "Error removing temporary file '%s'" %
-                        tmp_fname)
+            except Exception as e:
+                self.messages.error(
+                    "Error removing temporary file '%s'" %
+                    tmp_fname)
 
     def __in__(self, other):
         # XXX: You should do this one!
         pass
 
 
+def compact_journal(document, lock_dir=None):
+    """Merge the journal of the joined annotation file of the given
+    document (path without extension), if any, into the file itself.
+
+    The file is read and rewritten under the save lock, so that no save
+    made in between is lost."""
+    if lock_dir is None:
+        lock_dir = _default_lock_dir()
+    ann_file_path = document + '.' + JOINED_ANN_FILE_SUFF
+    with _file_save_lock(lock_dir, ann_file_path):
+        if not exists(_journal_path(ann_file_path)):
+            return
+        ann_obj = Annotations(document, lock_dir=lock_dir)
+        if ann_obj._read_only:
+            return
+        ann_obj._rewrite()
+
+
 class TextAnnotations(Annotations):
     """Text-bound annotation storage.
 
@@ -1341,6 +1661,7 @@ class TextAnnotations(Annotations):
                 u"Text-bound annotation missing text (expected format 'ID\\tTYPE START END\\tTEXT'). Filling from reference text. NOTE: This changes annotations on disk unless read-only.")
             text = "".join([self._document_text[start:end]
                             for start, end in spans])
+            self._fixed_on_parse.append(id)
 
         elif data_tail[0] != '\t':
             self.messages.error(
@@ -1371,6 +1692,7 @@ class TextAnnotations(Annotations):
                         u'NOTE: replacing old-style (pre-1.3) discontinuous annotation text span with new-style one, i.e. adding space to "%s" in .ann' % text[:len(oldstylereftext)], -1)
                     text = reftext
                     data_tail = ''
+                    self._fixed_on_parse.append(id)
                 else:
                     # unanticipated mismatch
                     self.messages.error(
@@ -1904,6 +2226,18 @@ class BinaryRelationAnnotation(IdedAnnotation):
         return soft_deps, hard_deps
 
 
+# Classes for which Annotations keeps a separate index, see get_events() etc.
+_INDEXED_CLASSES = (
+    EventAnnotation,
+    AttributeAnnotation,
+    EquivAnnotation,
+    TextBoundAnnotation,
+    BinaryRelationAnnotation,
+    NormalizationAnnotation,
+    OnelineCommentAnnotation,
+)
+
+
 def _writable(sugg_path):
     if exists(sugg_path):
         # check the file itself for writability
@@ -12,25 +12,29 @@ Version:    2011-04-22
 
 
 
+from itertools import chain
+from os.path import dirname
 from os.path import join as path_join
 from os.path import split as path_split
 from re import compile as re_compile
 
-from annotation import (DISCONT_SEP, TEXT_FILE_SUFFIX,
-                        AnnotationsIsReadOnlyError, AttributeAnnotation,
-                        BinaryRelationAnnotation,
+from annotation import (DISCONT_SEP, JOINED_ANN_FILE_SUFF, TEXT_FILE_SUFFIX,
+                        AnnotationNotFoundError, AnnotationsIsReadOnlyError,
+                        AttributeAnnotation, BinaryRelationAnnotation,
                         DependingAnnotationDeleteError, EquivAnnotation,
                         EventAnnotation, NormalizationAnnotation,
                         OnelineCommentAnnotation, SpanOffsetOverlapError,
                         TextAnnotations, TextBoundAnnotation,
                         TextBoundAnnotationWithText, open_textfile)
+from anncache import cached_annotations
 from common import ProtocolArgumentError, ProtocolError
 from document import real_directory
 from jsonwrap import dumps as json_dumps
 from jsonwrap import loads as json_loads
 from message import Messager
 from projectconfig import (ENTITY_CATEGORY, EVENT_CATEGORY, RELATION_CATEGORY,
-                           UNKNOWN_CATEGORY, ProjectConfiguration)
+                           UNKNOWN_CATEGORY, ProjectConfiguration,
+                           options_get_validation)
 
 try:
     from config import DEBUG
@@ -118,6 +122,92 @@ class ModificationTracker(object):
 
         return response
 
+    def json_delta(self, ann_obj):
+        """Returns the changes as an update of the annotation data the
+        client has for the document (see document._enrich_json_with_data),
+        or None if they can't be told as one. The ids in "deleted" and those
+        of the items in "updated" are to be removed from the data before
+        the latter are added, and the lists in "replaced" replace those in
+        the data. Must be called before the changes are saved."""
+        from document import (_attribute_json, _comment_json, _equiv_json,
+                              _event_json, _normalization_json,
+                              _relation_json, _textbound_json)
+
+        touched = self.__added + [a for b, a in self.__changed]
+        # Changes not told to the tracker would go amiss, those made since
+        # the last save (by the annotation object) must all be accounted for
+        journal = ann_obj._journal
+        if journal is None:
+            return None
+        tracked = set(getattr(a, 'id', None)
+                      for a in chain(touched, self.__deleted))
+        if any(getattr(a, 'id', None) not in tracked for _, a in journal):
+            return None
+
+        deleted = []
+        updated = {}
+        replaced = set()
+        textbound_ids = set()
+        for ann in chain(touched, self.__deleted):
+            if isinstance(ann, EquivAnnotation):
+                replaced.add('equivs')
+            elif isinstance(ann, OnelineCommentAnnotation):
+                replaced.add('comments')
+            elif isinstance(ann, EventAnnotation):
+                # The trigger may have become, or ceased to be, one
+                textbound_ids.add(ann.trigger)
+            elif not isinstance(ann, (TextBoundAnnotation,
+                                      BinaryRelationAnnotation,
+                                      AttributeAnnotation,
+                                      NormalizationAnnotation)):
+                return None
+        for ann in self.__deleted:
+            if not isinstance(ann, (EquivAnnotation,
+                                    OnelineCommentAnnotation)):
+                deleted.append(str(ann.id))
+
+        for ann in touched:
+            if isinstance(ann, TextBoundAnnotation):
+                textbound_ids.add(ann.id)
+            elif isinstance(ann, EventAnnotation):
+                updated.setdefault('events', []).append(_event_json(ann))
+            elif isinstance(ann, BinaryRelationAnnotation):
+                updated.setdefault('relations', []).append(
+                    _relation_json(ann))
+            elif isinstance(ann, AttributeAnnotation):
+                updated.setdefault('attributes', []).append(
+                    _attribute_json(ann))
+            elif isinstance(ann, NormalizationAnnotation):
+                updated.setdefault('normalizations', []).append(
+                    _normalization_json(ann))
+
+        textbounds = []
+        for id in textbound_ids:
+            try:
+                textbounds.append(ann_obj.get_ann_by_id(id))
+            except AnnotationNotFoundError:
+                # Deleted along with its event
+                pass
+        if textbounds:
+            trigger_ids = set(e.trigger for e in ann_obj.get_events())
+            for tb_ann in textbounds:
+                for key, j_tb in _textbound_json(tb_ann, trigger_ids,
+                                                 ann_obj):
+                    updated.setdefault(key, []).append(j_tb)
+
+        delta = {
+            'deleted': deleted,
+            'updated': updated,
+            'replaced': {},
+        }
+        if 'equivs' in replaced:
+            delta['replaced']['equivs'] = [
+                _equiv_json(a) for a in ann_obj.get_equivs()]
+        if 'comments' in replaced:
+            delta['replaced']['comments'] = [
+                _comment_json(a) for a in ann_obj.get_oneline_comments()]
+        return delta
+
 # TODO: revive the "unconfirmed annotation" functionality;
 # the following currently unused bit may help
 # def confirm_span(docdir, docname, span_id):
@@ -164,6 +254,43 @@ def _json_from_ann(ann_obj):
     return j_dic
 
 
+def _add_annotations_json(mods_json, ann_obj, mods, document_version=None):
+    # Attaches the annotations of the edited document to the response.
+    # Clients sending the document_version of the data they hold get only
+    # what changed (see ModificationTracker.json_delta()) as long as that
+    # is the version on disk, so that the response doesn't grow with the
+    # document, along with the new version. Must be called last thing
+    # before leaving the cached_annotations() block.
+    if document_version is None:
+        mods_json['annotations'] = _json_from_ann(ann_obj)
+        return mods_json
+
+    from document import _document_version
+    document = ann_obj.get_document()
+    # As in document._build_document_json_dict()
+    versioned = (not ann_obj.failed_lines and
+                 ann_obj._input_files == [
+                     document + '.' + JOINED_ANN_FILE_SUFF])
+    delta = None
+    if (versioned and document_version == _document_version(document) and
+            # Validation issues may come and go anywhere in the document
+            options_get_validation(dirname(document)) not in ('all', 'full')):
+        delta = mods.json_delta(ann_obj)
+
+    # Save while we hold the document, for the version to be ours; this
+    # clears the modifications, so the save on leaving the block is a no-op
+    ann_obj.save()
+    version = _document_version(document) if versioned else None
+
+    if delta is None or version is None:
+        mods_json['annotations'] = _json_from_ann(ann_obj)
+    else:
+        delta['mtime'] = ann_obj.ann_mtime
+        delta['ctime'] = ann_obj.ann_ctime
+        mods_json['annotations_delta'] = delta
+    if version is not None:
+        mods_json['document_version'] = version
+    return mods_json
 
 
 def _offsets_equal(o1, o2):
@@ -237,6 +364,7 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
             tb_ann.spans = offsets[:]
             tb_ann.text = _text_for_offsets(
                 ann_obj._document_text, tb_ann.spans)
+            ann_obj.update_annotation(tb_ann)
             #log_info('Span altered')
             mods.change(before, tb_ann)
 
@@ -275,6 +403,7 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
                         new_ann_trig.type = ann.type
                         # Update the old annotation to use this trigger
                         ann.trigger = str(new_ann_trig.id)
+                        ann_obj.update_annotation(ann)
                         ann_obj.add_annotation(new_ann_trig)
                         mods.addition(new_ann_trig)
                     else:
@@ -292,11 +421,13 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
                             # only users
                             before = str(ann_trig)
                             ann_trig.type = ann.type
+                            ann_obj.update_annotation(ann_trig)
                             mods.change(before, ann_trig)
                         else:
                             # Attach the new trigger THEN delete
                             # or the dep will hit you
                             ann.trigger = str(found.id)
+                            ann_obj.update_annotation(ann)
                             ann_obj.del_annotation(ann_trig)
                             mods.deletion(ann_trig)
             except AttributeError:
@@ -304,6 +435,7 @@ def _edit_span(ann_obj, mods, id, offsets, projectconf, attributes, type,
                 pass
 
             # Finally remember the change
+            ann_obj.update_annotation(ann)
             mods.change(before, ann)
     return tb_ann, e_ann
 
@@ -410,6 +542,7 @@ def _set_attributes(ann_obj, ann, attributes, mods, undo_resp={}):
             if existing_attr_ann.value != new_value:
                 before = str(existing_attr_ann)
                 existing_attr_ann.value = new_value
+                ann_obj.update_annotation(existing_attr_ann)
                 mods.change(before, existing_attr_ann)
 
     # The remaining annotations are new and should be created
@@ -442,16 +575,18 @@ def _json_offsets_to_list(offsets):
 
 
 def create_span(collection, document, offsets, type, attributes=None,
-                normalizations=None, id=None, comment=None):
+                normalizations=None, id=None, comment=None,
+                document_version=None):
     # offsets should be JSON string corresponding to a list of (start,
     # end) pairs; convert once at this interface
     offsets = _json_offsets_to_list(offsets)
 
     return _create_span(collection, document, offsets, type, attributes,
-                        normalizations, id, comment)
+                        normalizations, id, comment, document_version)
 
 
-def create_comment(collection, document, id, comment=None):
+def create_comment(collection, document, id, comment=None,
+                   document_version=None):
     directory = collection
     undo_resp = {}
 
@@ -465,7 +600,7 @@ def create_comment(collection, document, id, comment=None):
     # XXX what is this doing here?
     # path_split(document)[0]
 
-    with TextAnnotations(document) as ann_obj:
+    with cached_annotations(document) as ann_obj:
         # bail as quick as possible if read-only
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -477,8 +612,8 @@ def create_comment(collection, document, id, comment=None):
         mods_json = mods.json_response()
         if undo_resp:
             mods_json['undo'] = json_dumps(undo_resp)
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _add_annotations_json(mods_json, ann_obj, mods,
+                                     document_version)
 
 
 def _set_normalizations(ann_obj, ann, normalizations, mods, undo_resp={}):
@@ -517,6 +652,7 @@ def _set_normalizations(ann_obj, ann, normalizations, mods, undo_resp={}):
             if old_norm.reftext != new_reftext:
                 old = str(old_norm)
                 old_norm.reftext = new_reftext
+                ann_obj.update_annotation(old_norm)
                 mods.change(old, old_norm)
 
     # Process new normalizations
@@ -609,6 +745,7 @@ def _set_comments(ann_obj, ann, comment, mods, undo_resp={}):
             # XXX: Note the ugly tab, it is for parsing the tail
             before = str(found)
             found.tail = '\t' + comment
+            ann_obj.update_annotation(found)
             mods.change(before, found)
         else:
             # Create a new comment
@@ -644,6 +781,7 @@ def _set_special_comments(ann_obj, __id, comment, mods, undo_resp={}):
             # XXX: Note the ugly tab, it is for parsing the tail
             before = str(found)
             found.tail = '\t' + comment
+            ann_obj.update_annotation(found)
             mods.change(before, found)
         else:
             # Create a new comment
@@ -682,7 +820,8 @@ def _offset_overlaps(offsets):
 
 
 def _create_span(collection, document, offsets, _type, attributes=None,
-                 normalizations=None, _id=None, comment=None):
+                 normalizations=None, _id=None, comment=None,
+                 document_version=None):
 
     if _offset_overlaps(offsets):
         raise SpanOffsetOverlapError(offsets)
@@ -704,7 +843,7 @@ def _create_span(collection, document, offsets, _type, attributes=None,
 
     path_split(document)[0]
 
-    with TextAnnotations(document) as ann_obj:
+    with cached_annotations(document) as ann_obj:
         # bail as quick as possible if read-only
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -759,8 +898,8 @@ def _create_span(collection, document, offsets, _type, attributes=None,
 
         if undo_resp:
             mods_json['undo'] = json_dumps(undo_resp)
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _add_annotations_json(mods_json, ann_obj, mods,
+                                     document_version)
 
 
 
@@ -850,6 +989,7 @@ def _create_relation(ann_obj, projectconf, mods, origin, target, type,
             before = str(found)
             found.arg2 = target.id
             found.type = type
+            ann_obj.update_annotation(found)
             mods.change(before, found)
 
         target_ann = found
@@ -890,6 +1030,7 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type,
             if arg_tup not in origin.args:
                 before = str(origin)
                 origin.add_argument(type, str(target.id))
+                ann_obj.update_annotation(origin)
                 mods.change(before, origin)
             else:
                 # It already existed as an arg, we were called to do nothing...
@@ -903,6 +1044,7 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type,
                 before = str(origin)
                 origin.args.remove(old_arg_tup)
                 origin.add_argument(type, str(target.id))
+                ann_obj.update_annotation(origin)
                 mods.change(before, origin)
             else:
                 # Collision etc. don't do anything
@@ -925,14 +1067,16 @@ def _create_argument(ann_obj, projectconf, mods, origin, target, type,
     return None
 
 
-def reverse_arc(collection, document, origin, target, type, attributes=None):
+def reverse_arc(collection, document, origin, target, type, attributes=None,
+                document_version=None):
     directory = collection
     # undo_resp = {} # TODO
     real_dir = real_directory(directory)
-    # mods = ModificationTracker() # TODO
+    # Not reported as edits yet, only as what changed in the annotations
+    mods = ModificationTracker()
     projectconf = ProjectConfiguration(real_dir)
     document = path_join(real_dir, document)
-    with TextAnnotations(document) as ann_obj:
+    with cached_annotations(document) as ann_obj:
         # bail as quick as possible if read-only
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -956,18 +1100,21 @@ def reverse_arc(collection, document, origin, target, type, attributes=None):
                     (str(origin), str(target), str(type)))
             else:
                 # found it; just adjust this
+                before = str(found)
                 found.arg1, found.arg2 = found.arg2, found.arg1
-                # TODO: modification tracker
+                ann_obj.update_annotation(found)
+                mods.change(before, found)
 
         json_response = {}
-        json_response['annotations'] = _json_from_ann(ann_obj)
-        return json_response
+        return _add_annotations_json(json_response, ann_obj, mods,
+                                     document_version)
 
 # TODO: undo support
 
 
 def create_arc(collection, document, origin, target, type, attributes=None,
-               old_type=None, old_target=None, comment=None):
+               old_type=None, old_target=None, comment=None,
+               document_version=None):
     directory = collection
     undo_resp = {}
 
@@ -979,7 +1126,7 @@ def create_arc(collection, document, origin, target, type, attributes=None,
 
     document = path_join(real_dir, document)
 
-    with TextAnnotations(document) as ann_obj:
+    with cached_annotations(document) as ann_obj:
         # bail as quick as possible if read-only
         # TODO: make consistent across the different editing
         # functions, integrate ann_obj initialization and checks
@@ -1021,8 +1168,8 @@ def create_arc(collection, document, origin, target, type, attributes=None,
                 'create_arc: non-empty comment for None annotation (unsupported type for comment?)')
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _add_annotations_json(mods_json, ann_obj, mods,
+                                     document_version)
 
 # helper for delete_arc
 
@@ -1038,6 +1185,7 @@ def _delete_arc_equiv(origin, target, type_, mods, ann_obj):
             before = str(eq_ann)
             eq_ann.entities.remove(str(origin))
             eq_ann.entities.remove(str(target))
+            ann_obj.update_annotation(eq_ann)
             mods.change(before, eq_ann)
 
         if len(eq_ann.entities) < 2:
@@ -1073,6 +1221,7 @@ def _delete_arc_event_arg(origin, target, type_, mods, ann_obj):
     if arg_tup in event_ann.args:
         before = str(event_ann)
         event_ann.args.remove(arg_tup)
+        ann_obj.update_annotation(event_ann)
         mods.change(before, event_ann)
     else:
         # What we were to remove did not even exist in the first place
@@ -1096,7 +1245,8 @@ def _delete_arc_with_ann(origin, target, type_, mods, ann_obj, projectconf):
         Messager.error('Unknown annotation types for delete')
 
 
-def delete_arc(collection, document, origin, target, type):
+def delete_arc(collection, document, origin, target, type,
+               document_version=None):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -1107,7 +1257,7 @@ def delete_arc(collection, document, origin, target, type):
 
     document = path_join(real_dir, document)
 
-    with TextAnnotations(document) as ann_obj:
+    with cached_annotations(document) as ann_obj:
         # bail as quick as possible if read-only
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -1115,22 +1265,22 @@ def delete_arc(collection, document, origin, target, type):
         _delete_arc_with_ann(origin, target, type, mods, ann_obj, projectconf)
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _add_annotations_json(mods_json, ann_obj, mods,
+                                     document_version)
 
     # TODO: error handling?
 
 # TODO: ONLY determine what action to take! Delegate to Annotations!
 
 
-def delete_span(collection, document, id):
+def delete_span(collection, document, id, document_version=None):
     directory = collection
 
     real_dir = real_directory(directory)
 
     document = path_join(real_dir, document)
 
-    with TextAnnotations(document) as ann_obj:
+    with cached_annotations(document) as ann_obj:
         # bail as quick as possible if read-only
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -1160,8 +1310,8 @@ def delete_span(collection, document, id):
             }
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _add_annotations_json(mods_json, ann_obj, mods,
+                                     document_version)
 
 
 class AnnotationSplitError(ProtocolError):
@@ -1177,7 +1327,7 @@ class AnnotationSplitError(ProtocolError):
         return json_dic
 
 
-def split_span(collection, document, args, id):
+def split_span(collection, document, args, id, document_version=None):
     directory = collection
 
     real_dir = real_directory(directory)
@@ -1186,7 +1336,7 @@ def split_span(collection, document, args, id):
     # and split
     tosplit_args = json_loads(args)
 
-    with TextAnnotations(document) as ann_obj:
+    with cached_annotations(document) as ann_obj:
         # bail as quick as possible if read-only
         if ann_obj._read_only:
             raise AnnotationsIsReadOnlyError(ann_obj.get_document())
@@ -1243,6 +1393,7 @@ def split_span(collection, document, args, id):
             # tweak args
             if i == 0:
                 ann.args = nonsplit_args[:] + arg_combo
+                ann_obj.update_annotation(ann)
             else:
                 newann = deepcopy(ann)
                 # TODO: avoid hard-coding ID prefix
@@ -1254,59 +1405,58 @@ def split_span(collection, document, args, id):
 
         # then, go through all the annotations referencing the original
         # event, and create appropriate copies
-        for a in ann_obj:
-            soft_deps, hard_deps = a.get_deps()
-            refs = soft_deps | hard_deps
-            if ann.id in refs:
-                # Referenced; make duplicates appropriately
-
-                if isinstance(a, EventAnnotation):
-                    # go through args and make copies for referencing
-                    new_args = []
-                    for arg, aid in a.args:
-                        if aid == ann.id:
-                            for newe in new_events:
-                                new_args.append((arg, newe.id))
-                    a.args.extend(new_args)
-
-                elif isinstance(a, AttributeAnnotation):
-                    for newe in new_events:
-                        newmod = deepcopy(a)
-                        newmod.target = newe.id
-                        # TODO: avoid hard-coding ID prefix
-                        newmod.id = ann_obj.get_new_id("A")
-                        ann_obj.add_annotation(newmod)
-                        mods.addition(newmod)
-
-                elif isinstance(a, BinaryRelationAnnotation):
-                    # TODO
-                    raise AnnotationSplitError(
-                        "Cannot adjust annotation referencing split: not implemented for relations! (WARNING: annotations may be in inconsistent state, please reload!) (Please complain to the developers to fix this!)")
-
-                elif isinstance(a, OnelineCommentAnnotation):
-                    for newe in new_events:
-                        newcomm = deepcopy(a)
-                        newcomm.target = newe.id
-                        # TODO: avoid hard-coding ID prefix
-                        newcomm.id = ann_obj.get_new_id("#")
-                        ann_obj.add_annotation(newcomm)
-                        mods.addition(newcomm)
-                elif isinstance(a, NormalizationAnnotation):
-                    for newe in new_events:
-                        newnorm = deepcopy(a)
-                        newnorm.target = newe.id
-                        # TODO: avoid hard-coding ID prefix
-                        newnorm.id = ann_obj.get_new_id("N")
-                        ann_obj.add_annotation(newnorm)
-                        mods.addition(newnorm)
-                else:
-                    raise AnnotationSplitError(
-                        "Cannot adjust annotation referencing split: not implemented for %s! (Please complain to the lazy developers to fix this!)" %
-                        a.__class__)
+        # (get_referrers() returns a copy, safe to add to ann_obj)
+        for a in ann_obj.get_referrers(ann.id):
+            # Referenced; make duplicates appropriately
+
+            if isinstance(a, EventAnnotation):
+                # go through args and make copies for referencing
+                new_args = []
+                for arg, aid in a.args:
+                    if aid == ann.id:
+                        for newe in new_events:
+                            new_args.append((arg, newe.id))
+                a.args.extend(new_args)
+                ann_obj.update_annotation(a)
+
+            elif isinstance(a, AttributeAnnotation):
+                for newe in new_events:
+                    newmod = deepcopy(a)
+                    newmod.target = newe.id
+                    # TODO: avoid hard-coding ID prefix
+                    newmod.id = ann_obj.get_new_id("A")
+                    ann_obj.add_annotation(newmod)
+                    mods.addition(newmod)
+
+            elif isinstance(a, BinaryRelationAnnotation):
+                # TODO
+                raise AnnotationSplitError(
+                    "Cannot adjust annotation referencing split: not implemented for relations! (WARNING: annotations may be in inconsistent state, please reload!) (Please complain to the developers to fix this!)")
+
+            elif isinstance(a, OnelineCommentAnnotation):
+                for newe in new_events:
+                    newcomm = deepcopy(a)
+                    newcomm.target = newe.id
+                    # TODO: avoid hard-coding ID prefix
+                    newcomm.id = ann_obj.get_new_id("#")
+                    ann_obj.add_annotation(newcomm)
+                    mods.addition(newcomm)
+            elif isinstance(a, NormalizationAnnotation):
+                for newe in new_events:
+                    newnorm = deepcopy(a)
+                    newnorm.target = newe.id
+                    # TODO: avoid hard-coding ID prefix
+                    newnorm.id = ann_obj.get_new_id("N")
+                    ann_obj.add_annotation(newnorm)
+                    mods.addition(newnorm)
+            else:
+                raise AnnotationSplitError(
+                    "Cannot adjust annotation referencing split: not implemented for %s! (Please complain to the lazy developers to fix this!)" %
+                    a.__class__)
 
         mods_json = mods.json_response()
-        mods_json['annotations'] = _json_from_ann(ann_obj)
-        return mods_json
+        return _add_annotations_json(mods_json, ann_obj, mods,
+                                     document_version)
 
 
 def set_status(directory, document, status=None):
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+"""Persistent pre-forked application server.
+
+Serving each request in a fresh process (CGI, or a fork per request for the
+standalone server) pays for the imports, the configuration check and the
+logging setup every time and throws away every in-memory cache (parsed
+documents, project configurations, statistics) once the request is done.
+
+An AppServer instead keeps a pool of long-running worker processes, each
+serving one request at a time through server.serve() and keeping its caches
+warm between requests. Requests for the same collection are routed to the
+same worker as long as it isn't busy with something else, so that they find
+what earlier requests left in its caches. Workers are replaced after a
+number of requests (see APP_SERVER_MAX_REQUESTS) to bound leaks, and all of
+them on reload(), e.g. on SIGHUP, once they are done with the request at
+hand.
+
+AppServer.serve() has the same signature and return value as server.serve(),
+so front ends (standalone, FastCGI) only need to swap one for the other.
+The calling process doesn't import the server itself and may use threads.
+"""
+
+import multiprocessing
+import signal
+from os import cpu_count
+from threading import Lock, Thread
+from time import time
+from zlib import crc32
+
+from jsonwrap import dumps
+
+# Number of worker processes, 0 for one per CPU
+try:
+    from config import APP_SERVER_WORKERS
+except ImportError:
+    APP_SERVER_WORKERS = 0
+
+# Number of requests after which a worker is replaced (never if <= 0)
+try:
+    from config import APP_SERVER_MAX_REQUESTS
+except ImportError:
+    APP_SERVER_MAX_REQUESTS = 1000
+
+# Seconds to wait for a worker to exit before killing it
+WORKER_EXIT_TIMEOUT = 10
+JSON_HDR = ('Content-Type', 'application/json')
+
+
+class RequestParams(object):
+    """Picklable stand-in for the FieldStorage of a request, providing the
+    parts of it that server.serve() uses."""
+
+    def __init__(self, values=None):
+        self._values = values if values is not None else {}
+
+    @classmethod
+    def from_field_storage(cls, field_storage):
+        try:
+            keys = list(field_storage.keys())
+        except TypeError:
+            # Not form data, nothing that the server could use
+            keys = []
+        return cls(dict((k, field_storage.getvalue(k)) for k in keys))
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def keys(self):
+        return list(self._values.keys())
+
+    def getvalue(self, key, default=None):
+        return self._values.get(key, default)
+
+
+def _worker_main(connection, max_requests):
+    # Interrupts and reloads are for the parent to handle
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    from server import serve
+
+    served = 0
+    while True:
+        try:
+            request = connection.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+
+        response = serve(*request)
+        served += 1
+        retiring = max_requests > 0 and served >= max_requests
+        connection.send((response, retiring))
+        if retiring:
+            break
+    connection.close()
+
+
+def _failure_response(message):
+    # The server isn't available in this process, so this is done by hand
+    return None, ((JSON_HDR, ), dumps({
+        'exception': 'serverCrash',
+        'messages': [[message, 'error', -1]],
+    }))
+
+
+class _Worker(object):
+    def __init__(self, context, max_requests):
+        self.connection, child_connection = context.Pipe()
+        # Not daemonic so that workers may in turn start processes to
+        # parse documents (see docpool)
+        self.process = context.Process(target=_worker_main,
+                                       args=(child_connection, max_requests))
+        self.process.start()
+        child_connection.close()
+
+    def request(self, request):
+        self.connection.send(request)
+        return self.connection.recv()
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(WORKER_EXIT_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.connection.close()
+
+
+class _Slot(object):
+    # A worker and the lock held while it serves a request
+    def __init__(self):
+        self.lock = Lock()
+        self.worker = None
+
+
+class AppServer(object):
+    def __init__(self, workers=None, max_requests=None):
+        if workers is None:
+            workers = APP_SERVER_WORKERS
+        if workers <= 0:
+            workers = cpu_count() or 1
+        if max_requests is None:
+            max_requests = APP_SERVER_MAX_REQUESTS
+        self.max_requests = max_requests
+        # Fresh interpreters, so that reloading picks up changes to the
+        # server and its configuration
+        self._context = multiprocessing.get_context('spawn')
+        self._slots = [_Slot() for _ in range(workers)]
+        self._next_slot = 0
+        self._next_slot_lock = Lock()
+        self._closed = False
+
+    def start(self):
+        for slot in self._slots:
+            with slot.lock:
+                if slot.worker is None:
+                    slot.worker = self._start_worker()
+        return self
+
+    def _start_worker(self):
+        return _Worker(self._context, self.max_requests)
+
+    def _replace_worker(self, slot):
+        # Assumes that slot.lock is held
+        if slot.worker is not None:
+            slot.worker.stop()
+        slot.worker = self._start_worker() if not self._closed else None
+
+    def _affinity_slot(self, params):
+        # Requests for a collection share its caches (configuration,
+        # statistics, search index and documents)
+        collection = params.getvalue('collection')
+        if isinstance(collection, str) and collection:
+            return crc32(collection.encode('utf-8')) % len(self._slots)
+        with self._next_slot_lock:
+            self._next_slot = (self._next_slot + 1) % len(self._slots)
+            return self._next_slot
+
+    def _acquire_slot(self, preferred):
+        # Take the preferred worker if idle, otherwise any idle one, and
+        # wait for the preferred one if all are busy
+        count = len(self._slots)
+        for i in range(count):
+            slot = self._slots[(preferred + i) % count]
+            if slot.lock.acquire(False):
+                return slot
+        slot = self._slots[preferred]
+        slot.lock.acquire()
+        return slot
+
+    def serve(self, params, client_ip, client_hostname, cookie_data):
+        """Serves a request in one of the workers, see server.serve()."""
+        if not isinstance(params, RequestParams):
+            params = RequestParams.from_field_storage(params)
+        request = (params, client_ip, client_hostname, cookie_data)
+
+        slot = self._acquire_slot(self._affinity_slot(params))
+        try:
+            if self._closed:
+                return _failure_response('The server is shutting down')
+            if slot.worker is None or not slot.worker.process.is_alive():
+                self._replace_worker(slot)
+            try:
+                response, retiring = slot.worker.request(request)
+            except (EOFError, OSError):
+                # Don't retry, the request may have had effects already
+                self._replace_worker(slot)
+                return _failure_response(
+                    'The server process handling the request exited '
+                    'unexpectedly (id #%d)' % int(time()))
+            if retiring:
+                self._replace_worker(slot)
+            return response
+        finally:
+            slot.lock.release()
+
+    def reload(self):
+        """Replaces every worker once it is done with its current request,
+        without interrupting the serving of others."""
+        for slot in self._slots:
+            with slot.lock:
+                self._replace_worker(slot)
+
+    def reload_in_background(self):
+        thread = Thread(target=self.reload, name='brat-reload')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def install_signal_handlers(self):
+        """Reloads the workers on SIGHUP (where available), must be called
+        from the main thread."""
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: self.reload_in_background())
+
+    def close(self):
+        self._closed = True
+        for slot in self._slots:
+            with slot.lock:
+                if slot.worker is not None:
+                    slot.worker.stop()
+                    slot.worker = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+"""Asyncio HTTP front end for the brat server.
+
+Requests to ajax.cgi are served with server.serve_async(): the actions that
+wait on other services (tagging, normalization search, type suggestions,
+collection downloads) do so in the event loop, so that any number of
+annotators can wait on slow taggers at once, and all other actions run in
+a pool of executor threads (see ASYNC_SERVER_THREADS). Each connection is
+served in a task of its own, thus in a context of its own (see wsgiapp).
+
+Other paths are served as static files, subject to the given permission
+check. One request is served per connection.
+"""
+
+import asyncio
+import mimetypes
+from cgi import FieldStorage
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from http.client import parse_headers
+from io import BytesIO
+from os.path import isdir, isfile
+from os.path import join as path_join
+from posixpath import normpath
+from urllib.parse import unquote
+
+from server import serve_async
+
+# Number of threads for the actions that don't wait asynchronously
+try:
+    from config import ASYNC_SERVER_THREADS
+except ImportError:
+    ASYNC_SERVER_THREADS = 8
+
+# Longest request line or header block accepted
+MAX_HEADER_SIZE = 65536
+# Largest request body accepted (e.g. of a document import)
+MAX_BODY_SIZE = 64 * 1024 * 1024
+BRAT_PATH = '/ajax.cgi'
+
+
+def _index_file(file_path):
+    for index in ('index.html', 'index.htm'):
+        index_path = path_join(file_path, index)
+        if isfile(index_path):
+            return index_path
+    return None
+
+
+def _read_file(file_path):
+    with open(file_path, 'rb') as static_file:
+        return static_file.read()
+
+
+class AsyncBratServer(object):
+    def __init__(self, root, allow_path):
+        """Serves brat from the installation directory root; allow_path(path)
+        decides whether a (normalised) static file path may be served."""
+        self.root = root
+        self.allow_path = allow_path
+
+    async def _respond(self, writer, status, headers=(), body=b'',
+                       head_only=False):
+        status = HTTPStatus(status)
+        lines = ['HTTP/1.0 %d %s' % (status.value, status.phrase)]
+        lines.extend('%s: %s' % (k, v) for k, v in headers)
+        lines.append('Content-Length: %d' % len(body))
+        lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not head_only:
+            writer.write(body)
+        await writer.drain()
+
+    async def _serve_brat(self, writer, method, query_string, headers,
+                          body):
+        env = {'REQUEST_METHOD': method}
+        if body:
+            env['CONTENT_LENGTH'] = str(len(body))
+        if query_string:
+            env['QUERY_STRING'] = query_string
+        params = FieldStorage(fp=BytesIO(body), headers=headers, environ=env)
+
+        remote_addr = writer.get_extra_info('peername')[0]
+        cookie_data = ', '.join(headers.get_all('cookie', []))
+        # No hostname lookups, as with a CGI server not doing them
+        cookie_hdrs, response_data = await serve_async(
+            params, remote_addr, None, cookie_data)
+
+        response_hdrs = list(cookie_hdrs) if cookie_hdrs is not None else []
+        response_hdrs.extend(response_data[0])
+        response_body = response_data[1]
+        # Hack to support binary data and general Unicode for SVGs and JSON
+        if isinstance(response_body, str):
+            response_body = response_body.encode('utf-8')
+        await self._respond(writer, 200, response_hdrs, response_body)
+
+    async def _serve_static(self, writer, method, path):
+        path = normpath(unquote(path))
+        parts = [p for p in path.split('/') if p]
+        if '..' in parts or not self.allow_path('/' + '/'.join(parts)):
+            await self._respond(writer, 403)
+            return
+
+        file_path = path_join(self.root, *parts)
+        if isdir(file_path):
+            # TODO: permissions for directory listings
+            file_path = _index_file(file_path)
+        if file_path is None or not isfile(file_path):
+            await self._respond(writer, 404)
+            return
+
+        content_type = mimetypes.guess_type(file_path)[0]
+        body = await asyncio.get_running_loop().run_in_executor(
+            None, _read_file, file_path)
+        await self._respond(writer,
+                            200, [('Content-Type',
+                                   content_type or 'application/octet-stream')],
+                            body, head_only=(method == 'HEAD'))
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            request_line, _, header_data = head.partition(b'\r\n')
+            try:
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            except ValueError:
+                await self._respond(writer, 400)
+                return
+            headers = parse_headers(BytesIO(header_data))
+            try:
+                content_length = int(headers.get('content-length') or 0)
+            except ValueError:
+                content_length = -1
+            if content_length < 0:
+                await self._respond(writer, 400)
+                return
+            if content_length > MAX_BODY_SIZE:
+                await self._respond(writer, 413)
+                return
+            try:
+                body = await reader.readexactly(content_length)
+            except asyncio.IncompleteReadError:
+                await self._respond(writer, 400)
+                return
+
+            path, _, query_string = target.split('#', 1)[0].partition('?')
+            if path == BRAT_PATH and method in ('GET', 'POST'):
+                await self._serve_brat(writer, method, query_string, headers,
+                                       body)
+            elif method in ('GET', 'HEAD'):
+                await self._serve_static(writer, method, path)
+            else:
+                await self._respond(writer, 501)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self, host, port, ready=None):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(ASYNC_SERVER_THREADS))
+        server = await asyncio.start_server(self.handle, host, port,
+                                            limit=MAX_HEADER_SIZE)
+        if ready is not None:
+            ready(server)
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+"""Support for serving requests from an asyncio event loop.
+
+Actions that mostly wait on other services (taggers, disambiguators,
+simstring, tar) have coroutine versions (see dispatch.ASYNC_DISPATCHER)
+so that a slow service holds up neither a process nor a thread while it
+works. Anything that blocks (file access, parsing) is handed to the default
+executor of the loop with run_blocking().
+"""
+
+import asyncio
+import ssl
+from contextvars import copy_context
+from http.client import HTTPResponse
+from io import BytesIO
+from urllib.parse import urlparse
+
+from message import Messager
+
+# Seconds to wait for a service before giving up
+HTTP_TIMEOUT = 30
+
+
+async def run_blocking(function, *args):
+    """Calls function(*args) in the default executor of the running loop,
+    in (a copy of) the context of the request being served."""
+    # Messages added in the executor are to be seen by the request
+    Messager.prepare_context()
+    context = copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        None, context.run, function, *args)
+
+
+class _ReceivedResponse(object):
+    # Lets http.client parse a response that has already been read
+    def __init__(self, data):
+        self._data = data
+
+    def makefile(self, mode):
+        return BytesIO(self._data)
+
+
+async def http_request(method, url, body=None, headers=None,
+                       timeout=HTTP_TIMEOUT):
+    """Makes an HTTP(S) request without blocking the event loop and
+    returns the http.client.HTTPResponse, which has been read in full.
+
+    Raises ValueError for other URL schemes, OSError if the service can't
+    be reached and asyncio.TimeoutError if it doesn't respond in time.
+    """
+    url_soup = urlparse(url)
+    if url_soup.scheme == 'http':
+        ssl_context = None
+    elif url_soup.scheme == 'https':
+        ssl_context = ssl.create_default_context()
+    else:
+        raise ValueError('unsupported URL scheme "%s"' % url_soup.scheme)
+    port = url_soup.port or (443 if ssl_context is not None else 80)
+
+    request_lines = ['%s %s HTTP/1.0' % (
+        method, (url_soup.path or '/') +
+        ('?' + url_soup.query if url_soup.query else '')),
+        'Host: %s' % url_soup.netloc]
+    headers = dict(headers or {})
+    if body is not None:
+        headers['Content-Length'] = len(body)
+    request_lines.extend('%s: %s' % (k, v) for k, v in headers.items())
+    request = ('\r\n'.join(request_lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _exchange():
+        reader, writer = await asyncio.open_connection(
+            url_soup.hostname, port, ssl=ssl_context)
+        try:
+            writer.write(request + (body or b''))
+            await writer.drain()
+            # An HTTP/1.0 response ends where the connection does
+            return await reader.read()
+        finally:
+            writer.close()
+
+    data = await asyncio.wait_for(_exchange(), timeout)
+    response = HTTPResponse(_ReceivedResponse(data), method=method)
+    try:
+        response.begin()
+        response.data = response.read()
+    except Exception as e:
+        raise OSError('invalid HTTP response from %s: %s' % (url, e))
+    return response
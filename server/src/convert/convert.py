@@ -6,6 +6,7 @@ Version:    2012-06-26
 
 
 
+from itertools import chain
 from os.path import join as path_join
 from shutil import rmtree
 from tempfile import mkdtemp
@@ -13,6 +14,7 @@ from tempfile import mkdtemp
 from annotation import Annotations, open_textfile
 from common import ProtocolError
 from document import _document_json_dict
+from ssplit import merge_spanned_sentences
 
 from .stanford import basic_dep as stanford_basic_dep
 from .stanford import collapsed_ccproc_dep as stanford_collapsed_ccproc_dep
@@ -75,7 +77,13 @@ def convert(data, src):
         #   output rather than relying on the ones generated by brat.
         if src.startswith('stanford-'):
             json_dic['token_offsets'] = stanford_token_offsets(data)
-            json_dic['sentence_offsets'] = stanford_sentence_offsets(data)
+            # Note: As for the brat ones, no sentence may end inside an
+            #   annotation
+            json_dic['sentence_offsets'] = merge_spanned_sentences(
+                stanford_sentence_offsets(data),
+                (span for tb in chain(json_dic['entities'],
+                                      json_dic['triggers'])
+                 for span in tb[2]))
 
         return json_dic
     finally:
@@ -18,6 +18,7 @@ from config import DATA_DIR, USER_PASSWORD
 from annlog import log_annotation
 from annotator import (create_arc, create_span, delete_arc, delete_span,
                        reverse_arc, split_span, create_comment)
+from asyncsupport import run_blocking
 from auth import NotAuthorisedError, login, logout, whoami
 from common import ProtocolError
 from convert.convert import convert
@@ -25,16 +26,17 @@ from delete import delete_collection, delete_document
 from docimport import save_import
 from document import (get_configuration, get_directory_information,
                       get_document, get_document_timestamp)
-from download import download_collection, download_file
+from download import (download_collection, download_collection_async,
+                      download_file)
 from jsonwrap import dumps
 from message import Messager
-from norm import norm_get_data, norm_get_name, norm_search
-from predict import suggest_span_types
+from norm import norm_get_data, norm_get_name, norm_search, norm_search_async
+from predict import suggest_span_types, suggest_span_types_async
 from search import (search_entity, search_event, search_note, search_relation,
                     search_text)
 from session import get_session, load_conf, save_conf
 from svg import retrieve_stored, store_svg
-from tag import tag
+from tag import tag, tag_async
 from undo import undo
 
 # no-op function that can be invoked by client to log a user action
@@ -46,6 +48,7 @@ def logging_no_op(collection, document, log):
 
 
 # Constants
+PROTOCOL_VERSION = 1
 # Function call-backs
 DISPATCHER = {
     'getCollectionInformation': get_directory_information,
@@ -118,6 +121,16 @@ ANNOTATION_ACTION = set((
     'undo',
 ))
 
+# Coroutine versions of the actions that mostly wait on other services or
+# processes, for asyncio front ends (see dispatch_async()); these take the
+# same arguments as their counterparts in DISPATCHER
+ASYNC_DISPATCHER = {
+    'tag': tag_async,
+    'normSearch': norm_search_async,
+    'suggestSpanTypes': suggest_span_types_async,
+    'downloadCollection': download_collection_async,
+}
+
 # Actions that will be logged as annotator actions (if so configured)
 LOGGED_ANNOTATOR_ACTION = ANNOTATION_ACTION | set((
     'getDocument',
@@ -140,6 +153,9 @@ REQUIRES_AUTHENTICATION = ANNOTATION_ACTION | set((
 ))
 
 # Sanity check
+for async_action in ASYNC_DISPATCHER:
+    assert async_action in DISPATCHER, (
+        'INTERNAL ERROR: undefined action in ASYNC_DISPATCHER')
 for req_action in REQUIRES_AUTHENTICATION:
     assert req_action in DISPATCHER, (
         'INTERNAL ERROR: undefined action in REQUIRES_AUTHENTICATION set')
@@ -226,13 +242,14 @@ def _directory_is_safe(dir_path):
                    ).startswith(normpath(DATA_DIR))
 
 
-def dispatch(http_args, client_ip, client_hostname):
+def _action_call(http_args, client_ip, client_hostname):
+    """Validates the request and returns the action, the function
+    implementing it and the arguments to call it with."""
     action = http_args['action']
 
     log_info('dispatcher handling action: %s' % (action, ))
 
     # Verify that we don't have a protocol version mismatch
-    PROTOCOL_VERSION = 1
     try:
         protocol_version = int(http_args['protocol'])
         if protocol_version != PROTOCOL_VERSION:
@@ -312,8 +329,10 @@ def dispatch(http_args, client_ip, client_hostname):
 
     # TODO: log_annotation for exceptions?
 
-    json_dic = action_function(*action_args)
+    return action, action_function, action_args
+
 
+def _action_response(http_args, action, action_args, json_dic):
     # Log annotation actions separately (if so configured)
     if action in LOGGED_ANNOTATOR_ACTION:
         log_annotation(http_args['collection'],
@@ -325,3 +344,25 @@ def dispatch(http_args, client_ip, client_hostname):
     # Return the protocol version for symmetry
     json_dic['protocol'] = PROTOCOL_VERSION
     return json_dic
+
+
+def dispatch(http_args, client_ip, client_hostname):
+    action, action_function, action_args = _action_call(
+        http_args, client_ip, client_hostname)
+    json_dic = action_function(*action_args)
+    return _action_response(http_args, action, action_args, json_dic)
+
+
+async def dispatch_async(http_args, client_ip, client_hostname):
+    """Coroutine version of dispatch() for asyncio front ends.
+
+    Actions in ASYNC_DISPATCHER are awaited, all others are run in the
+    executor of the event loop."""
+    action, action_function, action_args = _action_call(
+        http_args, client_ip, client_hostname)
+    async_function = ASYNC_DISPATCHER.get(action)
+    if async_function is not None:
+        json_dic = await async_function(*action_args)
+    else:
+        json_dic = await run_blocking(action_function, *action_args)
+    return _action_response(http_args, action, action_args, json_dic)
@@ -8,13 +8,14 @@ Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
 Version:    2011-02-21
 """
 
-from os import W_OK, access
+from os import W_OK, access, remove
 from os.path import join as join_path
 from os.path import isdir, isfile
 
 from config import DATA_DIR
 
-from annotation import JOINED_ANN_FILE_SUFF, TEXT_FILE_SUFFIX, open_textfile
+from annotation import (JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF,
+                        TEXT_FILE_SUFFIX, open_textfile)
 from common import ProtocolError
 from document import real_directory
 
@@ -102,6 +103,10 @@ def save_import(text, docid, collection=None):
     # Touch the ann file so that we can edit the file later
     with open(ann_path, 'w') as _:
         pass
+    # A journal left behind by a removed file of the same name is not ours
+    journal_path = ann_path + '.' + JOURNAL_FILE_SUFF
+    if isfile(journal_path):
+        remove(journal_path)
 
     return {'document': docid}
 
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+"""Parallel per-document processing in a pool of worker processes.
+
+Parsing every document in a collection (for search or statistics) is CPU
+bound and the documents are independent of each other, so this can be
+spread over a bounded number of processes. Results are streamed back in
+document order, along with any messages the workers added to the Messager,
+which are passed on to the Messager of the calling process.
+
+The servers handle requests in threads, which a forked process could find
+holding locks that no thread of its own will ever release, so the workers
+are started afresh (as those of appserver) once per process and kept for
+the following requests.
+"""
+
+import multiprocessing
+from atexit import register as atexit_register
+from os import cpu_count
+from threading import Lock
+
+from message import Messager
+
+# Number of worker processes for parsing documents in parallel, 0 for one
+# per CPU (disabled if 1)
+try:
+    from config import DOCUMENT_WORKERS
+except ImportError:
+    DOCUMENT_WORKERS = 1
+
+# Fewer documents than this are not worth starting processes for
+MIN_DOCUMENTS_PER_WORKER = 4
+
+_MESSAGE_FUNCTIONS = {
+    'comment': Messager.info,
+    'warning': Messager.warning,
+    'error': Messager.error,
+    'debug': Messager.debug,
+}
+
+
+def _pending_messages():
+    return Messager.output_json({}).get('messages', [])
+
+
+def _call(args):
+    function, document = args
+    result = function(document)
+    return result, _pending_messages()
+
+
+_POOL = None
+_POOL_SIZE = 0
+_POOL_LOCK = Lock()
+
+
+def _pool(size):
+    # The pool of this process, restarted if its size is to change
+    global _POOL, _POOL_SIZE
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_SIZE != size:
+            if _POOL is not None:
+                _POOL.close()
+            _POOL = multiprocessing.get_context('spawn').Pool(size)
+            _POOL_SIZE = size
+        return _POOL
+
+
+@atexit_register
+def _close_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.terminate()
+            _POOL.join()
+            _POOL = None
+
+
+def _pool_size(workers):
+    if workers is None:
+        workers = DOCUMENT_WORKERS
+    if workers <= 0:
+        workers = cpu_count() or 1
+    # Daemonic processes (e.g. pool workers) may not have children
+    if multiprocessing.current_process().daemon:
+        return 1
+    return workers
+
+
+def map_documents(function, documents, workers=None):
+    """Yields function(document) for each of the documents, in order.
+
+    The function must be defined at module level and it and its results
+    must be picklable, so return only what the caller needs; it is called
+    in worker processes unless there are too few documents or workers (see
+    DOCUMENT_WORKERS) to bother.
+    """
+    documents = list(documents)
+    pool_size = _pool_size(workers)
+    workers = max(1, min(pool_size,
+                         len(documents) // MIN_DOCUMENTS_PER_WORKER))
+
+    if workers == 1:
+        for document in documents:
+            yield function(document)
+        return
+
+    chunksize = max(1, len(documents) // (workers * 4))
+    for result, messages in _pool(pool_size).imap(
+            _call, ((function, d) for d in documents), chunksize):
+        for msg, type, duration in messages:
+            _MESSAGE_FUNCTIONS.get(type, Messager.info)(
+                msg, duration, escaped=True)
+        yield result
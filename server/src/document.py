@@ -13,34 +13,75 @@ Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
 Version:    2011-04-21
 """
 
+from collections import OrderedDict
 from errno import EACCES, ENOENT
+from hashlib import sha1
 from itertools import chain
-from os import listdir
+from logging import info as log_info
+from os import fdopen, listdir, makedirs, remove, replace
 from os.path import join as path_join
 from os.path import abspath, dirname, getmtime, isabs, isdir, normpath
+from tempfile import mkstemp
+from threading import Lock
 
 from config import BASE_DIR, DATA_DIR
 
+from anncache import cached_annotations, document_signature
 from annlog import annotation_logging_active
 from annotation import (BIONLP_ST_2013_COMPATIBILITY, JOINED_ANN_FILE_SUFF,
                         TEXT_FILE_SUFFIX, AnnotationCollectionNotFoundError,
-                        AnnotationFileNotFoundError, TextAnnotations,
-                        open_textfile)
+                        AnnotationFileNotFoundError, open_textfile)
 from auth import AccessDeniedError, allowed_to_read
 from common import CollectionNotAccessibleError, ProtocolError
+from jsonwrap import RawJSON, dumps, loads
 from message import Messager
+from offsetcache import (SSPLITTERS, TOKENISERS, sentence_offsets,
+                         token_offsets)
 from projectconfig import (ARC_DRAWING_ATTRIBUTES, ATTR_DRAWING_ATTRIBUTES,
+                           CONFIG_CACHE_SIZE, CONFIG_SNAPSHOT_DIR,
                            SEPARATOR_STR, SPAN_DRAWING_ATTRIBUTES,
                            SPECIAL_RELATION_TYPES, VISUAL_ARC_DEFAULT,
                            VISUAL_ATTR_DEFAULT, VISUAL_SPAN_DEFAULT,
                            ProjectConfiguration,
                            get_annotation_config_section_labels,
+                           get_configuration_version,
                            options_get_ssplitter, options_get_tokenization,
                            options_get_validation,
                            visual_options_get_arc_bundle,
                            visual_options_get_text_direction)
+from ssplit import merge_spanned_sentences
 from stats import get_statistics
 
+# Members of getCollectionInformation and getConfiguration responses that
+# only depend on the configuration of the collection
+TYPE_CONFIGURATION_KEYS = (
+    'event_types',
+    'entity_types',
+    'relation_types',
+    'event_attribute_types',
+    'relation_attribute_types',
+    'entity_attribute_types',
+    'unconfigured_types',
+    'ui_names',
+    'visual_options',
+)
+# Named after the configuration snapshot so that they are removed together
+TYPE_CONFIGURATION_SUFFIX = '.types.json'
+
+# (etag, members, messages) by configuration version, see
+# get_type_configuration()
+_TYPE_CONFIGURATIONS = OrderedDict()
+_TYPE_CONFIGURATIONS_LOCK = Lock()
+
+# Maximum number of serialised documents to keep in memory (disabled if <= 0)
+try:
+    from config import DOCUMENT_JSON_CACHE_SIZE
+except ImportError:
+    DOCUMENT_JSON_CACHE_SIZE = 32
+
+# (version, members, messages) by document path, see get_document()
+_DOCUMENT_JSONS = OrderedDict()
+_DOCUMENT_JSONS_LOCK = Lock()
 
 def _fill_type_configuration(
         nodes,
@@ -503,7 +544,7 @@ class InvalidConfiguration(ProtocolError):
 
 
 # TODO: Is this what we would call the configuration? It is minimal.
-def get_configuration(name):
+def get_configuration(name, type_configuration_etag=None):
     # TODO: Rip out this path somewhere
     config_dir = path_join(BASE_DIR, 'configurations')
     for conf_name in listdir(config_dir):
@@ -513,18 +554,17 @@ def get_configuration(name):
     else:
         raise InvalidConfiguration
 
-    return _inject_annotation_type_conf(config_path)
+    return _inject_annotation_type_conf(
+        config_path, type_configuration_etag=type_configuration_etag)
 
 
-def _inject_annotation_type_conf(dir_path, json_dic=None):
-    if json_dic is None:
-        json_dic = {}
-
+def _build_type_configuration(dir_path):
     (event_types, entity_types, rel_types,
      unconf_types) = get_base_types(dir_path)
     (entity_attr_types, rel_attr_types,
      event_attr_types) = get_attribute_types(dir_path)
 
+    json_dic = {}
     json_dic['event_types'] = event_types
     json_dic['entity_types'] = entity_types
     json_dic['relation_types'] = rel_types
@@ -549,18 +589,123 @@ def _inject_annotation_type_conf(dir_path, json_dic=None):
 
     return json_dic
 
+
+def _type_configuration_path(version):
+    return path_join(CONFIG_SNAPSHOT_DIR, version + TYPE_CONFIGURATION_SUFFIX)
+
+
+def _load_type_configuration(version):
+    try:
+        with open(_type_configuration_path(version), 'r',
+                  encoding='utf-8') as stored_file:
+            stored = loads(stored_file.read())
+        return (stored['etag'], dict((k, RawJSON(stored['members'][k]))
+                                     for k in TYPE_CONFIGURATION_KEYS),
+                [tuple(m) for m in stored['messages']])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _store_type_configuration(version, etag, members, messages):
+    tmp_file_path = None
+    try:
+        makedirs(CONFIG_SNAPSHOT_DIR, exist_ok=True)
+        tmp_file_fh, tmp_file_path = mkstemp(dir=CONFIG_SNAPSHOT_DIR,
+                                             prefix='.', suffix='.tmp')
+        with fdopen(tmp_file_fh, 'w', encoding='utf-8') as tmp_file:
+            tmp_file.write(dumps({'etag': etag, 'members': members,
+                                  'messages': messages}))
+        replace(tmp_file_path, _type_configuration_path(version))
+        tmp_file_path = None
+    except (IOError, OSError) as e:
+        log_info('Failed to store type configuration %s: %s' % (version, e))
+    finally:
+        if tmp_file_path is not None:
+            try:
+                remove(tmp_file_path)
+            except OSError:
+                pass
+
+
+def get_type_configuration(dir_path):
+    """Returns the entity, event, relation and attribute type configuration
+    of the given directory as an (etag, members, messages) triple, where
+    members maps each of TYPE_CONFIGURATION_KEYS to its serialised value,
+    the etag changes whenever any of them does and messages are those given
+    in building it.
+
+    The result is computed once per version of the configuration files and
+    kept in memory and, if possible, on disk next to the configuration
+    snapshot (see projectconfig). The messages are given again whenever it
+    is reused.
+    """
+    version = get_configuration_version(dir_path)
+    if version is not None:
+        with _TYPE_CONFIGURATIONS_LOCK:
+            cached = _TYPE_CONFIGURATIONS.get(version)
+            if cached is not None:
+                _TYPE_CONFIGURATIONS.move_to_end(version)
+        if cached is not None:
+            Messager.add_messages(cached[2])
+            return cached
+
+    cached = None
+    if version is not None and CONFIG_SNAPSHOT_DIR is not None:
+        cached = _load_type_configuration(version)
+        if cached is not None:
+            Messager.add_messages(cached[2])
+    if cached is None:
+        mark = Messager.mark()
+        type_conf = _build_type_configuration(dir_path)
+        members = [(k, dumps(type_conf[k])) for k in TYPE_CONFIGURATION_KEYS]
+        etag = sha1(dumps(members).encode('utf-8')).hexdigest()
+        messages = Messager.messages_since(mark)
+        cached = (etag, dict((k, RawJSON(v)) for k, v in members), messages)
+        # The files may have changed while we were at it
+        if version != get_configuration_version(dir_path):
+            return cached
+        if version is not None and CONFIG_SNAPSHOT_DIR is not None:
+            _store_type_configuration(version, etag, dict(members), messages)
+
+    if version is not None:
+        with _TYPE_CONFIGURATIONS_LOCK:
+            _TYPE_CONFIGURATIONS[version] = cached
+            _TYPE_CONFIGURATIONS.move_to_end(version)
+            while len(_TYPE_CONFIGURATIONS) > CONFIG_CACHE_SIZE:
+                _TYPE_CONFIGURATIONS.popitem(last=False)
+    return cached
+
+
+def _inject_annotation_type_conf(dir_path, json_dic=None,
+                                 type_configuration_etag=None):
+    if json_dic is None:
+        json_dic = {}
+
+    etag, members, messages = get_type_configuration(dir_path)
+    # Clients holding a copy of the current type configuration don't need
+    # another one, unless it comes with messages (given again in any case)
+    if type_configuration_etag == etag and not messages:
+        json_dic['type_configuration_unchanged'] = True
+    else:
+        json_dic.update(members)
+    json_dic['type_configuration_etag'] = etag
+
+    return json_dic
+
 # TODO: This is not the prettiest of functions
 
 
-def get_directory_information(collection):
+def get_directory_information(collection, type_configuration_etag=None):
     directory = collection
 
     real_dir = real_directory(directory)
 
     assert_allowed_to_read(real_dir)
 
+    file_names = _listdir(real_dir)
+
     # Get the document names
-    base_names = [fn[0:-4] for fn in _listdir(real_dir)
+    base_names = [fn[0:-4] for fn in file_names
                   if fn.endswith('txt')]
 
     doclist = base_names[:]
@@ -584,7 +729,7 @@ def get_directory_information(collection):
     doclist = [doclist[i] + doc_stats[i] for i in range(len(doclist))]
     doclist_header += stats_types
 
-    dirlist = [dir for dir in _listdir(real_dir)
+    dirlist = [dir for dir in file_names
                if isdir(path_join(real_dir, dir))]
     # just in case, and for generality
     dirlist = [[dir] for dir in dirlist]
@@ -643,7 +788,7 @@ def get_directory_information(collection):
         'normalization_config': normalization_config,
         'annotation_logging': ann_logging,
         'ner_taggers': ner_taggers,
-    })
+    }, type_configuration_etag=type_configuration_etag)
 
 
 class UnableToReadTextFile(ProtocolError):
@@ -691,42 +836,76 @@ def _enrich_json_with_text(j_dic, txt_file_path, raw_text=None):
     j_dic['text'] = text
 
 
+    # Tokenisation and sentence splitting are cached for collection texts
     tokeniser = options_get_tokenization(dirname(txt_file_path))
-
-    # First, generate tokenisation
-    if tokeniser == 'mecab':
-        from tokenise import jp_token_boundary_gen
-        tok_offset_gen = jp_token_boundary_gen
-    elif tokeniser == 'whitespace':
-        from tokenise import whitespace_token_boundary_gen
-        tok_offset_gen = whitespace_token_boundary_gen
-    elif tokeniser == 'ptblike':
-        from tokenise import gtb_token_boundary_gen
-        tok_offset_gen = gtb_token_boundary_gen
-    else:
+    if tokeniser not in TOKENISERS:
         Messager.warning('Unrecognized tokenisation option '
                          ', reverting to whitespace tokenisation.')
-        from tokenise import whitespace_token_boundary_gen
-        tok_offset_gen = whitespace_token_boundary_gen
-    j_dic['token_offsets'] = [o for o in tok_offset_gen(text)]
+        tokeniser = 'whitespace'
+    j_dic['token_offsets'] = token_offsets(text, tokeniser,
+                                           txt_file_path)
 
     ssplitter = options_get_ssplitter(dirname(txt_file_path))
-    if ssplitter == 'newline':
-        from ssplit import newline_sentence_boundary_gen
-        ss_offset_gen = newline_sentence_boundary_gen
-    elif ssplitter == 'regex':
-        from ssplit import regex_sentence_boundary_gen
-        ss_offset_gen = regex_sentence_boundary_gen
-    else:
+    if ssplitter not in SSPLITTERS:
         Messager.warning('Unrecognized sentence splitting option '
                          ', reverting to newline sentence splitting.')
-        from ssplit import newline_sentence_boundary_gen
-        ss_offset_gen = newline_sentence_boundary_gen
-    j_dic['sentence_offsets'] = [o for o in ss_offset_gen(text)]
+        ssplitter = 'newline'
+    j_dic['sentence_offsets'] = sentence_offsets(
+        text, ssplitter, txt_file_path)
 
     return True
 
 
+def _event_json(event_ann):
+    return [str(event_ann.id), str(event_ann.trigger), event_ann.args]
+
+
+def _relation_json(rel_ann):
+    return [str(rel_ann.id), str(rel_ann.type),
+            [(rel_ann.arg1l, rel_ann.arg1),
+             (rel_ann.arg2l, rel_ann.arg2)]]
+
+
+def _textbound_json(tb_ann, trigger_ids, ann_obj):
+    # Returns the (key, data) pairs for a textbound given the ids of the
+    # event triggers in ann_obj
+    #j_tb = [str(tb_ann.id), tb_ann.type, tb_ann.start, tb_ann.end]
+    j_tb = [str(tb_ann.id), tb_ann.type, tb_ann.spans]
+
+    # If we spotted it as a trigger for an event or if the type is known
+    # to be an event type, we add it as a json trigger.
+    # TODO: proper handling of disconnected triggers. Currently
+    # these will be erroneously passed as 'entities'
+    if str(tb_ann.id) not in trigger_ids:
+        return [('entities', j_tb)]
+    # special case for BioNLP ST 2013 format: send triggers
+    # also as entities for those triggers that are referenced
+    # from annotations other than events (#926).
+    if (BIONLP_ST_2013_COMPATIBILITY and
+            tb_ann.id in ann_obj.externally_referenced_triggers):
+        return [('triggers', j_tb), ('entities', j_tb)]
+    return [('triggers', j_tb)]
+
+
+def _equiv_json(eq_ann):
+    return ['*', eq_ann.type] + [e for e in eq_ann.entities]
+
+
+def _attribute_json(att_ann):
+    return [str(att_ann.id), str(att_ann.type), str(att_ann.target),
+            att_ann.value]
+
+
+def _normalization_json(norm_ann):
+    return [str(norm_ann.id), str(norm_ann.type),
+            str(norm_ann.target), str(norm_ann.refdb),
+            str(norm_ann.refid), str(norm_ann.reftext)]
+
+
+def _comment_json(com_ann):
+    return [com_ann.target, str(com_ann.type), com_ann.tail.strip()]
+
+
 def _enrich_json_with_data(j_dic, ann_obj):
     # TODO: figure out if there's a reason for all the str()
     # invocations here; remove if not.
@@ -735,67 +914,26 @@ def _enrich_json_with_data(j_dic, ann_obj):
     trigger_ids = set()
     for event_ann in ann_obj.get_events():
         trigger_ids.add(event_ann.trigger)
-        j_dic['events'].append(
-            [str(event_ann.id), str(event_ann.trigger), event_ann.args]
-        )
+        j_dic['events'].append(_event_json(event_ann))
 
     for rel_ann in ann_obj.get_relations():
-        j_dic['relations'].append(
-            [str(rel_ann.id), str(rel_ann.type),
-             [(rel_ann.arg1l, rel_ann.arg1),
-              (rel_ann.arg2l, rel_ann.arg2)]]
-        )
+        j_dic['relations'].append(_relation_json(rel_ann))
 
     for tb_ann in ann_obj.get_textbounds():
-        #j_tb = [str(tb_ann.id), tb_ann.type, tb_ann.start, tb_ann.end]
-        j_tb = [str(tb_ann.id), tb_ann.type, tb_ann.spans]
-
-        # If we spotted it in the previous pass as a trigger for an
-        # event or if the type is known to be an event type, we add it
-        # as a json trigger.
-        # TODO: proper handling of disconnected triggers. Currently
-        # these will be erroneously passed as 'entities'
-        if str(tb_ann.id) in trigger_ids:
-            j_dic['triggers'].append(j_tb)
-            # special case for BioNLP ST 2013 format: send triggers
-            # also as entities for those triggers that are referenced
-            # from annotations other than events (#926).
-            if BIONLP_ST_2013_COMPATIBILITY:
-                if tb_ann.id in ann_obj.externally_referenced_triggers:
-                    try:
-                        j_dic['entities'].append(j_tb)
-                    except KeyError:
-                        j_dic['entities'] = [j_tb, ]
-        else:
-            try:
-                j_dic['entities'].append(j_tb)
-            except KeyError:
-                j_dic['entities'] = [j_tb, ]
+        for key, j_tb in _textbound_json(tb_ann, trigger_ids, ann_obj):
+            j_dic[key].append(j_tb)
 
     for eq_ann in ann_obj.get_equivs():
-        j_dic['equivs'].append(
-            (['*', eq_ann.type]
-             + [e for e in eq_ann.entities])
-        )
+        j_dic['equivs'].append(_equiv_json(eq_ann))
 
     for att_ann in ann_obj.get_attributes():
-        j_dic['attributes'].append([str(att_ann.id), str(
-            att_ann.type), str(att_ann.target), att_ann.value])
+        j_dic['attributes'].append(_attribute_json(att_ann))
 
     for norm_ann in ann_obj.get_normalizations():
-        j_dic['normalizations'].append(
-            [str(norm_ann.id), str(norm_ann.type),
-             str(norm_ann.target), str(norm_ann.refdb),
-             str(norm_ann.refid), str(norm_ann.reftext)]
-        )
+        j_dic['normalizations'].append(_normalization_json(norm_ann))
 
     for com_ann in ann_obj.get_oneline_comments():
-        comment = [com_ann.target, str(com_ann.type),
-                   com_ann.tail.strip()]
-        try:
-            j_dic['comments'].append(comment)
-        except KeyError:
-            j_dic['comments'] = [comment, ]
+        j_dic['comments'].append(_comment_json(com_ann))
 
     if ann_obj.failed_lines:
         error_msg = 'Unable to parse the following line(s):\n%s' % (
@@ -865,8 +1003,9 @@ def _enrich_json_with_base(j_dic):
         j_dic[d] = []
 
 
-def _document_json_dict(document):
-    # TODO: DOC!
+def _build_document_json_dict(document):
+    # Returns the document data and whether it may be reused for as long
+    # as the version of the document stays the same
 
     # pointing at directory instead of document?
     if isdir(document):
@@ -879,43 +1018,99 @@ def _document_json_dict(document):
     # Read in the textual data to make it ready to push
     _enrich_json_with_text(j_dic, document + '.' + TEXT_FILE_SUFFIX)
 
-    with TextAnnotations(document) as ann_obj:
+    with cached_annotations(document, read_only=True) as ann_obj:
         # Note: At this stage the sentence offsets can conflict with the
         #   annotations, we thus merge any sentence offsets that lie within
         #   annotations
-        # XXX: ~O(tb_ann * sentence_breaks), can be optimised
         # XXX: The merge strategy can lead to unforeseen consequences if two
         #   sentences are not adjacent (the format allows for this:
         #   S_1: [0, 10], S_2: [15, 20])
-        s_breaks = j_dic['sentence_offsets']
-        for tb_ann in ann_obj.get_textbounds():
-            s_i = 0
-            while s_i < len(s_breaks):
-                s_start, s_end = s_breaks[s_i]
-                # Does any subspan of the annotation strech over the
-                # end of the sentence?
-                found_spanning = False
-                for tb_start, tb_end in tb_ann.spans:
-                    if tb_start < s_end and tb_end > s_end:
-                        found_spanning = True
-                        break
-                if found_spanning:
-                    # Merge this sentence and the next sentence
-                    s_breaks[s_i] = (s_start, s_breaks[s_i + 1][1])
-                    del s_breaks[s_i + 1]
-                else:
-                    s_i += 1
+        j_dic['sentence_offsets'] = merge_spanned_sentences(
+            j_dic['sentence_offsets'],
+            (span for tb_ann in ann_obj.get_textbounds()
+             for span in tb_ann.spans))
 
         _enrich_json_with_data(j_dic, ann_obj)
+        # Documents read from several files aren't covered by their version
+        # and those failing to parse report it on every request
+        reusable = (not ann_obj.failed_lines and
+                    ann_obj._input_files == [
+                        document + '.' + JOINED_ANN_FILE_SUFF])
 
-    return j_dic
+    return j_dic, reusable
 
 
-def get_document(collection, document):
+def _document_json_dict(document):
+    # TODO: DOC!
+    return _build_document_json_dict(document)[0]
+
+
+def _document_version(document):
+    """Returns a string that changes whenever the document data for the
+    given document (path without extension) would, or None if unknown."""
+    signature = document_signature(document)
+    if signature[0] is None:
+        # Not a document with a joined annotation file
+        return None
+    # Tokenisation, sentence splitting and validation are configured
+    configuration_version = get_configuration_version(dirname(document))
+    if configuration_version is None:
+        return None
+    return sha1(repr((signature, configuration_version)).encode(
+        'utf-8')).hexdigest()
+
+
+def get_document(collection, document, document_version=None):
+    """Returns the document data, or only that it is unchanged if the
+    client has the given document_version of it already.
+
+    The serialised data is kept in memory for the latest version of the
+    most recently requested documents (see DOCUMENT_JSON_CACHE_SIZE), with
+    the messages given in building it, which are given again on reuse.
+    Documents with messages get no version, so that the client always asks
+    for them in full.
+    """
     directory = collection
     real_dir = real_directory(directory)
     doc_path = path_join(real_dir, document)
-    return _document_json_dict(doc_path)
+
+    version = _document_version(doc_path)
+    if version is not None and version == document_version:
+        return {
+            'document_unchanged': True,
+            'document_version': version,
+        }
+
+    members = None
+    if version is not None and DOCUMENT_JSON_CACHE_SIZE > 0:
+        with _DOCUMENT_JSONS_LOCK:
+            cached = _DOCUMENT_JSONS.get(doc_path)
+            if cached is not None and cached[0] == version:
+                _DOCUMENT_JSONS.move_to_end(doc_path)
+                _, members, messages = cached
+        if members is not None:
+            Messager.add_messages(messages)
+
+    if members is None:
+        mark = Messager.mark()
+        j_dic, reusable = _build_document_json_dict(doc_path)
+        if version is None or not reusable:
+            return j_dic
+        messages = Messager.messages_since(mark)
+        members = dict((k, RawJSON(dumps(v))) for k, v in j_dic.items())
+        # The files may have changed while we were at it
+        if (DOCUMENT_JSON_CACHE_SIZE > 0 and
+                version == _document_version(doc_path)):
+            with _DOCUMENT_JSONS_LOCK:
+                _DOCUMENT_JSONS[doc_path] = (version, members, messages)
+                _DOCUMENT_JSONS.move_to_end(doc_path)
+                while len(_DOCUMENT_JSONS) > DOCUMENT_JSON_CACHE_SIZE:
+                    _DOCUMENT_JSONS.popitem(last=False)
+
+    json_dic = dict(members)
+    if not messages:
+        json_dic['document_version'] = version
+    return json_dic
 
 
 def get_document_timestamp(collection, document):
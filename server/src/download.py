@@ -6,14 +6,17 @@ Version:    2011-10-03
 
 
 
+from asyncio import create_subprocess_exec
 from os import close as os_close
-from os import remove
+from os import remove, walk
 from os.path import join as path_join
 from os.path import basename, dirname, normpath
 from subprocess import Popen
 from tempfile import mkstemp
 
-from annotation import open_textfile
+from anncache import ANNOTATION_CACHE
+from annotation import JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF, open_textfile
+from asyncsupport import run_blocking
 from common import NoPrintJSONError
 from document import real_directory
 
@@ -55,7 +58,22 @@ def find_in_directory_tree(directory, filename):
     return (None, None)
 
 
-def download_collection(collection, include_conf=False):
+def compact_journals(directory):
+    # Annotation files are only complete on their own once their journals
+    # have been merged into them, which a download thus writes to the
+    # collection (see ANNOTATION_JOURNAL in the configuration)
+    journal_suff = '.%s.%s' % (JOINED_ANN_FILE_SUFF, JOURNAL_FILE_SUFF)
+    for dirpath, _, filenames in walk(directory):
+        for filename in filenames:
+            if filename.endswith(journal_suff):
+                ANNOTATION_CACHE.compact_journal(
+                    path_join(dirpath, filename[:-len(journal_suff)]))
+
+
+def _collection_archive(collection, include_conf, tmp_file_path):
+    """Returns the tar command line (and the directory to run it in) that
+    archives the given collection into tmp_file_path and the headers for
+    sending the archive."""
     directory = collection
     real_dir = real_directory(directory)
     dir_name = basename(dirname(real_dir))
@@ -69,41 +87,75 @@ def download_collection(collection, include_conf=False):
     except ValueError:
         pass
 
+    tar_cmd_split = ['tar', '--exclude=.stats_cache',
+                     '--exclude=*.%s' % JOURNAL_FILE_SUFF]
+    conf_names = []
+    if not include_conf:
+        tar_cmd_split.extend(['--exclude=%s' % c for c in confs])
+    else:
+        # also include configs from parent directories.
+        for cname in confs:
+            cdir, depth = find_in_directory_tree(real_dir, cname)
+            if depth is not None and depth > 0:
+                relpath = path_join(
+                    dir_name, *['..' for _ in range(depth)])
+                conf_names.append(path_join(relpath, cname))
+        if conf_names:
+            # replace pathname components ending in ".." with target
+            # directory name so that .confs in parent directories appear
+            # in the target directory in the tar.
+            tar_cmd_split.extend(['--absolute-names', '--transform',
+                                  's|.*\\.\\.|%s|' % dir_name])
+
+    tar_cmd_split.extend(['-c', '-z', '-f', tmp_file_path, dir_name])
+    tar_cmd_split.extend(conf_names)
+
+    hdrs = [('Content-Type', 'application/octet-stream'),  # 'application/x-tgz'),
+            ('Content-Disposition', 'inline; filename=%s' % fname)]
+    return tar_cmd_split, path_join(real_dir, '..'), hdrs
+
+
+def _read_archive(tmp_file_path):
+    with open(tmp_file_path, 'rb') as tmp_file:
+        return tmp_file.read()
+
+
+def download_collection(collection, include_conf=False):
     tmp_file_path = None
     try:
         tmp_file_fh, tmp_file_path = mkstemp()
         os_close(tmp_file_fh)
 
-        tar_cmd_split = ['tar', '--exclude=.stats_cache']
-        conf_names = []
-        if not include_conf:
-            tar_cmd_split.extend(['--exclude=%s' % c for c in confs])
-        else:
-            # also include configs from parent directories.
-            for cname in confs:
-                cdir, depth = find_in_directory_tree(real_dir, cname)
-                if depth is not None and depth > 0:
-                    relpath = path_join(
-                        dir_name, *['..' for _ in range(depth)])
-                    conf_names.append(path_join(relpath, cname))
-            if conf_names:
-                # replace pathname components ending in ".." with target
-                # directory name so that .confs in parent directories appear
-                # in the target directory in the tar.
-                tar_cmd_split.extend(['--absolute-names', '--transform',
-                                      's|.*\\.\\.|%s|' % dir_name])
-
-        tar_cmd_split.extend(['-c', '-z', '-f', tmp_file_path, dir_name])
-        tar_cmd_split.extend(conf_names)
-        tar_p = Popen(tar_cmd_split, cwd=path_join(real_dir, '..'))
+        compact_journals(real_directory(collection))
+
+        tar_cmd_split, tar_cwd, hdrs = _collection_archive(
+            collection, include_conf, tmp_file_path)
+        tar_p = Popen(tar_cmd_split, cwd=tar_cwd)
         tar_p.wait()
 
-        hdrs = [('Content-Type', 'application/octet-stream'),  # 'application/x-tgz'),
-                ('Content-Disposition', 'inline; filename=%s' % fname)]
-        with open(tmp_file_path, 'rb') as tmp_file:
-            tar_data = tmp_file.read()
+        raise NoPrintJSONError(hdrs, _read_archive(tmp_file_path))
+    finally:
+        if tmp_file_path is not None:
+            remove(tmp_file_path)
+
+
+async def download_collection_async(collection, include_conf=False):
+    """Coroutine version of download_collection(), which waits for tar
+    without blocking the event loop."""
+    tmp_file_path = None
+    try:
+        tmp_file_fh, tmp_file_path = mkstemp()
+        os_close(tmp_file_fh)
+
+        await run_blocking(compact_journals, real_directory(collection))
+
+        tar_cmd_split, tar_cwd, hdrs = _collection_archive(
+            collection, include_conf, tmp_file_path)
+        tar_p = await create_subprocess_exec(*tar_cmd_split, cwd=tar_cwd)
+        await tar_p.wait()
 
-        raise NoPrintJSONError(hdrs, tar_data)
+        raise NoPrintJSONError(hdrs,
+                               await run_blocking(_read_archive, tmp_file_path))
     finally:
         if tmp_file_path is not None:
             remove(tmp_file_path)
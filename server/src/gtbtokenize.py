@@ -19,6 +19,7 @@
 
 
 import re
+from bisect import bisect_left
 
 INPUT_ENCODING = "UTF-8"
 OUTPUT_ENCODING = "UTF-8"
@@ -78,9 +79,12 @@ __initial.append((re.compile(r'\?'), ' ? '))
 __initial.append((re.compile(r'\!'), ' ! '))
 
 # separate greater than and less than signs, avoiding breaking
-# "arrows" (e.g. "-->", ">>") and compound operators (e.g. "</=")
-__initial.append((re.compile(r'((?:=\/)?<+(?:\/=|--+>?)?)'), r' \1 '))
-__initial.append((re.compile(r'((?:<?--+|=\/)?>+(?:\/=)?)'), r' \1 '))
+# "arrows" (e.g. "-->", ">>") and compound operators (e.g. "</=").
+# (The lookaheads only spare the regex engine from trying each position.)
+__initial.append((re.compile(r'(?=[=<])((?:=\/)?<+(?:\/=|--+>?)?)'),
+                  r' \1 '))
+__initial.append((re.compile(r'(?=[-<=>])((?:<?--+|=\/)?>+(?:\/=)?)'),
+                  r' \1 '))
 
 # separate dashes, not breaking up "arrows"
 __initial.append((re.compile(r'(<?--+\>?)'), r' \1 '))
@@ -185,6 +189,23 @@ __final.append((re.compile(r' wanna '), ' wan na '))
 __final.append((re.compile(r'  +'), r' '))
 
 
+# Characters of which every match of a rule has one (None for rules that
+# are always run), to skip the rules that can't match. Of the characters
+# in the escapes put in for brackets, only "-" is among these, and no rule
+# after those needs it.
+__TRIGGERS = '.,;:@#$%&?!<>-()[]{}\'"'
+
+
+def __triggers(rules):
+    return [frozenset(r.pattern).intersection(__TRIGGERS) or None
+            for r, t in rules]
+
+
+__initial_triggers = __triggers(__initial)
+__repeated_triggers = __triggers(__repeated)
+__final_triggers = __triggers(__final)
+
+
 def _tokenize(s):
     """Tokenizer core.
 
@@ -193,19 +214,26 @@ def _tokenize(s):
     You probably want to use tokenize() instead of this function.
     """
 
+    present = frozenset(s)
+
     # see re.complies for comments
-    for r, t in __initial:
-        s = r.sub(t, s)
+    for (r, t), triggers in zip(__initial, __initial_triggers):
+        if triggers is None or not present.isdisjoint(triggers):
+            s = r.sub(t, s)
 
-    while True:
+    repeated = [(r, t) for (r, t), triggers
+                in zip(__repeated, __repeated_triggers)
+                if triggers is None or not present.isdisjoint(triggers)]
+    while repeated:
         o = s
-        for r, t in __repeated:
+        for r, t in repeated:
             s = r.sub(t, s)
         if o == s:
             break
 
-    for r, t in __final:
-        s = r.sub(t, s)
+    for (r, t), triggers in zip(__final, __final_triggers):
+        if triggers is None or not present.isdisjoint(triggers):
+            s = r.sub(t, s)
 
     return s
 
@@ -308,6 +336,113 @@ def tokenize(s, ptb_escaping=False, use_single_quotes_only=False,
     return s + s_end
 
 
+# Offsets of tokens without rewriting the whole text: as the rules only
+# insert space, they act within the stretches of text between spaces
+# ("chunks"), which tokenize() would split at anyway. Chunks that no rule
+# touches are tokens as they are (if not split at other whitespace), and
+# the others are tokenized together, once per distinct chunk, kept apart
+# by a separator that no rule matches. Two kinds of rules see past a
+# chunk: the one for sentence-final periods, anchored to the end of the
+# text, and the words that need space on both sides, of which a match uses
+# up the space before the same word in the next chunk. The chunk ending
+# the text is thus tokenized at the end, and chunks that may share a word
+# in this way are tokenized as one.
+
+__WORDS = [r.pattern.strip().replace('\\', '') for r, t in __final
+           if r.pattern.startswith(' ') and r.pattern.endswith(' ') and
+           r.pattern.strip()]
+# Chunks that some rule may match
+__CHUNK_RE = re.compile(r'(?<![^ ])(?:[^ %s]*[%s][^ ]*|(?:%s)(?![^ ]))' % (
+    re.escape(__TRIGGERS), re.escape(__TRIGGERS),
+    '|'.join(map(re.escape, __WORDS))))
+__WORD_END_RE = re.compile(r'(?:%s)\Z' % '|'.join(map(re.escape, __WORDS)))
+__WORD_LENGTH = max(len(w) for w in __WORDS)
+__TOKEN_RE = re.compile(r'\S+')
+__QUOTE_RE = re.compile(r'([ \(\[\{\<])\"')
+__SEPARATOR = '\0'
+
+
+def _chunk_token_offsets(chunks, tokenized):
+    # Offsets of the tokens in each chunk, tokenized together
+    for chunk, token_str in zip(chunks, tokenized.split(__SEPARATOR)):
+        offsets, pos = [], 0
+        for token in token_str.split():
+            start = chunk.index(token, pos)
+            pos = start + len(token)
+            offsets.append((start, pos))
+        yield offsets
+
+
+def token_offsets(text):
+    """Returns the (start, end) offsets of the tokens in the given text,
+    the same as those of the tokens of tokenize(text) in the text."""
+
+    if __SEPARATOR in text:
+        offsets, pos = [], 0
+        for token in tokenize(text).split():
+            start = text.index(token, pos)
+            pos = start + len(token)
+            offsets.append((start, pos))
+        return offsets
+
+    # As in tokenize(), ignoring space and newlines at the end. If there
+    # are newlines before that space, tokenize() puts space before the
+    # last one as well, which thus ends the text.
+    end = len(text.rstrip('\n').rstrip(' '))
+    last_end = end
+    if text[end - 1:end] == '\n':
+        end -= 1
+        last_end = None
+
+    # Offsets of the text split at whitespace, and for the chunks to
+    # tokenize, the range of those they replace
+    spans = [m.span() for m in __TOKEN_RE.finditer(text, 0, end)]
+    starts = [start for start, _ in spans]
+    chunks = []
+    for m in __CHUNK_RE.finditer(text, 0, end):
+        start, chunk_end = m.span()
+        if chunks and chunks[-1][3] == start - 1:
+            i, _, chunk_start, _, chunk = chunks[-1]
+            word = __WORD_END_RE.search(chunk[-__WORD_LENGTH:])
+            if word is not None and text.startswith(word.group(), start):
+                chunks[-1] = (i, bisect_left(starts, chunk_end, i),
+                              chunk_start, chunk_end,
+                              text[chunk_start:chunk_end])
+                continue
+        i = bisect_left(starts, start)
+        chunks.append((i, bisect_left(starts, chunk_end, i), start,
+                       chunk_end, m.group()))
+
+    if not chunks:
+        return spans
+
+    # Distinct chunks, and the last one again if it ends the text
+    distinct = list(dict.fromkeys(chunk for _, _, _, _, chunk in chunks))
+    if chunks[-1][3] == last_end:
+        batch = distinct + [chunks[-1][4]]
+        s = ' ' + (' %s ' % __SEPARATOR).join(batch) + ' '
+    else:
+        batch = distinct
+        s = ' ' + (' %s ' % __SEPARATOR).join(batch) + ' %s ' % __SEPARATOR
+    s = __QUOTE_RE.sub(r'\1 " ', s)
+    s = PTB_unescape(_tokenize(s).replace('"', ' " '))
+    batch_offsets = list(_chunk_token_offsets(batch, s))
+    chunk_offsets = dict(zip(distinct, batch_offsets))
+
+    offsets, j = [], 0
+    for i, next_j, start, chunk_end, chunk in chunks:
+        offsets.extend(spans[j:i])
+        if chunk_end == last_end:
+            tokens = batch_offsets[-1]
+        else:
+            tokens = chunk_offsets[chunk]
+        offsets.extend((start + token_start, start + token_end)
+                       for token_start, token_end in tokens)
+        j = next_j
+    offsets.extend(spans[j:])
+    return offsets
+
+
 def __argparser():
     import argparse
 
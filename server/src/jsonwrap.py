@@ -19,10 +19,27 @@ except ImportError:
 # encoding
 
 
+class RawJSON(str):
+    """An already serialised JSON value, spliced in as is by dumps() where
+    it is the value of a member of the top-level object."""
+    pass
+
+
 def dumps(dic):
-    # ultrajson has neither sort_keys nor indent
-    #     return lib_dumps(dic, sort_keys=True, indent=2)
-    return lib_dumps(dic)
+    raw = None
+    if isinstance(dic, dict):
+        raw = [(k, v) for k, v in dic.items() if isinstance(v, RawJSON)]
+    if not raw:
+        # ultrajson has neither sort_keys nor indent
+        #     return lib_dumps(dic, sort_keys=True, indent=2)
+        return lib_dumps(dic)
+
+    rest = lib_dumps(dict((k, v) for k, v in dic.items()
+                          if not isinstance(v, RawJSON)))
+    members = ','.join('%s:%s' % (lib_dumps(k), v) for k, v in raw)
+    if rest.strip() == '{}':
+        return '{' + members + '}'
+    return rest[:rest.rindex('}')] + ',' + members + '}'
 
 
 def loads(s):
@@ -4,12 +4,15 @@
 
 """Normalization support."""
 
+from collections import OrderedDict
 from datetime import datetime
 from functools import reduce
+from threading import Lock
 
 import normdb
 import sdistance
-from simstringdb import Simstring
+from simstringdb import Simstring, simstring_reader
+from asyncsupport import run_blocking
 from document import real_directory
 from message import Messager
 from normdb import string_norm_form
@@ -29,6 +32,9 @@ MAX_DIFF_TO_BEST_SCORE = 200
 # maximum number of search results to return
 MAX_SEARCH_RESULT_NUMBER = 1000
 
+# maximum number of alignment scores of (query, name) pairs to remember
+MAX_NORM_SCORE_CACHE_SIZE = 100000
+
 NORM_LOOKUP_DEBUG = True
 
 REPORT_LOOKUP_TIMINGS = False
@@ -253,21 +259,44 @@ def _norm_filter_score(score, best_score=MAX_SCORE):
 # TODO: get rid of arbitrary max_cost default constant
 
 
-def _norm_score(substring, name, max_cost=500):
-    # returns an integer score representing the similarity of the given
-    # substring to the given name (larger is better).
-    cache = _norm_score.__cache
-    if (substring, name) not in cache:
-        cost = sdistance.tsuruoka_local(substring, name, max_cost=max_cost)
-        # debugging
-        #Messager.info('%s --- %s: %d (max %d)' % (substring, name, cost, max_cost))
-        score = MAX_SCORE - cost
-        cache[(substring, name)] = score
-    # TODO: should we avoid exceeding max_cost? Cached values might.
-    return cache[(substring, name)]
-
-
-_norm_score.__cache = {}
+def _norm_scores(substring, names, max_cost=500):
+    # returns integer scores representing the similarity of the given
+    # substring to each of the given names (larger is better). Costs
+    # above max_cost are cut off at max_cost.
+    cache = _norm_scores.__cache
+    costs = {}
+    with _norm_scores.__lock:
+        for name in names:
+            cached = cache.get((substring, name))
+            if cached is None:
+                continue
+            cost, cut_off = cached
+            # a cost that was cut off is only known to be at least that
+            if not cut_off or cost >= max_cost:
+                cache.move_to_end((substring, name))
+                costs[name] = min(cost, max_cost)
+
+    missing = list(OrderedDict.fromkeys(n for n in names if n not in costs))
+    if missing:
+        # align with all at once
+        computed = sdistance.tsuruoka_local_batch(substring, missing,
+                                                  max_cost=max_cost)
+        with _norm_scores.__lock:
+            for name, cost in zip(missing, computed):
+                # debugging
+                #Messager.info('%s --- %s: %d (max %d)' % (substring, name, cost, max_cost))
+                costs[name] = cost
+                cache[(substring, name)] = (cost, cost >= max_cost)
+                cache.move_to_end((substring, name))
+            while len(cache) > MAX_NORM_SCORE_CACHE_SIZE:
+                cache.popitem(last=False)
+
+    return [MAX_SCORE - costs[name] for name in names]
+
+
+# least recently used first
+_norm_scores.__cache = OrderedDict()
+_norm_scores.__lock = Lock()
 
 
 def _norm_search_name_attr(ss, name, attr,
@@ -325,18 +354,29 @@ def _norm_search_name_attr(ss, name, attr,
     id_names = [(i, n) for i, n, s in id_name_scores]
 
     # update matches and scores
-    for i, n in id_names:
+    for idx, (i, n) in enumerate(id_names):
         if n not in matched:
             matched[n] = set()
         matched[n].add(i)
 
-        max_cost = MAX_SCORE - best_score + MAX_DIFF_TO_BEST_SCORE + 1
         if (name, n) not in score_by_str:
+            # score this and the following names not yet scored at once,
+            # as many as could possibly be needed for the results
+            max_cost = MAX_SCORE - best_score + MAX_DIFF_TO_BEST_SCORE + 1
+            batch = OrderedDict()
+            for _, n2 in id_names[idx:]:
+                if (name, n2) not in score_by_str:
+                    batch[n2] = True
+                    if len(batch) > MAX_SEARCH_RESULT_NUMBER:
+                        break
             # TODO: decide whether to use normalized or unnormalized strings
             # for scoring here.
-            #score_by_str[(name, n)] = _norm_score(name, n, max_cost)
-            score_by_str[(name, n)] = _norm_score(
-                string_norm_form(name), string_norm_form(n), max_cost)
+            #scores = _norm_scores(name, list(batch), max_cost)
+            scores = _norm_scores(
+                string_norm_form(name),
+                [string_norm_form(n2) for n2 in batch], max_cost)
+            for n2, score in zip(batch, scores):
+                score_by_str[(name, n2)] = score
         score = score_by_str[(name, n)]
         best_score = max(score, best_score)
 
@@ -371,7 +411,7 @@ def _norm_search_impl(database, name, collection=None, exactmatch=False):
     score_by_id = {}
     score_by_str = {}
 
-    with Simstring(dbpath, unicode=dbunicode) as ss:
+    with simstring_reader(dbpath, unicode=dbunicode) as ss:
 
         # look up hits where name appears in full
         best_score = _norm_search_name_attr(ss, name, None,
@@ -381,7 +421,7 @@ def _norm_search_impl(database, name, collection=None, exactmatch=False):
         # if there are no hits and we only have a simple candidate string,
         # look up with a low threshold
         if best_score == 0 and len(name.split()) == 1:
-            with Simstring(dbpath, threshold=0.5, unicode=dbunicode) as low_threshold_ss:
+            with simstring_reader(dbpath, threshold=0.5, unicode=dbunicode) as low_threshold_ss:
                 best_score = _norm_search_name_attr(low_threshold_ss, name, None,
                                                     matched, score_by_id, score_by_str,
                                                     0, exactmatch)
@@ -454,6 +494,14 @@ def norm_search(database, name, collection=None, exactmatch=False):
         }
 
 
+async def norm_search_async(database, name, collection=None,
+                            exactmatch=False):
+    """Coroutine version of norm_search(), which waits on simstring in the
+    executor rather than in the event loop."""
+    return await run_blocking(norm_search, database, name, collection,
+                              exactmatch)
+
+
 def _test():
     # test
     test_cases = {
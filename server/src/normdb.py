@@ -6,9 +6,13 @@
 
 import sqlite3 as sqlite
 import sys
+from contextlib import contextmanager
+from os import stat
 from os.path import join as path_join
 from os.path import sep as path_sep
 from os.path import exists
+from threading import Lock
+from urllib.request import pathname2url
 
 try:
     from config import BASE_DIR, WORK_DIR
@@ -31,8 +35,21 @@ NON_EMPTY_TABLES = set(["names"])
 # Maximum number of variables in one SQL query (TODO: get from lib!)
 MAX_SQL_VARIABLE_COUNT = 999
 
+# Maximum number of idle connections kept open per DB
+MAX_IDLE_CONNECTIONS = 4
+
+# Bytes of each DB to access through memory mapping
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Number of compiled statements kept per connection; the queries differ
+# only in the number of variables for the values looked up
+CACHED_STATEMENTS = 256
+
 __query_count = {}
 
+__connection_pools = {}
+__connection_pools_lock = Lock()
+
 
 class dbNotFoundError(Exception):
     def __init__(self, fn):
@@ -84,17 +101,92 @@ def __increment_query_count(dbname):
     __query_count[dbname] = __query_count.get(dbname, 0) + 1
 
 
-def _get_connection_cursor(dbname):
-    # helper for DB access functions
+class _ConnectionPool(object):
+    """Read-only connections to a DB file, kept open for reuse by later
+    lookups in the same process."""
+
+    def __init__(self, dbfn, signature):
+        self.signature = signature
+        uri = 'file:%s?mode=ro' % pathname2url(dbfn)
+        # DBs are created once by tools/norm_db_init.py and only read
+        # from here on; sqlite can then skip locking and change checks.
+        # (A rebuilt DB changes the signature and gets a pool of its own.)
+        if not any(exists(dbfn + s) for s in ('-journal', '-wal')):
+            uri += '&immutable=1'
+        self.uri = uri
+        self._idle = []
+        self._closed = False
+        self._lock = Lock()
+
+    def _connect(self):
+        # Connections move between threads, but only one uses each at a time
+        connection = sqlite.connect(self.uri, uri=True,
+                                    check_same_thread=False,
+                                    cached_statements=CACHED_STATEMENTS)
+        connection.execute('PRAGMA mmap_size=%d' % MMAP_SIZE)
+        return connection
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, connection):
+        with self._lock:
+            if not self._closed and len(self._idle) < MAX_IDLE_CONNECTIONS:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+def __connection_pool(dbname):
     dbfn = __db_path(dbname)
-
-    # open DB
-    if not exists(dbfn):
+    try:
+        st = stat(dbfn)
+    except OSError:
         raise dbNotFoundError(dbfn)
-    connection = sqlite.connect(dbfn)
+    signature = (st.st_ino, st.st_size, st.st_mtime)
+
+    with __connection_pools_lock:
+        pool = __connection_pools.get(dbfn)
+        if pool is None or pool.signature != signature:
+            if pool is not None:
+                # Connections in use are closed once released
+                pool.close()
+            pool = _ConnectionPool(dbfn, signature)
+            __connection_pools[dbfn] = pool
+        return pool
+
+
+def close_connections():
+    """Closes the idle connections to all DBs."""
+    with __connection_pools_lock:
+        pools = list(__connection_pools.values())
+        __connection_pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+@contextmanager
+def _get_cursor(dbname):
+    # helper for DB access functions: a cursor on a pooled connection,
+    # returned to the pool when done
+    pool = __connection_pool(dbname)
+    connection = pool.acquire()
     cursor = connection.cursor()
-
-    return connection, cursor
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+        pool.release(connection)
 
 
 def _execute_fetchall(cursor, command, args, dbname):
@@ -107,12 +199,11 @@ def _execute_fetchall(cursor, command, args, dbname):
 def data_by_id(dbname, id_):
     """Given a DB name and an entity id, returns all the information contained
     in the DB for the id."""
-    connection, cursor = _get_connection_cursor(dbname)
-
-    # select separately from names, attributes and infos
-    responses = {}
-    for table in TYPE_TABLES:
-        command = '''
+    with _get_cursor(dbname) as cursor:
+        # select separately from names, attributes and infos
+        responses = {}
+        for table in TYPE_TABLES:
+            command = '''
 SELECT L.text, N.value
 FROM entities E
 JOIN %s N
@@ -120,13 +211,11 @@ JOIN %s N
 JOIN labels L
   ON L.id = N.label_id
 WHERE E.uid=?''' % table
-        responses[table] = _execute_fetchall(cursor, command, (id_, ), dbname)
-
-        # short-circuit on missing or incomplete entry
-        if table in NON_EMPTY_TABLES and len(responses[table]) == 0:
-            break
+            responses[table] = _execute_fetchall(cursor, command, (id_, ), dbname)
 
-    cursor.close()
+            # short-circuit on missing or incomplete entry
+            if table in NON_EMPTY_TABLES and len(responses[table]) == 0:
+                break
 
     # empty or incomplete?
     for t in NON_EMPTY_TABLES:
@@ -168,27 +257,24 @@ def _ids_by_names(dbname, names, exactmatch=False, return_match=False):
     True, returns pairs of (id, matched name), otherwise returns only
     ids.
     """
-    connection, cursor = _get_connection_cursor(dbname)
-
-    if not return_match:
-        command = 'SELECT E.uid'
-    else:
-        command = 'SELECT E.uid, N.value'
+    with _get_cursor(dbname) as cursor:
+        if not return_match:
+            command = 'SELECT E.uid'
+        else:
+            command = 'SELECT E.uid, N.value'
 
-    command += '''
+        command += '''
 FROM entities E
 JOIN names N
   ON E.id = N.entity_id
 '''
-    if exactmatch:
-        command += 'WHERE N.value IN (%s)' % ','.join(['?' for n in names])
-    else:
-        command += 'WHERE N.normvalue IN (%s)' % ','.join(['?' for n in names])
-        names = [string_norm_form(n) for n in names]
-
-    responses = _execute_fetchall(cursor, command, names, dbname)
+        if exactmatch:
+            command += 'WHERE N.value IN (%s)' % ','.join(['?' for n in names])
+        else:
+            command += 'WHERE N.normvalue IN (%s)' % ','.join(['?' for n in names])
+            names = [string_norm_form(n) for n in names]
 
-    cursor.close()
+        responses = _execute_fetchall(cursor, command, names, dbname)
 
     if not return_match:
         return [r[0] for r in responses]
@@ -229,33 +315,30 @@ def _ids_by_names_attr(dbname, names, attr, exactmatch=False,
     True, returns pairs of (id, matched name), otherwise returns only
     names.
     """
-    connection, cursor = _get_connection_cursor(dbname)
-
-    if not return_match:
-        command = 'SELECT E.uid'
-    else:
-        command = 'SELECT E.uid, N.value'
+    with _get_cursor(dbname) as cursor:
+        if not return_match:
+            command = 'SELECT E.uid'
+        else:
+            command = 'SELECT E.uid, N.value'
 
-    command += '''
+        command += '''
 FROM entities E
 JOIN names N
   ON E.id = N.entity_id
 JOIN attributes A
   ON E.id = A.entity_id
 '''
-    if exactmatch:
-        command += 'WHERE N.value IN (%s) AND A.value=?' % ','.join([
-            '?' for n in names])
-    else:
-        # NOTE: using 'LIKE', not '=' here
-        command += 'WHERE N.normvalue IN (%s) AND A.normvalue LIKE ?' % ','.join([
-            '?' for n in names])
-        attr = '%' + string_norm_form(attr) + '%'
-        names = [string_norm_form(n) for n in names]
-
-    responses = _execute_fetchall(cursor, command, names + [attr], dbname)
-
-    cursor.close()
+        if exactmatch:
+            command += 'WHERE N.value IN (%s) AND A.value=?' % ','.join([
+                '?' for n in names])
+        else:
+            # NOTE: using 'LIKE', not '=' here
+            command += 'WHERE N.normvalue IN (%s) AND A.normvalue LIKE ?' % ','.join([
+                '?' for n in names])
+            attr = '%' + string_norm_form(attr) + '%'
+            names = [string_norm_form(n) for n in names]
+
+        responses = _execute_fetchall(cursor, command, names + [attr], dbname)
 
     if not return_match:
         return [r[0] for r in responses]
@@ -283,12 +366,11 @@ def datas_by_ids(dbname, ids):
 def _datas_by_ids(dbname, ids):
     """Given a DB name and a list of entity ids, returns all the information
     contained in the DB for the ids."""
-    connection, cursor = _get_connection_cursor(dbname)
-
-    # select separately from names, attributes and infos
-    responses = {}
-    for table in TYPE_TABLES:
-        command = '''
+    with _get_cursor(dbname) as cursor:
+        # select separately from names, attributes and infos
+        responses = {}
+        for table in TYPE_TABLES:
+            command = '''
 SELECT E.uid, L.text, N.value
 FROM entities E
 JOIN %s N
@@ -296,22 +378,20 @@ JOIN %s N
 JOIN labels L
   ON L.id = N.label_id
 WHERE E.uid IN (%s)''' % (table, ','.join(['?' for i in ids]))
-        response = _execute_fetchall(cursor, command, list(ids), dbname)
-
-        # group by ID first
-        for id_, label, value in response:
-            if id_ not in responses:
-                responses[id_] = {}
-            if table not in responses[id_]:
-                responses[id_][table] = []
-            responses[id_][table].append([label, value])
-
-        # short-circuit on missing or incomplete entry
-        if (table in NON_EMPTY_TABLES and
-                len([i for i in responses if responses[i][table] == 0]) != 0):
-            return None
-
-    cursor.close()
+            response = _execute_fetchall(cursor, command, list(ids), dbname)
+
+            # group by ID first
+            for id_, label, value in response:
+                if id_ not in responses:
+                    responses[id_] = {}
+                if table not in responses[id_]:
+                    responses[id_][table] = []
+                responses[id_][table].append([label, value])
+
+            # short-circuit on missing or incomplete entry
+            if (table in NON_EMPTY_TABLES and
+                    len([i for i in responses if responses[i][table] == 0]) != 0):
+                return None
 
     # empty or incomplete?
     for id_ in responses:
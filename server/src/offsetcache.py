@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+"""Cache of the token and sentence offsets of the collection documents.
+
+Tokenising and sentence splitting a text runs a pipeline of regular
+expressions (and possibly MeCab) over all of it, while the texts of the
+documents practically never change. The offsets of the texts of documents
+in DATA_DIR are thus kept on disk, as arrays of integers in a file of their
+own for each document and tokeniser (or sentence splitter), together with a
+hash of the text that they were computed for. A document thus has at most
+one file per tokeniser and sentence splitter, which is replaced once its
+text changes. Once every OFFSET_CACHE_PRUNE_INTERVAL seconds at most, the
+oldest files in excess of OFFSET_CACHE_MAX_FILES are removed.
+
+Short texts and texts from elsewhere (e.g. conversions and tools) are
+tokenised and sentence split directly.
+"""
+
+import os
+from array import array
+from hashlib import sha1
+from logging import info as log_info
+from os.path import abspath, dirname
+from os.path import join as path_join
+from os.path import sep as path_sep
+from tempfile import mkstemp
+from time import time
+
+# Directory for the cached offsets (disabled if None)
+try:
+    from config import OFFSET_CACHE_DIR
+except ImportError:
+    try:
+        from config import WORK_DIR
+        OFFSET_CACHE_DIR = path_join(WORK_DIR, 'offsets')
+    except ImportError:
+        # e.g. tools run without a server configuration
+        OFFSET_CACHE_DIR = None
+
+try:
+    from config import DATA_DIR
+except ImportError:
+    DATA_DIR = None
+
+try:
+    from config import OFFSET_CACHE_MAX_FILES
+except ImportError:
+    OFFSET_CACHE_MAX_FILES = 10000
+
+# Seconds between checks for files in excess of OFFSET_CACHE_MAX_FILES
+OFFSET_CACHE_PRUNE_INTERVAL = 3600
+# File whose modification time is that of the last check
+PRUNE_STAMP_FILE_NAME = '.pruned'
+
+# Texts shorter than this (in characters) are cheaper to process again
+OFFSET_CACHE_MIN_TEXT_SIZE = 1024
+
+# Bump when a tokeniser or sentence splitter changes its output
+OFFSET_CACHE_VERSION = 2
+
+MAGIC = b'BRATOFFS'
+# Arrays are stored in native byte order, which the mark identifies
+BYTE_ORDER_MARK = 0x01020304
+
+TOKENISERS = ('whitespace', 'ptblike', 'mecab')
+SSPLITTERS = ('newline', 'regex')
+
+
+def _token_boundary_gen(tokeniser):
+    if tokeniser == 'mecab':
+        from tokenise import jp_token_boundary_gen
+        return jp_token_boundary_gen
+    elif tokeniser == 'ptblike':
+        from tokenise import gtb_token_boundary_gen
+        return gtb_token_boundary_gen
+    elif tokeniser == 'whitespace':
+        from tokenise import whitespace_token_boundary_gen
+        return whitespace_token_boundary_gen
+    raise ValueError('unknown tokeniser "%s"' % tokeniser)
+
+
+def _sentence_boundary_gen(ssplitter):
+    if ssplitter == 'regex':
+        from ssplit import regex_sentence_boundary_gen
+        return regex_sentence_boundary_gen
+    elif ssplitter == 'newline':
+        from ssplit import newline_sentence_boundary_gen
+        return newline_sentence_boundary_gen
+    raise ValueError('unknown sentence splitter "%s"' % ssplitter)
+
+
+def _is_cached(text, txt_file_path):
+    if (OFFSET_CACHE_DIR is None or DATA_DIR is None or
+            txt_file_path is None or
+            len(text) < OFFSET_CACHE_MIN_TEXT_SIZE):
+        return False
+    return abspath(txt_file_path).startswith(
+        abspath(DATA_DIR).rstrip(path_sep) + path_sep)
+
+
+def _text_digest(text):
+    return sha1(text.encode('utf-8', 'surrogatepass')).digest()
+
+
+def _cache_path(txt_file_path, kind, name):
+    key = sha1(('%s\0%s\0%s\0%d' % (abspath(txt_file_path), kind, name,
+                                     OFFSET_CACHE_VERSION)
+                ).encode('utf-8', 'surrogatepass')).hexdigest()
+    return path_join(OFFSET_CACHE_DIR, key[:2], key)
+
+
+def _read_offsets(cache_path, text_digest):
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            data = cache_file.read()
+    except (IOError, OSError):
+        return None
+    header = array('I')
+    header_size = len(MAGIC) + len(text_digest) + 2 * header.itemsize
+    if (len(data) < header_size or data[:len(MAGIC)] != MAGIC or
+            data[len(MAGIC):len(MAGIC) + len(text_digest)] != text_digest):
+        # missing, broken or for an earlier version of the text
+        return None
+    header.frombytes(data[len(MAGIC) + len(text_digest):header_size])
+    bom, count = header
+    offsets = array('I')
+    if (bom != BYTE_ORDER_MARK or
+            len(data) != header_size + 2 * count * offsets.itemsize):
+        return None
+    offsets.frombytes(data[header_size:])
+    return offsets
+
+
+def _prune_due():
+    # Whether the last check was long enough ago, claiming the next one
+    # if so (any process writing to the cache may check)
+    stamp_path = path_join(OFFSET_CACHE_DIR, PRUNE_STAMP_FILE_NAME)
+    try:
+        if time() - os.stat(stamp_path).st_mtime < OFFSET_CACHE_PRUNE_INTERVAL:
+            return False
+        os.utime(stamp_path)
+    except FileNotFoundError:
+        try:
+            with open(stamp_path, 'w'):
+                pass
+        except (IOError, OSError):
+            return False
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _prune_cache():
+    # Removes the oldest files in excess of OFFSET_CACHE_MAX_FILES
+    cache_files = []
+    try:
+        with os.scandir(OFFSET_CACHE_DIR) as sub_dirs:
+            sub_dir_paths = [e.path for e in sub_dirs if e.is_dir()]
+        for sub_dir_path in sub_dir_paths:
+            with os.scandir(sub_dir_path) as entries:
+                for entry in entries:
+                    try:
+                        cache_files.append((entry.stat().st_mtime,
+                                            entry.path))
+                    except OSError:
+                        # removed while we looked
+                        pass
+    except (IOError, OSError) as e:
+        log_info('Could not list offset cache %s: %s' % (OFFSET_CACHE_DIR, e))
+        return
+
+    if len(cache_files) <= OFFSET_CACHE_MAX_FILES:
+        return
+    cache_files.sort()
+    for _, cache_path in cache_files[:len(cache_files) -
+                                     OFFSET_CACHE_MAX_FILES]:
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+
+
+def _write_offsets(cache_path, text_digest, offsets):
+    cache_dir = dirname(cache_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        new_file = not os.path.exists(cache_path)
+        # Replace at once, so that readers never see a partial file
+        fd, tmp_path = mkstemp(dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(MAGIC)
+                cache_file.write(text_digest)
+                array('I', (BYTE_ORDER_MARK, len(offsets) // 2)).tofile(
+                    cache_file)
+                offsets.tofile(cache_file)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except (IOError, OSError) as e:
+        log_info('Could not write offset cache file %s: %s' % (cache_path, e))
+        return
+
+    # Only a new document (or one not seen for long) adds to the cache
+    if new_file and _prune_due():
+        _prune_cache()
+
+
+def _cached_offsets(text, txt_file_path, kind, name, boundary_gen):
+    if not _is_cached(text, txt_file_path):
+        return list(boundary_gen(text))
+
+    cache_path = _cache_path(txt_file_path, kind, name)
+    text_digest = _text_digest(text)
+    offsets = _read_offsets(cache_path, text_digest)
+    if offsets is None:
+        offsets = array('I')
+        for start, end in boundary_gen(text):
+            offsets.append(start)
+            offsets.append(end)
+        _write_offsets(cache_path, text_digest, offsets)
+    return list(zip(offsets[::2], offsets[1::2]))
+
+
+def token_offsets(text, tokeniser, txt_file_path=None):
+    """Returns the (start, end) offsets of the tokens of the text as given
+    by the named tokeniser (see TOKENISERS). The offsets are cached if the
+    text is that of the given text file of a collection."""
+    return _cached_offsets(text, txt_file_path, 'tokens', tokeniser,
+                           _token_boundary_gen(tokeniser))
+
+
+def sentence_offsets(text, ssplitter, txt_file_path=None):
+    """Returns the (start, end) offsets of the sentences of the text as
+    given by the named sentence splitter (see SSPLITTERS). The offsets are
+    cached if the text is that of the given text file of a collection."""
+    return _cached_offsets(text, txt_file_path, 'sentences', ssplitter,
+                           _sentence_boundary_gen(ssplitter))
@@ -13,11 +13,13 @@ Version:    2011-11-17
 CUT_OFF = 0.95
 # In seconds
 QUERY_TIMEOUT = 30
+import asyncio
 from urllib.error import URLError
 from urllib.parse import quote_plus
 from urllib.request import urlopen
 
 from annlog import log_annotation
+from asyncsupport import http_request, run_blocking
 from common import ProtocolError
 from document import real_directory
 from jsonwrap import loads
@@ -52,26 +54,19 @@ class UnknownModelError(ProtocolError):
         json_dic['exception'] = 'unknownModelError'
 
 
-def suggest_span_types(collection, document, start, end, text, model):
-
+def _model_url(collection, model):
     pconf = ProjectConfiguration(real_directory(collection))
     for _, _, model_str, model_url in pconf.get_disambiguator_config():
         if model_str == model:
-            break
-    else:
-        # We were unable to find a matching model
-        raise SimSemConnectionNotConfiguredError
+            return model_url
+    # We were unable to find a matching model
+    raise SimSemConnectionNotConfiguredError
 
-    try:
-        quoted_text = quote_plus(text)
-        resp = urlopen(model_url % quoted_text, None, QUERY_TIMEOUT)
-    except URLError:
-        # TODO: Could give more details
-        raise SimSemConnectionError
 
-    json = loads(resp.read())
+def _suggestions(collection, document, start, end, text, resp_data):
+    json = loads(resp_data)
 
-    preds = json['result'][text.decode('utf-8')]
+    preds = json['result'][text]
 
     selected_preds = []
     conf_sum = 0
@@ -95,6 +90,37 @@ def suggest_span_types(collection, document, start, end, text, model):
             }
 
 
+def suggest_span_types(collection, document, start, end, text, model):
+    model_url = _model_url(collection, model)
+
+    try:
+        quoted_text = quote_plus(text)
+        resp = urlopen(model_url % quoted_text, None, QUERY_TIMEOUT)
+    except URLError:
+        # TODO: Could give more details
+        raise SimSemConnectionError
+
+    return _suggestions(collection, document, start, end, text, resp.read())
+
+
+async def suggest_span_types_async(collection, document, start, end, text,
+                                   model):
+    """Coroutine version of suggest_span_types()."""
+    model_url = _model_url(collection, model)
+
+    try:
+        resp = await http_request('GET', model_url % quote_plus(text),
+                                  timeout=QUERY_TIMEOUT)
+    except (ValueError, OSError, asyncio.TimeoutError):
+        raise SimSemConnectionError
+    # urlopen() fails on these as well
+    if resp.status >= 400:
+        raise SimSemConnectionError
+
+    return await run_blocking(_suggestions, collection, document, start,
+                              end, text, resp.data)
+
+
 if __name__ == '__main__':
     from config import DATA_DIR
     print(suggest_span_types(DATA_DIR, 'dummy', -1, -1, 'proposición', 'ner_spanish'))
@@ -12,15 +12,44 @@ Author:     Illes Solt          <solt tmit bme hu>
 Version:    2011-08-15
 """
 
+import errno
 import re
 import sys
 import urllib.parse  # TODO reduce scope
 import urllib.robotparser  # TODO reduce scope
+from collections import OrderedDict
+from hashlib import sha1
+from logging import info as log_info
+from os import fdopen, listdir, makedirs, remove, replace, stat
+from os.path import join as path_join
+from pickle import dump as pickle_dump
+from pickle import load as pickle_load
+from pickle import HIGHEST_PROTOCOL, PicklingError
+from tempfile import mkstemp
+from threading import Lock
 
 from annotation import open_textfile
 from message import Messager
 import config
 
+# Maximum number of compiled collection configurations to keep in memory
+# (disabled if <= 0)
+try:
+    from config import CONFIG_CACHE_SIZE
+except ImportError:
+    CONFIG_CACHE_SIZE = 64
+
+# Compiled configurations are also stored in WORK_DIR, so that new server
+# processes (e.g. each CGI request) can load them instead of parsing the
+# configuration files
+try:
+    from config import WORK_DIR
+    CONFIG_SNAPSHOT_DIR = path_join(WORK_DIR, 'config')
+except ImportError:
+    CONFIG_SNAPSHOT_DIR = None
+# Bump when CompiledConfiguration or TypeHierarchyNode change
+CONFIG_SNAPSHOT_VERSION = 2
+
 ENTITY_CATEGORY, EVENT_CATEGORY, RELATION_CATEGORY, UNKNOWN_CATEGORY = range(
     4)
 
@@ -697,55 +726,49 @@ def get_configs(
         minconf,
         sections,
         optional_sections):
-    if (directory, filename) not in get_configs.__cache:
-        configstr, source = __read_first_in_directory_tree(directory, filename)
-
-        if configstr is None:
-            # didn't get one; try default dir and fall back to the default
-            configstr = __read_or_default(filename, defaultstr)
-            if configstr == defaultstr:
-                Messager.info(
-                    "Project configuration: no configuration file (%s) found, using default." %
-                    filename, 5)
-                source = "[default]"
-            else:
-                source = filename
-
-        # try to parse what was found, fall back to minimal config
-        try:
-            configs, section_labels = __parse_configs(
-                configstr, source, sections, optional_sections)
-        except BaseException:
-            Messager.warning(
-                "Project configuration: Falling back to minimal default. Configuration is likely wrong.",
-                5)
-            configs = minconf
-            section_labels = dict([(a, a) for a in sections])
-
-        # very, very special case processing: if we have a type
-        # "Equiv" defined in a "relations" section that doesn't
-        # specify a "<REL-TYPE>", automatically fill "symmetric" and
-        # "transitive". This is to support older configurations that
-        # rely on the type "Equiv" to identify the relation as an
-        # equivalence.
-        if 'relations' in configs:
-            for r in configs['relations']:
-                if r == SEPARATOR_STR:
-                    continue
-                if (r.storage_form() == "Equiv" and
-                        "<REL-TYPE>" not in r.special_arguments):
-                    # this was way too much noise; will only add in after
-                    # at least most configs are revised.
-                    #                     Messager.warning('Note: "Equiv" defined in config without "<REL-TYPE>"; assuming symmetric and transitive. Consider revising config to add "<REL-TYPE>:symmetric-transitive" to definition.')
-                    r.special_arguments["<REL-TYPE>"] = ["symmetric",
-                                                         "transitive"]
-
-        get_configs.__cache[(directory, filename)] = (configs, section_labels)
-
-    return get_configs.__cache[(directory, filename)]
+    configstr, source = __read_first_in_directory_tree(directory, filename)
+
+    if configstr is None:
+        # didn't get one; try default dir and fall back to the default
+        configstr = __read_or_default(filename, defaultstr)
+        if configstr == defaultstr:
+            Messager.info(
+                "Project configuration: no configuration file (%s) found, using default." %
+                filename, 5)
+            source = "[default]"
+        else:
+            source = filename
 
+    # try to parse what was found, fall back to minimal config
+    try:
+        configs, section_labels = __parse_configs(
+            configstr, source, sections, optional_sections)
+    except BaseException:
+        Messager.warning(
+            "Project configuration: Falling back to minimal default. Configuration is likely wrong.",
+            5)
+        configs = minconf
+        section_labels = dict([(a, a) for a in sections])
+
+    # very, very special case processing: if we have a type
+    # "Equiv" defined in a "relations" section that doesn't
+    # specify a "<REL-TYPE>", automatically fill "symmetric" and
+    # "transitive". This is to support older configurations that
+    # rely on the type "Equiv" to identify the relation as an
+    # equivalence.
+    if 'relations' in configs:
+        for r in configs['relations']:
+            if r == SEPARATOR_STR:
+                continue
+            if (r.storage_form() == "Equiv" and
+                    "<REL-TYPE>" not in r.special_arguments):
+                # this was way too much noise; will only add in after
+                # at least most configs are revised.
+                #                     Messager.warning('Note: "Equiv" defined in config without "<REL-TYPE>"; assuming symmetric and transitive. Consider revising config to add "<REL-TYPE>:symmetric-transitive" to definition.')
+                r.special_arguments["<REL-TYPE>"] = ["symmetric",
+                                                     "transitive"]
 
-get_configs.__cache = {}
+    return (configs, section_labels)
 
 
 def __get_access_control(directory, filename, default_rules):
@@ -791,7 +814,7 @@ __minimal_configuration = {
                                         ["Negation"], ["Arg:<EVENT>"])], }
 
 
-def get_annotation_configs(directory):
+def _parse_annotation_configs(directory):
     return get_configs(directory,
                        __annotation_config_filename,
                        __default_configuration,
@@ -811,7 +834,7 @@ __minimal_visual = {
 }
 
 
-def get_visual_configs(directory):
+def _parse_visual_configs(directory):
     return get_configs(directory,
                        __visual_config_filename,
                        __default_visual,
@@ -833,7 +856,7 @@ __minimal_tools = {
 }
 
 
-def get_tools_configs(directory):
+def _parse_tools_configs(directory):
     return get_configs(directory,
                        __tools_config_filename,
                        __default_tools,
@@ -842,296 +865,641 @@ def get_tools_configs(directory):
                        __optional_tools_sections)
 
 
-def get_entity_type_hierarchy(directory):
-    return get_annotation_configs(directory)[0][ENTITY_SECTION]
-
+def _collect_type_list(node, collected):
+    if node == SEPARATOR_STR:
+        return collected
 
-def get_relation_type_hierarchy(directory):
-    return get_annotation_configs(directory)[0][RELATION_SECTION]
+    collected.append(node)
 
+    for c in node.children:
+        _collect_type_list(c, collected)
 
-def get_event_type_hierarchy(directory):
-    return get_annotation_configs(directory)[0][EVENT_SECTION]
+    return collected
 
 
-def get_attribute_type_hierarchy(directory):
-    return get_annotation_configs(directory)[0][ATTRIBUTE_SECTION]
-
+def _type_hierarchy_to_list(hierarchy):
+    root_nodes = hierarchy
+    types = []
+    for n in root_nodes:
+        _collect_type_list(n, types)
+    return types
 
-def get_annotation_config_section_labels(directory):
-    return get_annotation_configs(directory)[1]
 
-# TODO: too much caching?
+def _compile_labels(visual_configs):
+    l = {}
+    for t in visual_configs[LABEL_SECTION]:
+        if t.storage_form() in l:
+            Messager.warning(
+                "In configuration, labels for '%s' defined more than once. Only using the last set." %
+                t.storage_form(), -1)
+        # first is storage for, rest are labels.
+        l[t.storage_form()] = t.terms[1:]
+    return l
+
+
+def _compile_labels_by_storage_form(label_map):
+    d = {}
+    for l, labels in list(label_map.items()):
+        # recognize <EMPTY> as specifying that a label should
+        # be the empty string
+        labels = [lab if lab != '<EMPTY>' else ' ' for lab in labels]
+        d[l] = labels
+    return d
+
+
+def _compile_nodes_by_storage_form(type_list):
+    d = {}
+    for e in type_list:
+        t = e.storage_form()
+        if t in d:
+            Messager.warning(
+                "Project configuration: term %s appears multiple times, only using last. Configuration may be wrong." %
+                t, 5)
+        d[t] = e
+    return d
 
 
-def get_labels(directory):
-    cache = get_labels.__cache
-    if directory not in cache:
-        l = {}
-        for t in get_visual_configs(directory)[0][LABEL_SECTION]:
-            if t.storage_form() in l:
+def _compile_options_by_storage_form(config):
+    d = {}
+    for n in config:
+        t = n.storage_form()
+        if t in d:
+            Messager.warning(
+                "Project configuration: %s appears multiple times, only using last. Configuration may be wrong." %
+                t, 5)
+        d[t] = {}
+        for a in n.arguments:
+            if len(n.arguments[a]) != 1:
                 Messager.warning(
-                    "In configuration, labels for '%s' defined more than once. Only using the last set." %
-                    t.storage_form(), -1)
-            # first is storage for, rest are labels.
-            l[t.storage_form()] = t.terms[1:]
-        cache[directory] = l
-    return cache[directory]
+                    "Project configuration: %s key %s has multiple values, only using first. Configuration may be wrong." %
+                    (t, a), 5)
+            d[t][a] = n.arguments[a][0]
+    return d
 
 
-get_labels.__cache = {}
+def _compile_drawing_config_by_storage_form(drawing_config):
+    d = {}
+    for n in drawing_config:
+        t = n.storage_form()
+        if t in d:
+            Messager.warning(
+                "Project configuration: term %s appears multiple times, only using last. Configuration may be wrong." %
+                t, 5)
+        d[t] = {}
+        for a in n.arguments:
+            # attribute drawing can be specified with multiple
+            # values (multi-valued attributes), other parts of
+            # drawing config should have single values only.
+            if len(n.arguments[a]) != 1:
+                if a in ATTR_DRAWING_ATTRIBUTES:
+                    # use multi-valued directly
+                    d[t][a] = n.arguments[a]
+                else:
+                    # warn and pass
+                    Messager.warning(
+                        "Project configuration: expected single value for %s argument %s, got '%s'. Configuration may be wrong." %
+                        (t, a, "|".join(
+                            n.arguments[a])))
+            else:
+                d[t][a] = n.arguments[a][0]
 
-# TODO: too much caching?
+    # TODO: hack to get around inability to have commas in values;
+    # fix original issue instead
+    for t in d:
+        for k in d[t]:
+            # sorry about this
+            if not isinstance(d[t][k], list):
+                d[t][k] = d[t][k].replace("-", ",")
+            else:
+                d[t][k] = [v.replace("-", ",") for v in d[t][k]]
+
+    default_keys = [VISUAL_SPAN_DEFAULT,
+                    VISUAL_ARC_DEFAULT,
+                    VISUAL_ATTR_DEFAULT]
+    for default_dict in [d.get(dk, {}) for dk in default_keys]:
+        for k in default_dict:
+            for t in d:
+                d[t][k] = d[t].get(k, default_dict[k])
+
+    # Kind of a special case: recognize <NONE> as "deleting" an
+    # attribute (prevents default propagation) and <EMPTY> as
+    # specifying that a value should be the empty string
+    # (can't be written as such directly).
+    for t in d:
+        todelete = [k for k in d[t] if d[t][k] == '<NONE>']
+        for k in todelete:
+            del d[t][k]
+
+        for k in d[t]:
+            if d[t][k] == '<EMPTY>':
+                d[t][k] = ''
+
+    return d
+
+
+def _compile_binary_relation_types(relation_type_list):
+    """Returns the relation types that can be used as arcs, warning about
+    the others."""
+    rels = []
+    for r in relation_type_list:
+        if len(r.arg_list) != 2:
+            # Don't complain about argument constraints for unused relations
+            if not r.unused:
+                Messager.warning(
+                    "Relation type %s has %d arguments in configuration (%s; expected 2). Please fix configuration." %
+                    (r.storage_form(), len(
+                        r.arg_list), ",".join(
+                        r.arg_list)))
+        else:
+            rels.append(r)
+    return rels
 
 
-def get_drawing_types(directory):
-    cache = get_drawing_types.__cache
-    if directory not in cache:
-        l = set()
-        for n in get_drawing_config(directory):
-            l.add(n.storage_form())
-        cache[directory] = list(l)
-    return cache[directory]
+def _compile_relations_by_storage_form(relation_type_list, include_special):
+    d = {}
+    for r in relation_type_list:
+        if (r.storage_form() in SPECIAL_RELATION_TYPES and
+                not include_special):
+            continue
+        if r.unused:
+            continue
+        if r.storage_form() not in d:
+            d[r.storage_form()] = []
+        d[r.storage_form()].append(r)
+    return d
+
+
+class CompiledConfiguration(object):
+    """The configuration of a collection (annotation.conf, visual.conf,
+    tools.conf, kb_shortcuts.conf and acl.conf) parsed, together with the
+    lookup tables derived from it.
+
+    Instances are shared between requests (see get_configuration()) and
+    must not be modified. The version identifies the contents of the
+    configuration files (None if unknown) and is also the name of the
+    on-disk snapshot, if any, which files derived from the configuration
+    may use as a prefix for theirs to be removed along with it. The
+    messages are the warnings given in parsing the configuration, given
+    again when loading the snapshot as parsing would.
+    """
 
+    def __init__(self, directory):
+        self.version = None
+        mark = Messager.mark()
+
+        self.annotation_configs = _parse_annotation_configs(directory)
+        self.visual_configs = _parse_visual_configs(directory)
+        self.tools_configs = _parse_tools_configs(directory)
+        self.kb_shortcuts = _parse_kb_shortcuts(directory)
+        self.access_control = _parse_access_control(directory)
+
+        annotation, visual, tools = (self.annotation_configs[0],
+                                     self.visual_configs[0],
+                                     self.tools_configs[0])
+        self.entity_type_list = _type_hierarchy_to_list(
+            annotation[ENTITY_SECTION])
+        self.event_type_list = _type_hierarchy_to_list(
+            annotation[EVENT_SECTION])
+        self.relation_type_list = _type_hierarchy_to_list(
+            annotation[RELATION_SECTION])
+        self.attribute_type_list = _type_hierarchy_to_list(
+            annotation[ATTRIBUTE_SECTION])
+        self.search_config_list = _type_hierarchy_to_list(
+            tools[SEARCH_SECTION])
+        self.annotator_config_list = _type_hierarchy_to_list(
+            tools[ANNOTATORS_SECTION])
+        self.disambiguator_config_list = _type_hierarchy_to_list(
+            tools[DISAMBIGUATORS_SECTION])
+        self.normalization_config_list = _type_hierarchy_to_list(
+            tools[NORMALIZATION_SECTION])
+
+        self.labels = _compile_labels(visual)
+        self._labels_by_storage_form = _compile_labels_by_storage_form(
+            self.labels)
+        self._nodes_by_storage_form = _compile_nodes_by_storage_form(
+            self.entity_type_list + self.event_type_list)
+        self._option_configs = _compile_options_by_storage_form(
+            tools[OPTIONS_SECTION])
+        self._visual_option_configs = _compile_options_by_storage_form(
+            visual[OPTIONS_SECTION])
+        self._drawing_configs = _compile_drawing_config_by_storage_form(
+            visual[DRAWING_SECTION])
+        self.drawing_types = list(set(n.storage_form()
+                                      for n in visual[DRAWING_SECTION]))
+
+        self._relations_by_storage_form = dict(
+            (include_special, _compile_relations_by_storage_form(
+                self.relation_type_list, include_special))
+            for include_special in (False, True))
+
+        # arc tables: the relations that can take each type (and each
+        # generic type) as their first or second argument
+        self._binary_relations = _compile_binary_relation_types(
+            self.relation_type_list)
+        self._entity_types = set(t.storage_form()
+                                 for t in self.entity_type_list)
+        self._event_types = set(t.storage_form()
+                                for t in self.event_type_list)
+        self._relations_by_arg = {}
+        arc_types = (['<ANY>', '<ENTITY>', '<EVENT>'] +
+                     list(self._nodes_by_storage_form))
+        for num in (0, 1):
+            for atype in arc_types:
+                for include_special in (False, True):
+                    self._relations_by_arg[(num, atype, include_special)] = \
+                        self._find_relations_by_arg(num, atype,
+                                                    include_special)
+
+        self.messages = Messager.messages_since(mark)
+
+    def _find_relations_by_arg(self, num, atype, include_special):
+        assert num >= 0 and num < 2, "INTERNAL ERROR"
+
+        entity_types, event_types = self._entity_types, self._event_types
+
+        rels = []
+        for r in self._binary_relations:
+            # "Special" nesting relations ignored unless specifically
+            # requested
+            if (r.storage_form() in SPECIAL_RELATION_TYPES and
+                    not include_special):
+                continue
 
-get_drawing_types.__cache = {}
+            types = r.arguments[r.arg_list[num]]
+            for type_ in types:
+                # TODO: there has to be a better way
+                if (type_ == atype or
+                    type_ == "<ANY>" or
+                    atype == "<ANY>" or
+                    (type_ in entity_types and atype == "<ENTITY>") or
+                    (type_ in event_types and atype == "<EVENT>") or
+                    (atype in entity_types and type_ == "<ENTITY>") or
+                        (atype in event_types and type_ == "<EVENT>")):
+                    rels.append(r)
+                    # TODO: why not break here?
 
+        return rels
 
-def get_option_config(directory):
-    return get_tools_configs(directory)[0][OPTIONS_SECTION]
+    def relations_by_arg(self, num, atype, include_special=False):
+        """Returns the relations that can have an annotation of the given
+        type as their first (num=0) or second (num=1) argument."""
+        key = (num, atype, include_special)
+        try:
+            return self._relations_by_arg[key]
+        except KeyError:
+            # unconfigured type; not worth keeping
+            return self._find_relations_by_arg(num, atype, include_special)
 
+    def node_by_storage_form(self, term):
+        return self._nodes_by_storage_form.get(term, None)
 
-def get_drawing_config(directory):
-    return get_visual_configs(directory)[0][DRAWING_SECTION]
+    def labels_by_storage_form(self, term):
+        return self._labels_by_storage_form.get(term, None)
 
+    def option_config_by_storage_form(self, term):
+        return self._option_configs.get(term, None)
 
-def get_visual_option_config(directory):
-    return get_visual_configs(directory)[0][OPTIONS_SECTION]
+    def visual_option_config_by_storage_form(self, term):
+        return self._visual_option_configs.get(term, None)
 
+    def drawing_config_by_storage_form(self, term):
+        return self._drawing_configs.get(term, None)
 
-def get_visual_config_section_labels(directory):
-    return get_visual_configs(directory)[1]
+    def relations_by_storage_form(self, rtype, include_special=False):
+        return self._relations_by_storage_form[include_special].get(rtype, [])
 
 
-def get_search_config(directory):
-    return get_tools_configs(directory)[0][SEARCH_SECTION]
+def _parse_kb_shortcuts(directory):
+    return __get_kb_shortcuts(directory,
+                              __kb_shortcut_filename,
+                              __default_kb_shortcuts,
+                              {"P": "Positive_regulation"})
 
 
-def get_annotator_config(directory):
-    return get_tools_configs(directory)[0][ANNOTATORS_SECTION]
+def _parse_access_control(directory):
+    return __get_access_control(directory,
+                                __access_control_filename,
+                                __default_access_control)
 
 
-def get_disambiguator_config(directory):
-    return get_tools_configs(directory)[0][DISAMBIGUATORS_SECTION]
+def __config_file_signature(directory, filename):
+    """Returns the path, modification time and size of the configuration
+    file with the given name that applies to the given directory, or None
+    if there is none and the default applies.
 
+    Follows the lookup of __read_first_in_directory_tree() and
+    get_configs() without reading the files.
+    """
+    try:
+        from config import BASE_DIR
+    except BaseException:
+        BASE_DIR = "/"
+    from os.path import split, join
 
-def get_normalization_config(directory):
-    return get_tools_configs(directory)[0][NORMALIZATION_SECTION]
+    candidates = []
+    if directory is not None:
+        while BASE_DIR in directory:
+            candidates.append(join(directory, filename))
+            parent = split(directory)[0]
+            if parent == directory:
+                break
+            directory = parent
+    # default dir (relative to the working directory)
+    candidates.append(filename)
 
+    for path in candidates:
+        try:
+            st = stat(path)
+        except OSError:
+            continue
+        return (path, st.st_mtime_ns, st.st_size)
+    return None
+
+
+def _configuration_signature(directory):
+    return tuple(__config_file_signature(directory, filename)
+                 for filename in (__annotation_config_filename,
+                                  __visual_config_filename,
+                                  __tools_config_filename,
+                                  __kb_shortcut_filename,
+                                  __access_control_filename))
+
+
+def _config_content_hashes(signature):
+    """Returns the SHA-1 hashes of the contents of the configuration files
+    in the given signature (see _configuration_signature())."""
+    hashes = []
+    for file_signature in signature:
+        if file_signature is None:
+            hashes.append(None)
+            continue
+        try:
+            with open(file_signature[0], 'rb') as config_file:
+                hashes.append(sha1(config_file.read()).hexdigest())
+        except IOError:
+            hashes.append(None)
+    return hashes
 
-def get_tools_config_section_labels(directory):
-    return get_tools_configs(directory)[1]
 
+def _snapshot_name(signature, hashes):
+    """Returns the name (without extension) of the snapshot of the given
+    configuration files and contents, and the prefix shared by the names of
+    all snapshots of the same files."""
+    paths = [s[0] if s is not None else None for s in signature]
+    prefix = sha1(repr((CONFIG_SNAPSHOT_VERSION, paths)).encode(
+        'utf-8')).hexdigest()
+    return ('%s-%s' % (prefix, sha1(repr(hashes).encode('utf-8')).hexdigest()),
+            prefix)
 
-def get_access_control(directory):
-    cache = get_access_control.__cache
-    if directory not in cache:
-        a = __get_access_control(directory,
-                                 __access_control_filename,
-                                 __default_access_control)
-        cache[directory] = a
 
-    return cache[directory]
+def _load_snapshot(snapshot_path):
+    try:
+        with open(snapshot_path, 'rb') as snapshot_file:
+            return pickle_load(snapshot_file)
+    except IOError:
+        return None
+    except Exception as e:
+        # Corrupt or from an incompatible version, simply replaced
+        log_info('Failed to load configuration snapshot %s: %s' %
+                 (snapshot_path, e))
+        return None
+
+
+def _store_snapshot(name, prefix, compiled):
+    snapshot_path = path_join(CONFIG_SNAPSHOT_DIR, name + '.pickle')
+    tmp_file_path = None
+    try:
+        try:
+            makedirs(CONFIG_SNAPSHOT_DIR)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        tmp_file_fh, tmp_file_path = mkstemp(dir=CONFIG_SNAPSHOT_DIR,
+                                             prefix='.', suffix='.tmp')
+        with fdopen(tmp_file_fh, 'wb') as tmp_file:
+            pickle_dump(compiled, tmp_file, HIGHEST_PROTOCOL)
+        replace(tmp_file_path, snapshot_path)
+        tmp_file_path = None
+
+        # Snapshots (and other files derived from them) of earlier
+        # versions of the same files are of no use
+        for file_name in listdir(CONFIG_SNAPSHOT_DIR):
+            if (file_name.startswith(prefix) and
+                    not file_name.startswith(name)):
+                try:
+                    remove(path_join(CONFIG_SNAPSHOT_DIR, file_name))
+                except OSError:
+                    pass
+    except (IOError, OSError, PicklingError) as e:
+        log_info('Failed to store configuration snapshot %s: %s' %
+                 (snapshot_path, e))
+    finally:
+        if tmp_file_path is not None:
+            try:
+                remove(tmp_file_path)
+            except OSError:
+                pass
+
+
+def _compile_configuration(directory, signature):
+    """Returns the CompiledConfiguration for the given directory, loading it
+    from the on-disk snapshot of the same configuration file contents if
+    there is one and storing one otherwise."""
+    hashes = _config_content_hashes(signature)
+    name, prefix = _snapshot_name(signature, hashes)
+
+    if CONFIG_SNAPSHOT_DIR is not None:
+        compiled = _load_snapshot(
+            path_join(CONFIG_SNAPSHOT_DIR, name + '.pickle'))
+        if isinstance(compiled, CompiledConfiguration):
+            Messager.add_messages(compiled.messages)
+            return compiled
+
+    compiled = CompiledConfiguration(directory)
+    # Files changed while being parsed have no (known) version
+    if _config_content_hashes(signature) == hashes:
+        compiled.version = name
+        if CONFIG_SNAPSHOT_DIR is not None:
+            _store_snapshot(name, prefix, compiled)
+    return compiled
+
+
+class ConfigurationRegistry(object):
+    """Bounded LRU cache of CompiledConfigurations, keyed by the paths,
+    modification times and sizes of the configuration files that apply to
+    each collection. A configuration is recompiled whenever any of its files
+    change, appear or disappear."""
+
+    def __init__(self, max_size=CONFIG_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get(self, directory):
+        # Collections with the same configuration files share one
+        key = _configuration_signature(directory)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                return compiled
+
+        compiled = _compile_configuration(directory, key)
+        if self.max_size > 0:
+            with self._lock:
+                self._entries[key] = compiled
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return compiled
+
+
+CONFIGURATION_REGISTRY = ConfigurationRegistry()
+
+
+def get_configuration(directory):
+    """Returns the CompiledConfiguration for the given collection
+    directory, up to date with the configuration files on disk."""
+    return CONFIGURATION_REGISTRY.get(directory)
+
+
+def get_configuration_version(directory):
+    """Returns a string identifying the contents of the configuration files
+    of the given directory, or None if it is not known."""
+    return get_configuration(directory).version
 
 
-get_access_control.__cache = {}
+def get_annotation_configs(directory):
+    return get_configuration(directory).annotation_configs
 
 
-def get_kb_shortcuts(directory):
-    cache = get_kb_shortcuts.__cache
-    if directory not in cache:
-        a = __get_kb_shortcuts(directory,
-                               __kb_shortcut_filename,
-                               __default_kb_shortcuts,
-                               {"P": "Positive_regulation"})
-        cache[directory] = a
+def get_visual_configs(directory):
+    return get_configuration(directory).visual_configs
 
-    return cache[directory]
 
+def get_tools_configs(directory):
+    return get_configuration(directory).tools_configs
 
-get_kb_shortcuts.__cache = {}
 
+def get_entity_type_hierarchy(directory):
+    return get_annotation_configs(directory)[0][ENTITY_SECTION]
 
-def __collect_type_list(node, collected):
-    if node == SEPARATOR_STR:
-        return collected
 
-    collected.append(node)
+def get_relation_type_hierarchy(directory):
+    return get_annotation_configs(directory)[0][RELATION_SECTION]
 
-    for c in node.children:
-        __collect_type_list(c, collected)
 
-    return collected
+def get_event_type_hierarchy(directory):
+    return get_annotation_configs(directory)[0][EVENT_SECTION]
 
 
-def __type_hierarchy_to_list(hierarchy):
-    root_nodes = hierarchy
-    types = []
-    for n in root_nodes:
-        __collect_type_list(n, types)
-    return types
+def get_attribute_type_hierarchy(directory):
+    return get_annotation_configs(directory)[0][ATTRIBUTE_SECTION]
 
-# TODO: it's not clear it makes sense for all of these methods to have
-# their own caches; this seems a bit like a case of premature
-# optimization to me. Consider simplifying.
 
+def get_annotation_config_section_labels(directory):
+    return get_annotation_configs(directory)[1]
 
-def get_entity_type_list(directory):
-    cache = get_entity_type_list.__cache
-    if directory not in cache:
-        cache[directory] = __type_hierarchy_to_list(
-            get_entity_type_hierarchy(directory))
-    return cache[directory]
 
+def get_labels(directory):
+    return get_configuration(directory).labels
 
-get_entity_type_list.__cache = {}
 
+def get_drawing_types(directory):
+    return get_configuration(directory).drawing_types
 
-def get_event_type_list(directory):
-    cache = get_event_type_list.__cache
-    if directory not in cache:
-        cache[directory] = __type_hierarchy_to_list(
-            get_event_type_hierarchy(directory))
-    return cache[directory]
 
+def get_option_config(directory):
+    return get_tools_configs(directory)[0][OPTIONS_SECTION]
 
-get_event_type_list.__cache = {}
 
+def get_drawing_config(directory):
+    return get_visual_configs(directory)[0][DRAWING_SECTION]
 
-def get_relation_type_list(directory):
-    cache = get_relation_type_list.__cache
-    if directory not in cache:
-        cache[directory] = __type_hierarchy_to_list(
-            get_relation_type_hierarchy(directory))
-    return cache[directory]
 
+def get_visual_option_config(directory):
+    return get_visual_configs(directory)[0][OPTIONS_SECTION]
 
-get_relation_type_list.__cache = {}
 
+def get_visual_config_section_labels(directory):
+    return get_visual_configs(directory)[1]
 
-def get_attribute_type_list(directory):
-    cache = get_attribute_type_list.__cache
-    if directory not in cache:
-        cache[directory] = __type_hierarchy_to_list(
-            get_attribute_type_hierarchy(directory))
-    return cache[directory]
 
+def get_search_config(directory):
+    return get_tools_configs(directory)[0][SEARCH_SECTION]
 
-get_attribute_type_list.__cache = {}
 
+def get_annotator_config(directory):
+    return get_tools_configs(directory)[0][ANNOTATORS_SECTION]
 
-def get_search_config_list(directory):
-    cache = get_search_config_list.__cache
-    if directory not in cache:
-        cache[directory] = __type_hierarchy_to_list(
-            get_search_config(directory))
-    return cache[directory]
 
+def get_disambiguator_config(directory):
+    return get_tools_configs(directory)[0][DISAMBIGUATORS_SECTION]
 
-get_search_config_list.__cache = {}
 
+def get_normalization_config(directory):
+    return get_tools_configs(directory)[0][NORMALIZATION_SECTION]
 
-def get_annotator_config_list(directory):
-    cache = get_annotator_config_list.__cache
-    if directory not in cache:
-        cache[directory] = __type_hierarchy_to_list(
-            get_annotator_config(directory))
-    return cache[directory]
 
+def get_tools_config_section_labels(directory):
+    return get_tools_configs(directory)[1]
 
-get_annotator_config_list.__cache = {}
 
+def get_access_control(directory):
+    return get_configuration(directory).access_control
 
-def get_disambiguator_config_list(directory):
-    cache = get_disambiguator_config_list.__cache
-    if directory not in cache:
-        cache[directory] = __type_hierarchy_to_list(
-            get_disambiguator_config(directory))
-    return cache[directory]
 
+def get_kb_shortcuts(directory):
+    return get_configuration(directory).kb_shortcuts
 
-get_disambiguator_config_list.__cache = {}
 
+def get_entity_type_list(directory):
+    return get_configuration(directory).entity_type_list
 
-def get_normalization_config_list(directory):
-    cache = get_normalization_config_list.__cache
-    if directory not in cache:
-        cache[directory] = __type_hierarchy_to_list(
-            get_normalization_config(directory))
-    return cache[directory]
 
+def get_event_type_list(directory):
+    return get_configuration(directory).event_type_list
 
-get_normalization_config_list.__cache = {}
 
+def get_relation_type_list(directory):
+    return get_configuration(directory).relation_type_list
 
-def get_node_by_storage_form(directory, term):
-    cache = get_node_by_storage_form.__cache
-    if directory not in cache:
-        d = {}
-        for e in get_entity_type_list(
-                directory) + get_event_type_list(directory):
-            t = e.storage_form()
-            if t in d:
-                Messager.warning(
-                    "Project configuration: term %s appears multiple times, only using last. Configuration may be wrong." %
-                    t, 5)
-            d[t] = e
-        cache[directory] = d
 
-    return cache[directory].get(term, None)
+def get_attribute_type_list(directory):
+    return get_configuration(directory).attribute_type_list
 
 
-get_node_by_storage_form.__cache = {}
+def get_search_config_list(directory):
+    return get_configuration(directory).search_config_list
 
 
-def _get_option_by_storage_form(directory, term, config, cache):
-    if directory not in cache:
-        d = {}
-        for n in config:
-            t = n.storage_form()
-            if t in d:
-                Messager.warning(
-                    "Project configuration: %s appears multiple times, only using last. Configuration may be wrong." %
-                    t, 5)
-            d[t] = {}
-            for a in n.arguments:
-                if len(n.arguments[a]) != 1:
-                    Messager.warning(
-                        "Project configuration: %s key %s has multiple values, only using first. Configuration may be wrong." %
-                        (t, a), 5)
-                d[t][a] = n.arguments[a][0]
+def get_annotator_config_list(directory):
+    return get_configuration(directory).annotator_config_list
 
-        cache[directory] = d
 
-    return cache[directory].get(term, None)
+def get_disambiguator_config_list(directory):
+    return get_configuration(directory).disambiguator_config_list
 
 
-def get_option_config_by_storage_form(directory, term):
-    cache = get_option_config_by_storage_form.__cache
-    config = get_option_config(directory)
-    return _get_option_by_storage_form(directory, term, config, cache)
+def get_normalization_config_list(directory):
+    return get_configuration(directory).normalization_config_list
 
 
-get_option_config_by_storage_form.__cache = {}
+def get_node_by_storage_form(directory, term):
+    return get_configuration(directory).node_by_storage_form(term)
 
 
-def get_visual_option_config_by_storage_form(directory, term):
-    cache = get_visual_option_config_by_storage_form.__cache
-    config = get_visual_option_config(directory)
-    return _get_option_by_storage_form(directory, term, config, cache)
+def get_option_config_by_storage_form(directory, term):
+    return get_configuration(directory).option_config_by_storage_form(term)
 
 
-get_visual_option_config_by_storage_form.__cache = {}
+def get_visual_option_config_by_storage_form(directory, term):
+    return get_configuration(
+        directory).visual_option_config_by_storage_form(term)
 
 # access for settings for specific options in tools.conf
 # TODO: avoid fixed string values here, define vars earlier
@@ -1170,172 +1538,26 @@ def visual_options_get_text_direction(directory):
 
 
 def get_drawing_config_by_storage_form(directory, term):
-    cache = get_drawing_config_by_storage_form.__cache
-    if directory not in cache:
-        d = {}
-        for n in get_drawing_config(directory):
-            t = n.storage_form()
-            if t in d:
-                Messager.warning(
-                    "Project configuration: term %s appears multiple times, only using last. Configuration may be wrong." %
-                    t, 5)
-            d[t] = {}
-            for a in n.arguments:
-                # attribute drawing can be specified with multiple
-                # values (multi-valued attributes), other parts of
-                # drawing config should have single values only.
-                if len(n.arguments[a]) != 1:
-                    if a in ATTR_DRAWING_ATTRIBUTES:
-                        # use multi-valued directly
-                        d[t][a] = n.arguments[a]
-                    else:
-                        # warn and pass
-                        Messager.warning(
-                            "Project configuration: expected single value for %s argument %s, got '%s'. Configuration may be wrong." %
-                            (t, a, "|".join(
-                                n.arguments[a])))
-                else:
-                    d[t][a] = n.arguments[a][0]
-
-        # TODO: hack to get around inability to have commas in values;
-        # fix original issue instead
-        for t in d:
-            for k in d[t]:
-                # sorry about this
-                if not isinstance(d[t][k], list):
-                    d[t][k] = d[t][k].replace("-", ",")
-                else:
-                    for i in range(len(d[t][k])):
-                        d[t][k][i] = d[t][k][i].replace("-", ",")
-
-        default_keys = [VISUAL_SPAN_DEFAULT,
-                        VISUAL_ARC_DEFAULT,
-                        VISUAL_ATTR_DEFAULT]
-        for default_dict in [d.get(dk, {}) for dk in default_keys]:
-            for k in default_dict:
-                for t in d:
-                    d[t][k] = d[t].get(k, default_dict[k])
-
-        # Kind of a special case: recognize <NONE> as "deleting" an
-        # attribute (prevents default propagation) and <EMPTY> as
-        # specifying that a value should be the empty string
-        # (can't be written as such directly).
-        for t in d:
-            todelete = [k for k in d[t] if d[t][k] == '<NONE>']
-            for k in todelete:
-                del d[t][k]
-
-            for k in d[t]:
-                if d[t][k] == '<EMPTY>':
-                    d[t][k] = ''
-
-        cache[directory] = d
-
-    return cache[directory].get(term, None)
-
-
-get_drawing_config_by_storage_form.__cache = {}
-
-
-def __directory_relations_by_arg_num(
-        directory, num, atype, include_special=False):
-    assert num >= 0 and num < 2, "INTERNAL ERROR"
-
-    rels = []
-
-    entity_types = set([t.storage_form()
-                        for t in get_entity_type_list(directory)])
-    event_types = set([t.storage_form()
-                       for t in get_event_type_list(directory)])
-
-    for r in get_relation_type_list(directory):
-        # "Special" nesting relations ignored unless specifically
-        # requested
-        if r.storage_form() in SPECIAL_RELATION_TYPES and not include_special:
-            continue
-
-        if len(r.arg_list) != 2:
-            # Don't complain about argument constraints for unused relations
-            if not r.unused:
-                Messager.warning(
-                    "Relation type %s has %d arguments in configuration (%s; expected 2). Please fix configuration." %
-                    (r.storage_form(), len(
-                        r.arg_list), ",".join(
-                        r.arg_list)))
-        else:
-            types = r.arguments[r.arg_list[num]]
-            for type_ in types:
-                # TODO: there has to be a better way
-                if (type_ == atype or
-                    type_ == "<ANY>" or
-                    atype == "<ANY>" or
-                    (type_ in entity_types and atype == "<ENTITY>") or
-                    (type_ in event_types and atype == "<EVENT>") or
-                    (atype in entity_types and type_ == "<ENTITY>") or
-                        (atype in event_types and type_ == "<EVENT>")):
-                    rels.append(r)
-                    # TODO: why not break here?
-
-    return rels
+    return get_configuration(directory).drawing_config_by_storage_form(term)
 
 
 def get_relations_by_arg1(directory, atype, include_special=False):
-    cache = get_relations_by_arg1.__cache
-    cache[directory] = cache.get(directory, {})
-    if (atype, include_special) not in cache[directory]:
-        cache[directory][(atype, include_special)] = __directory_relations_by_arg_num(
-            directory, 0, atype, include_special)
-    return cache[directory][(atype, include_special)]
-
-
-get_relations_by_arg1.__cache = {}
+    return get_configuration(directory).relations_by_arg(
+        0, atype, include_special)
 
 
 def get_relations_by_arg2(directory, atype, include_special=False):
-    cache = get_relations_by_arg2.__cache
-    cache[directory] = cache.get(directory, {})
-    if (atype, include_special) not in cache[directory]:
-        cache[directory][(atype, include_special)] = __directory_relations_by_arg_num(
-            directory, 1, atype, include_special)
-    return cache[directory][(atype, include_special)]
-
-
-get_relations_by_arg2.__cache = {}
+    return get_configuration(directory).relations_by_arg(
+        1, atype, include_special)
 
 
 def get_relations_by_storage_form(directory, rtype, include_special=False):
-    cache = get_relations_by_storage_form.__cache
-    cache[directory] = cache.get(directory, {})
-    if include_special not in cache[directory]:
-        cache[directory][include_special] = {}
-        for r in get_relation_type_list(directory):
-            if (r.storage_form() in SPECIAL_RELATION_TYPES and
-                    not include_special):
-                continue
-            if r.unused:
-                continue
-            if r.storage_form() not in cache[directory][include_special]:
-                cache[directory][include_special][r.storage_form()] = []
-            cache[directory][include_special][r.storage_form()].append(r)
-    return cache[directory][include_special].get(rtype, [])
-
-
-get_relations_by_storage_form.__cache = {}
+    return get_configuration(directory).relations_by_storage_form(
+        rtype, include_special)
 
 
 def get_labels_by_storage_form(directory, term):
-    cache = get_labels_by_storage_form.__cache
-    if directory not in cache:
-        cache[directory] = {}
-        for l, labels in list(get_labels(directory).items()):
-            # recognize <EMPTY> as specifying that a label should
-            # be the empty string
-            labels = [lab if lab != '<EMPTY>' else ' ' for lab in labels]
-            cache[directory][l] = labels
-    return cache[directory].get(term, None)
-
-
-get_labels_by_storage_form.__cache = {}
+    return get_configuration(directory).labels_by_storage_form(term)
 
 # fallback for missing or partial config: these are highly likely to
 # be entity (as opposed to an event or relation) types.
@@ -1385,11 +1607,12 @@ class ProjectConfiguration(object):
                 "Project config received relative directory ('%s'), configuration may not be found." %
                 directory, duration=-1)
         self.directory = directory
+        self.config = get_configuration(directory)
 
     def mandatory_arguments(self, atype):
         """Returns the mandatory argument types that must be present for an
         annotation of the given type."""
-        node = get_node_by_storage_form(self.directory, atype)
+        node = self.config.node_by_storage_form(atype)
         if node is None:
             Messager.warning(
                 "Project configuration: unknown event type %s. Configuration may be wrong." %
@@ -1400,7 +1623,7 @@ class ProjectConfiguration(object):
     def multiple_allowed_arguments(self, atype):
         """Returns the argument types that are allowed to be filled more than
         once for an annotation of the given type."""
-        node = get_node_by_storage_form(self.directory, atype)
+        node = self.config.node_by_storage_form(atype)
         if node is None:
             Messager.warning(
                 "Project configuration: unknown event type %s. Configuration may be wrong." %
@@ -1411,7 +1634,7 @@ class ProjectConfiguration(object):
     def argument_maximum_count(self, atype, arg):
         """Returns the maximum number of times that the given argument is
         allowed to be filled for an annotation of the given type."""
-        node = get_node_by_storage_form(self.directory, atype)
+        node = self.config.node_by_storage_form(atype)
         if node is None:
             Messager.warning(
                 "Project configuration: unknown event type %s. Configuration may be wrong." %
@@ -1422,7 +1645,7 @@ class ProjectConfiguration(object):
     def argument_minimum_count(self, atype, arg):
         """Returns the minimum number of times that the given argument is
         allowed to be filled for an annotation of the given type."""
-        node = get_node_by_storage_form(self.directory, atype)
+        node = self.config.node_by_storage_form(atype)
         if node is None:
             Messager.warning(
                 "Project configuration: unknown event type %s. Configuration may be wrong." %
@@ -1436,25 +1659,22 @@ class ProjectConfiguration(object):
     def relation_types_from(self, from_ann, include_special=False):
         """Returns the possible relation types that can have an annotation of
         the given type as their arg1."""
-        return [r.storage_form() for r in get_relations_by_arg1(
-            self.directory, from_ann, include_special)]
+        return [r.storage_form() for r in self.config.relations_by_arg(
+            0, from_ann, include_special)]
 
     def relation_types_to(self, to_ann, include_special=False):
         """Returns the possible relation types that can have an annotation of
         the given type as their arg2."""
-        return [
-            r.storage_form() for r in get_relations_by_arg2(
-                self.directory,
-                to_ann,
-                include_special)]
+        return [r.storage_form() for r in self.config.relations_by_arg(
+            1, to_ann, include_special)]
 
     def relation_types_from_to(self, from_ann, to_ann, include_special=False):
         """Returns the possible relation types that can have the given arg1 and
         arg2."""
         types = []
 
-        t1r = get_relations_by_arg1(self.directory, from_ann, include_special)
-        t2r = get_relations_by_arg2(self.directory, to_ann, include_special)
+        t1r = self.config.relations_by_arg(0, from_ann, include_special)
+        t2r = self.config.relations_by_arg(1, to_ann, include_special)
 
         for r in t1r:
             if r in t2r:
@@ -1468,8 +1688,8 @@ class ProjectConfiguration(object):
         # TODO: this is O(NM) for relation counts N and M and goes
         # past much of the implemented caching. Might become a
         # bottleneck for annotations with large type systems.
-        t1r = get_relations_by_arg1(self.directory, inner, True)
-        t2r = get_relations_by_arg2(self.directory, outer, True)
+        t1r = self.config.relations_by_arg(0, inner, True)
+        t2r = self.config.relations_by_arg(1, outer, True)
 
         types = []
         for r in (s for s in t1r if s.storage_form()
@@ -1585,7 +1805,7 @@ class ProjectConfiguration(object):
 
             # relations
 
-            rels = get_relations_by_arg1(self.directory, t1, include_special)
+            rels = self.config.relations_by_arg(0, t1, include_special)
 
             for r in rels:
                 a = r.storage_form()
@@ -1611,7 +1831,7 @@ class ProjectConfiguration(object):
 
             # event arguments
 
-            n1 = get_node_by_storage_form(self.directory, t1)
+            n1 = self.config.node_by_storage_form(t1)
 
             for a, args in list(n1.arguments.items()):
                 if a in processed_as_relation:
@@ -1651,7 +1871,7 @@ class ProjectConfiguration(object):
         types.
         """
 
-        from_node = get_node_by_storage_form(self.directory, from_ann)
+        from_node = self.config.node_by_storage_form(from_ann)
 
         if from_node is None:
             Messager.warning(
@@ -1660,15 +1880,15 @@ class ProjectConfiguration(object):
             return []
 
         if to_ann == "<ANY>":
-            relations_from = get_relations_by_arg1(
-                self.directory, from_ann, include_special)
+            relations_from = self.config.relations_by_arg(
+                0, from_ann, include_special)
             # TODO: consider using from_node.arg_list instead of .arguments for
             # order
             return unique_preserve_order(
                 [role for role in from_node.arguments] + [r.storage_form() for r in relations_from])
 
         # specific hits
-        types = from_node.keys_by_type.get(to_ann, [])
+        types = list(from_node.keys_by_type.get(to_ann, []))
 
         if "<ANY>" in from_node.keys_by_type:
             types += from_node.keys_by_type["<ANY>"]
@@ -1689,7 +1909,7 @@ class ProjectConfiguration(object):
         """Returs a list of the possible attribute types for an annotation of
         the given type."""
         attrs = []
-        for attr in get_attribute_type_list(self.directory):
+        for attr in self.config.attribute_type_list:
             if attr == SEPARATOR_STR:
                 continue
 
@@ -1711,49 +1931,49 @@ class ProjectConfiguration(object):
         return attrs
 
     def get_labels(self):
-        return get_labels(self.directory)
+        return self.config.labels
 
     def get_kb_shortcuts(self):
-        return get_kb_shortcuts(self.directory)
+        return self.config.kb_shortcuts
 
     def get_access_control(self):
-        return get_access_control(self.directory)
+        return self.config.access_control
 
     def get_attribute_types(self):
         return [t.storage_form()
-                for t in get_attribute_type_list(self.directory)]
+                for t in self.config.attribute_type_list]
 
     def get_event_types(self):
-        return [t.storage_form() for t in get_event_type_list(self.directory)]
+        return [t.storage_form() for t in self.config.event_type_list]
 
     def get_relation_types(self):
         return [t.storage_form()
-                for t in get_relation_type_list(self.directory)]
+                for t in self.config.relation_type_list]
 
     def get_equiv_types(self):
         # equivalence relations are those relations that are symmetric
         # and transitive, i.e. that have "symmetric" and "transitive"
         # in their "<REL-TYPE>" special argument values.
-        return [t.storage_form() for t in get_relation_type_list(self.directory)
+        return [t.storage_form() for t in self.config.relation_type_list
                 if "<REL-TYPE>" in t.special_arguments and
                 "symmetric" in t.special_arguments["<REL-TYPE>"] and
                 "transitive" in t.special_arguments["<REL-TYPE>"]]
 
     def get_relations_by_type(self, _type):
-        return get_relations_by_storage_form(self.directory, _type)
+        return self.config.relations_by_storage_form(_type)
 
     def get_labels_by_type(self, _type):
-        return get_labels_by_storage_form(self.directory, _type)
+        return self.config.labels_by_storage_form(_type)
 
     def get_drawing_types(self):
-        return get_drawing_types(self.directory)
+        return self.config.drawing_types
 
     def get_drawing_config_by_type(self, _type):
-        return get_drawing_config_by_storage_form(self.directory, _type)
+        return self.config.drawing_config_by_storage_form(_type)
 
     def get_search_config(self):
         search_config = []
-        for r in get_search_config_list(self.directory):
+        for r in self.config.search_config_list:
             if '<URL>' not in r.special_arguments:
                 Messager.warning(
                     'Project configuration: config error: missing <URL> specification for %s search.' %
@@ -1788,18 +2008,18 @@ class ProjectConfiguration(object):
         return tool_config
 
     def get_disambiguator_config(self):
-        tool_list = get_disambiguator_config_list(self.directory)
+        tool_list = self.config.disambiguator_config_list
         return self._get_tool_config(tool_list)
 
     def get_annotator_config(self):
         # TODO: "annotator" is a very confusing term for a web service
         # that does automatic annotation in the context of a tool
         # where most annotators are expected to be human. Rethink.
-        tool_list = get_annotator_config_list(self.directory)
+        tool_list = self.config.annotator_config_list
         return self._get_tool_config(tool_list)
 
     def get_normalization_config(self):
-        norm_list = get_normalization_config_list(self.directory)
+        norm_list = self.config.normalization_config_list
         norm_config = []
         for n in norm_list:
             if 'DB' not in n.arguments:
@@ -1823,19 +2043,19 @@ class ProjectConfiguration(object):
         return norm_config
 
     def get_entity_types(self):
-        return [t.storage_form() for t in get_entity_type_list(self.directory)]
+        return [t.storage_form() for t in self.config.entity_type_list]
 
     def get_entity_type_hierarchy(self):
-        return get_entity_type_hierarchy(self.directory)
+        return self.config.annotation_configs[0][ENTITY_SECTION]
 
     def get_relation_type_hierarchy(self):
-        return get_relation_type_hierarchy(self.directory)
+        return self.config.annotation_configs[0][RELATION_SECTION]
 
     def get_event_type_hierarchy(self):
-        return get_event_type_hierarchy(self.directory)
+        return self.config.annotation_configs[0][EVENT_SECTION]
 
     def get_attribute_type_hierarchy(self):
-        return get_attribute_type_hierarchy(self.directory)
+        return self.config.annotation_configs[0][ATTRIBUTE_SECTION]
 
     def _get_filtered_attribute_type_hierarchy(self, types):
         from copy import deepcopy
@@ -1881,7 +2101,7 @@ class ProjectConfiguration(object):
     def preferred_display_form(self, t):
         """Given a storage form label, returns the preferred display form as
         defined by the label configuration (labels.conf)"""
-        labels = get_labels_by_storage_form(self.directory, t)
+        labels = self.config.labels_by_storage_form(t)
         if labels is None or len(labels) < 1:
             return t
         else:
@@ -16,6 +16,7 @@ Version:    2011-05-31
 """
 
 import re
+from contextvars import ContextVar
 
 # for cleaning up control chars from a string, from
 # http://stackoverflow.com/questions/92438/stripping-non-printable-characters-from-a-string-in-python
@@ -29,9 +30,21 @@ def remove_control_chars(s):
     return __control_char_re.sub('', s)
 
 
-class Messager:
-    __pending_messages = []
+# Messages for the client of the request being served, each request (see
+# wsgiapp.BratApplication) is served in a context of its own
+PENDING_MESSAGES = ContextVar('brat_pending_messages')
+
+
+def _pending_messages():
+    try:
+        return PENDING_MESSAGES.get()
+    except LookupError:
+        pending = []
+        PENDING_MESSAGES.set(pending)
+        return pending
 
+
+class Messager:
     def info(msg, duration=3, escaped=False):
         Messager.__message(msg, 'comment', duration, escaped)
     # decorator syntax only since python 2.4, staticmethod() since 2.2
@@ -49,8 +62,33 @@ class Messager:
         Messager.__message(msg, 'debug', duration, escaped)
     debug = staticmethod(debug)
 
+    def prepare_context():
+        # Messages added in contexts copied from the current one from here
+        # on (e.g. to run in another thread) are added to its messages
+        _pending_messages()
+    prepare_context = staticmethod(prepare_context)
+
+    def mark():
+        # Position in the messages of the request, see messages_since()
+        return len(_pending_messages())
+    mark = staticmethod(mark)
+
+    def messages_since(mark, remove=False):
+        # The messages added since mark() gave the given position (e.g. in
+        # building something cached), which add_messages() adds again
+        pending = _pending_messages()
+        messages = pending[mark:]
+        if remove:
+            del pending[mark:]
+        return messages
+    messages_since = staticmethod(messages_since)
+
+    def add_messages(messages):
+        _pending_messages().extend(messages)
+    add_messages = staticmethod(add_messages)
+
     def output(o):
-        for m, c, d in Messager.__pending_messages:
+        for m, c, d in _pending_messages():
             print(c, ":", m, file=o)
     output = staticmethod(output)
 
@@ -69,34 +107,32 @@ class Messager:
     def __output_json(json_dict):
         # protect against non-unicode inputs
         convertable_messages = []
-        for m in Messager.__pending_messages:
+        for m in _pending_messages():
             try:
                 m[0].encode('utf-8')
                 convertable_messages.append(m)
             except UnicodeDecodeError:
                 convertable_messages.append(
                     ('[ERROR: MESSAGE THAT CANNOT BE ENCODED AS UTF-8 OMITTED]', 'error', 5))
-        Messager.__pending_messages = convertable_messages
 
         # clean up messages by removing possible control characters
         # that may cause trouble clientside
         cleaned_messages = []
-        for s, t, r in Messager.__pending_messages:
+        for s, t, r in convertable_messages:
             cs = remove_control_chars(s)
             if cs != s:
                 s = cs + \
                     '[NOTE: SOME NONPRINTABLE CHARACTERS REMOVED FROM MESSAGE]'
             cleaned_messages.append((s, t, r))
-        Messager.__pending_messages = cleaned_messages
 
         # to avoid crowding the interface, combine messages with identical
         # content
         msgcount = {}
-        for m in Messager.__pending_messages:
+        for m in cleaned_messages:
             msgcount[m] = msgcount.get(m, 0) + 1
 
         merged_messages = []
-        for m in Messager.__pending_messages:
+        for m in cleaned_messages:
             if m in msgcount:
                 count = msgcount[m]
                 del msgcount[m]
@@ -108,7 +144,7 @@ class Messager:
         if 'messages' not in json_dict:
             json_dict['messages'] = []
         json_dict['messages'] += merged_messages
-        Messager.__pending_messages = []
+        PENDING_MESSAGES.set([])
         return json_dict
     __output_json = staticmethod(__output_json)
 
@@ -125,7 +161,7 @@ class Messager:
             msg = str(msg)
         if not escaped:
             msg = Messager.__escape(msg)
-        Messager.__pending_messages.append((msg, type, duration))
+        _pending_messages().append((msg, type, duration))
     __message = staticmethod(__message)
 
 
@@ -10,6 +10,11 @@ from string import ascii_lowercase as lowercase
 from string import digits
 from sys import maxsize as maxint
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DIGITS = set(digits)
 LOWERCASE = set(lowercase)
 TSURUOKA_2004_INS_CHEAP = set((' ', '-', ))
@@ -114,6 +119,101 @@ def tsuruoka_local(a, b, edge_insert_cost=1, max_cost=maxint):
         return max_cost
 
 
+# Larger than any cost in tsuruoka_local_batch(), see there
+_SEGMENT_OFFSET = 1 << 32
+
+
+def _tsuruoka_repl_costs(a_c, b_codes):
+    # costs of replacing a_c by each character of the candidates (as code
+    # points, -1 for padding)
+    costs = numpy.full(b_codes.shape, 50, dtype=numpy.int64)
+    for (x, y), cost in TSURUOKA_REPL.items():
+        if x == a_c:
+            costs[b_codes == ord(y)] = cost
+    return costs
+
+
+def tsuruoka_local_batch(a, bs, edge_insert_cost=1, max_cost=maxint):
+    """Returns [tsuruoka_local(a, b, edge_insert_cost, max_cost) for b in
+    bs], computing the alignments of a with all of bs at once if NumPy is
+    available."""
+    if numpy is None or len(a) == 0:
+        return [tsuruoka_local(a, b, edge_insert_cost, max_cost) for b in bs]
+
+    costs = [None] * len(bs)
+    todo = []
+    for k, b in enumerate(bs):
+        if len(b) == 0 or a in b:
+            # special cases, see tsuruoka_local()
+            costs[k] = tsuruoka_local(a, b, edge_insert_cost, max_cost)
+        else:
+            todo.append(k)
+    if not todo:
+        return costs
+
+    # one row per candidate, padded on the right; as no cell depends on
+    # cells to its right, the padding doesn't affect the others
+    lengths = numpy.array([len(bs[k]) for k in todo], dtype=numpy.int64)
+    width = int(lengths.max())
+    b_codes = numpy.full((len(todo), width), -1, dtype=numpy.int64)
+    ins_costs = numpy.full((len(todo), width), 100, dtype=numpy.int64)
+    for row, k in enumerate(todo):
+        b = bs[k]
+        b_codes[row, :len(b)] = [ord(c) for c in b]
+        ins_costs[row, :len(b)] = [TSURUOKA_INS.get(c, 100) for c in b]
+    # cumulative insertion costs up to each column, for taking the
+    # minimum over any run of insertions at once
+    ins_cumulative = numpy.zeros((len(todo), width + 1), dtype=numpy.int64)
+    numpy.cumsum(ins_costs, axis=1, out=ins_cumulative[:, 1:])
+    columns = numpy.arange(width + 1)
+    padding = columns[None, :] > lengths[:, None]
+    rows = numpy.array(todo)
+
+    # any sequence of initial inserts has edge_insert_cost
+    prev_min_col = numpy.tile(columns * edge_insert_cost, (len(todo), 1))
+    for a_c in a:
+        del_cost = TSURUOKA_DEL.get(a_c, 100)
+        match = b_codes == ord(a_c)
+        curr_min_col = numpy.empty_like(prev_min_col)
+        curr_min_col[:, 0] = prev_min_col[:, 0] + del_cost
+        curr_min_col[:, 1:] = numpy.where(
+            match, prev_min_col[:, :-1],
+            numpy.minimum(prev_min_col[:, 1:] + del_cost,
+                          prev_min_col[:, :-1] +
+                          _tsuruoka_repl_costs(a_c, b_codes)))
+        # then insertions, i.e. the min over j' <= j of col[j'] plus the
+        # inserts after j'. Matches take the diagonal as is, so this is
+        # done for the segments starting at each match separately, offset
+        # so that later ones always win.
+        offsets = numpy.zeros_like(curr_min_col)
+        numpy.cumsum(match, axis=1, out=offsets[:, 1:])
+        offsets = ins_cumulative + offsets * _SEGMENT_OFFSET
+        curr_min_col = offsets + numpy.minimum.accumulate(
+            curr_min_col - offsets, axis=1)
+
+        # early return for the candidates that can't get below max_cost
+        row_min = numpy.where(padding, maxint, curr_min_col).min(axis=1)
+        done = row_min >= max_cost
+        if done.any():
+            for k in rows[done]:
+                costs[k] = max_cost
+            keep = ~done
+            if not keep.any():
+                return costs
+            rows, lengths, padding = rows[keep], lengths[keep], padding[keep]
+            b_codes, ins_cumulative = b_codes[keep], ins_cumulative[keep]
+            curr_min_col = curr_min_col[keep]
+        prev_min_col = curr_min_col
+
+    # any number of trailing inserts have edge_insert_cost
+    trailing = (lengths[:, None] - columns[None, :]) * edge_insert_cost
+    min_costs = numpy.where(padding, maxint,
+                            curr_min_col + trailing).min(axis=1)
+    for k, cost in zip(rows.tolist(), min_costs.tolist()):
+        costs[k] = cost if cost < max_cost else max_cost
+    return costs
+
+
 def tsuruoka_norm(a, b):
     return 1 - (tsuruoka(a, b) / (max(len(a), len(b)) * 100.))
 
@@ -8,9 +8,13 @@
 
 
 import re
+import sys
+from functools import partial
 
 import annotation
+from docpool import map_documents
 from message import Messager
+from spanindex import TextBoundIndex
 
 # Constants
 DEFAULT_EMPTY_STRING = "***"
@@ -148,6 +152,113 @@ class NoteMatch(object):
         assert False, "INTERNAL ERROR: not implemented"
 
 
+def _load_annotations(fn):
+    """Helper for __filenames_to_annotations and _search_document, returns
+    the Annotations object for the given file name or None if it can't be
+    loaded."""
+    try:
+        # remove suffixes for Annotations to prompt parsing of all
+        # annotation files.
+        nosuff_fn = fn.replace(
+            ".ann",
+            "").replace(
+            ".a1",
+            "").replace(
+            ".a2",
+            "").replace(
+            ".rel",
+            "")
+        return annotation.TextAnnotations(nosuff_fn, read_only=True)
+    except annotation.AnnotationFileNotFoundError:
+        print("%s:\tFailed: file not found" % fn, file=sys.stderr)
+    except annotation.AnnotationNotFoundError as e:
+        print("%s:\tFailed: %s" % (fn, e), file=sys.stderr)
+    return None
+
+
+class _MatchedDocument(object):
+    """Stands in for the Annotations object of a document searched in a
+    worker process (see _search_document), holding only what
+    format_results() needs: the document, its text and the annotations that
+    the matches refer to."""
+
+    def __init__(self, ann_obj, anns):
+        self._document = ann_obj.get_document()
+        self._document_text = ann_obj.get_document_text()
+        self._ann_by_id = {}
+        for ann in anns:
+            ids = list(getattr(ann, 'entities', []))
+            for attr in ('trigger', 'arg1', 'arg2'):
+                if hasattr(ann, attr):
+                    ids.append(getattr(ann, attr))
+            for id in ids:
+                try:
+                    self._ann_by_id[id] = ann_obj.get_ann_by_id(id)
+                except annotation.AnnotationNotFoundError:
+                    pass
+
+    def get_document(self):
+        return self._document
+
+    def get_document_text(self):
+        return self._document_text
+
+    def get_ann_by_id(self, id):
+        try:
+            return self._ann_by_id[id]
+        except KeyError:
+            raise annotation.AnnotationNotFoundError(id)
+
+
+def _search_document(search, fn):
+    """Helper for __search_filenames, returns the (ann_obj, ann) matches of
+    the search in the given file, with a _MatchedDocument for ann_obj, or
+    None if it can't be loaded."""
+    ann_obj = _load_annotations(fn)
+    if ann_obj is None:
+        return None
+    anns = [ann for _, ann in search([ann_obj], max_results=-1).get_matches()]
+    if not anns:
+        return []
+    matched = _MatchedDocument(ann_obj, anns)
+    return [(matched, ann) for ann in anns]
+
+
+def __search_filenames(search, filenames, sort=True):
+    """Runs the search (a search_anns_for_ function taking only the
+    Annotations objects) over the documents in the given files, in
+    parallel (see docpool), returning what it would return for all of them
+    at once. sort is False for searches that don't sort the matches by
+    document."""
+    mark = Messager.mark()
+    matches = search([])
+    if Messager.mark() != mark:
+        # The query itself is at fault (e.g. an invalid regular expression)
+        return matches
+
+    for doc_matches in map_documents(partial(_search_document, search),
+                                     filenames):
+        if doc_matches is None:
+            continue
+        for ann_obj, ann in doc_matches:
+            matches.add_match(ann_obj, ann)
+
+        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
+        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
+            Messager.warning(
+                'Search result limit (%d) exceeded, stopping search.' %
+                MAX_SEARCH_RESULT_NUMBER)
+            break
+
+    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+
+    if sort:
+        # sort by document name for output
+        matches.sort_matches()
+
+    return matches
+
+
 def __filenames_to_annotations(filenames):
     """Given file names, returns corresponding Annotations objects."""
 
@@ -158,26 +269,8 @@ def __filenames_to_annotations(filenames):
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
 
-    anns = []
-    for fn in filenames:
-        try:
-            # remove suffixes for Annotations to prompt parsing of all
-            # annotation files.
-            nosuff_fn = fn.replace(
-                ".ann",
-                "").replace(
-                ".a1",
-                "").replace(
-                ".a2",
-                "").replace(
-                ".rel",
-                "")
-            ann_obj = annotation.TextAnnotations(nosuff_fn, read_only=True)
-            anns.append(ann_obj)
-        except annotation.AnnotationFileNotFoundError:
-            print("%s:\tFailed: file not found" % fn, file=sys.stderr)
-        except annotation.AnnotationNotFoundError as e:
-            print("%s:\tFailed: %s" % (fn, e), file=sys.stderr)
+    anns = [ann_obj for ann_obj in map(_load_annotations, filenames)
+            if ann_obj is not None]
 
     if len(anns) != len(filenames):
         print("Note: only checking %d/%d given files" % (
@@ -191,8 +284,13 @@ def __filenames_to_annotations(filenames):
     return anns
 
 
-def __directory_to_annotations(directory):
-    """Given a directory, returns Annotations objects for contained files."""
+def __directory_to_filenames(directory, index_query=None):
+    """Given a directory, returns the contained files (without suffix).
+
+    If index_query is given, only documents that the collection search
+    index deems possible matches for it are included (see
+    searchindex.filter_documents for the keyword arguments).
+    """
     # TODO: put this shared functionality in a more reasonable place
     from document import real_directory, _listdir
     from os.path import join as path_join
@@ -201,9 +299,16 @@ def __directory_to_annotations(directory):
     # Get the document names
     base_names = [fn[0:-4] for fn in _listdir(real_dir) if fn.endswith('txt')]
 
-    filenames = [path_join(real_dir, bn) for bn in base_names]
+    if index_query is not None:
+        from searchindex import filter_documents
+        base_names = filter_documents(real_dir, base_names, **index_query)
 
-    return __filenames_to_annotations(filenames)
+    return [path_join(real_dir, bn) for bn in base_names]
+
+
+def __directory_to_annotations(directory):
+    """Given a directory, returns Annotations objects for contained files."""
+    return __filenames_to_annotations(__directory_to_filenames(directory))
 
 
 def __document_to_annotations(directory, document):
@@ -242,6 +347,27 @@ def __doc_or_dir_to_annotations(directory, document, scope):
         return []
 
 
+def __doc_or_dir_search(directory, document, scope, search,
+                        index_query=None, sort=True):
+    """Runs the search (see __search_filenames) over the document or the
+    directory selected by scope (see __doc_or_dir_to_annotations), in the
+    latter case only over the documents possibly matching index_query."""
+    if scope == "collection":
+        return __search_filenames(
+            search, __directory_to_filenames(directory, index_query), sort)
+    return search(__doc_or_dir_to_annotations(directory, document, scope))
+
+
+def _index_query(kinds, types, text, text_match):
+    """Helper for the brat interface functions, returns the query narrowing
+    down the documents to search in a collection (see
+    __directory_to_filenames)."""
+    if text == '' or text == DEFAULT_EMPTY_STRING:
+        text = None
+    return {'kinds': kinds, 'types': types, 'text': text,
+            'text_match': text_match}
+
+
 def _get_text_type_ann_map(
         ann_objs,
         restrict_types=None,
@@ -278,29 +404,25 @@ def _get_text_type_ann_map(
 def _get_offset_ann_map(ann_objs, restrict_types=None, ignore_types=None):
     """Helper function for search.
 
-    Given annotations, returns a dict mapping offsets in text into the
-    set of annotations spanning each offset.
+    Given annotations, returns a TextBoundIndex over the spans of their
+    textbounds, giving e.g. the annotations spanning each offset in text
+    with spanning(offset).
     """
 
     # treat None and empty list uniformly
     restrict_types = [] if restrict_types is None else restrict_types
     ignore_types = [] if ignore_types is None else ignore_types
 
-    offset_ann_map = {}
+    textbounds = []
     for ann_obj in ann_objs:
         for t in ann_obj.get_textbounds():
             if t.type in ignore_types:
                 continue
             if restrict_types != [] and t.type not in restrict_types:
                 continue
+            textbounds.append(t)
 
-            for t_start, t_end in t.spans:
-                for o in range(t_start, t_end):
-                    if o not in offset_ann_map:
-                        offset_ann_map[o] = set()
-                    offset_ann_map[o].add(t)
-
-    return offset_ann_map
+    return TextBoundIndex(textbounds)
 
 
 def eq_text_neq_type_spans(
@@ -494,10 +616,10 @@ def eq_text_partially_marked(
                 # inconsistent (for this check) if the current span
                 # has no fully covering tagging. Note that type
                 # matching is not considered here.
-                start_spanning = offset_ann_map.get(start_offset, set())
-                # NOTE: -1 needed, see _get_offset_ann_map()
-                end_spanning = offset_ann_map.get(end_offset - 1, set())
-                if len(start_spanning & end_spanning) == 0:
+                start_spanning = set(offset_ann_map.spanning(start_offset))
+                # NOTE: -1 needed, end offsets are exclusive
+                end_spanning = offset_ann_map.spanning(end_offset - 1)
+                if not start_spanning.intersection(end_spanning):
                     if s not in text_untagged_map:
                         text_untagged_map[s] = []
                     text_untagged_map[s].append(
@@ -645,13 +767,17 @@ def _get_match_regex(text, text_match="word", match_case=False,
 def search_anns_for_textbound(ann_objs, text, restrict_types=None,
                               ignore_types=None, nested_types=None,
                               text_match="word", match_case=False,
-                              entities_only=False):
+                              entities_only=False, max_results=None):
     """Searches for the given text in the Textbound annotations in the given
     Annotations objects.
 
-    Returns a SearchMatchSet object.
+    Returns a SearchMatchSet object with at most max_results matches
+    (MAX_SEARCH_RESULT_NUMBER if None, unlimited if <= 0).
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -680,6 +806,8 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
     for ann_obj in ann_objs:
         # collect per-document (ann_obj) for sorting
         ann_matches = []
+        # built on first need
+        span_index = None
 
         if entities_only:
             candidates = ann_obj.get_textbounds()
@@ -695,8 +823,10 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
                     DEFAULT_EMPTY_STRING and not match_regex.search(t.get_text())):
                 continue
             if nested_types != []:
-                # TODO: massively inefficient
-                nested = [x for x in ann_obj.get_textbounds()
+                if span_index is None:
+                    span_index = TextBoundIndex(ann_obj.get_textbounds())
+                nested = [x for x in span_index.within(t.first_start(),
+                                                       t.last_end())
                           if x != t and t.contains(x)]
                 if len([x for x in nested if x.type in nested_types]) == 0:
                     continue
@@ -710,14 +840,14 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
         for t in ann_matches:
             matches.add_match(ann_obj, t)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
             Messager.warning(
                 'Search result limit (%d) exceeded, stopping search.' %
-                MAX_SEARCH_RESULT_NUMBER)
+                max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     # sort by document name for output
     matches.sort_matches()
@@ -732,13 +862,18 @@ def search_anns_for_textbound(ann_objs, text, restrict_types=None,
 
 def search_anns_for_note(ann_objs, text, category,
                          restrict_types=None, ignore_types=None,
-                         text_match="word", match_case=False):
+                         text_match="word", match_case=False,
+                         max_results=None):
     """Searches for the given text in the comment annotations in the given
     Annotations objects.
 
-    Returns a SearchMatchSet object.
+    Returns a SearchMatchSet object with at most max_results matches
+    (MAX_SEARCH_RESULT_NUMBER if None, unlimited if <= 0).
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -788,14 +923,14 @@ def search_anns_for_note(ann_objs, text, category,
         for t in ann_matches:
             matches.add_match(ann_obj, t)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
             Messager.warning(
                 'Search result limit (%d) exceeded, stopping search.' %
-                MAX_SEARCH_RESULT_NUMBER)
+                max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     # sort by document name for output
     matches.sort_matches()
@@ -810,13 +945,18 @@ def search_anns_for_note(ann_objs, text, category,
 
 def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
                              restrict_types=None, ignore_types=None,
-                             text_match="word", match_case=False):
+                             text_match="word", match_case=False,
+                             max_results=None):
     """Searches the given Annotations objects for relation annotations matching
     the given specification.
 
-    Returns a SearchMatchSet object.
+    Returns a SearchMatchSet object with at most max_results matches
+    (MAX_SEARCH_RESULT_NUMBER if None, unlimited if <= 0).
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -915,14 +1055,14 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
         for r in ann_matches:
             matches.add_match(ann_obj, r)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
             Messager.warning(
                 'Search result limit (%d) exceeded, stopping search.' %
-                MAX_SEARCH_RESULT_NUMBER)
+                max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     # sort by document name for output
     matches.sort_matches()
@@ -937,13 +1077,18 @@ def search_anns_for_relation(ann_objs, arg1, arg1type, arg2, arg2type,
 
 def search_anns_for_event(ann_objs, trigger_text, args,
                           restrict_types=None, ignore_types=None,
-                          text_match="word", match_case=False):
+                          text_match="word", match_case=False,
+                          max_results=None):
     """Searches the given Annotations objects for Event annotations matching
     the given specification.
 
-    Returns a SearchMatchSet object.
+    Returns a SearchMatchSet object with at most max_results matches
+    (MAX_SEARCH_RESULT_NUMBER if None, unlimited if <= 0).
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -1055,14 +1200,14 @@ def search_anns_for_event(ann_objs, trigger_text, args,
         for t_obj, e in ann_matches:
             matches.add_match(ann_obj, e)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
             Messager.warning(
                 'Search result limit (%d) exceeded, stopping search.' %
-                MAX_SEARCH_RESULT_NUMBER)
+                max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     # sort by document name for output
     matches.sort_matches()
@@ -1082,13 +1227,18 @@ def search_anns_for_text(
         ignore_types=None,
         nested_types=None,
         text_match="word",
-        match_case=False):
+        match_case=False,
+        max_results=None):
     """Searches for the given text in the document texts of the given
     Annotations objects.
 
-    Returns a SearchMatchSet object.
+    Returns a SearchMatchSet object with at most max_results matches
+    (MAX_SEARCH_RESULT_NUMBER if None, unlimited if <= 0).
     """
 
+    if max_results is None:
+        max_results = MAX_SEARCH_RESULT_NUMBER
+
     global REPORT_SEARCH_TIMINGS
     if REPORT_SEARCH_TIMINGS:
         process_start = datetime.now()
@@ -1117,20 +1267,18 @@ def search_anns_for_text(
     # main search loop
     for ann_obj in ann_objs:
         doctext = ann_obj.get_document_text()
+        # built on first need
+        span_index = None
 
         for m in match_regex.finditer(doctext):
             # only need to care about embedding annotations if there's
             # some annotation-based restriction
-            # if restrict_types == [] and ignore_types == []:
-            # TODO: _extremely_ naive and slow way to find embedding
-            # annotations.  Use some reasonable data structure
-            # instead.
             embedding = []
             # if there are no type restrictions, we can skip this bit
             if restrict_types != [] or ignore_types != []:
-                for t in ann_obj.get_textbounds():
-                    if t.contains(m):
-                        embedding.append(t)
+                if span_index is None:
+                    span_index = TextBoundIndex(ann_obj.get_textbounds())
+                embedding = span_index.containing(m.start(), m.end())
 
             # Note interpretation of ignore_types here: if the text
             # span is embedded in one or more of the ignore_types or
@@ -1149,14 +1297,14 @@ def search_anns_for_text(
             tm = TextMatch(m.start(), m.end(), m.group())
             matches.add_match(ann_obj, tm)
 
-        # MAX_SEARCH_RESULT_NUMBER <= 0 --> no limit
-        if len(matches) > MAX_SEARCH_RESULT_NUMBER and MAX_SEARCH_RESULT_NUMBER > 0:
+        # max_results <= 0 --> no limit
+        if len(matches) > max_results and max_results > 0:
             Messager.warning(
                 'Search result limit (%d) exceeded, stopping search.' %
-                MAX_SEARCH_RESULT_NUMBER)
+                max_results)
             break
 
-    matches.limit_to(MAX_SEARCH_RESULT_NUMBER)
+    matches.limit_to(max_results)
 
     if REPORT_SEARCH_TIMINGS:
         process_delta = datetime.now() - process_start
@@ -1412,11 +1560,12 @@ def search_text(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
-    matches = search_anns_for_text(ann_objs, text,
-                                   text_match=text_match,
-                                   match_case=match_case)
+    matches = __doc_or_dir_search(
+        directory, document, scope,
+        partial(search_anns_for_text, text=text,
+                text_match=text_match,
+                match_case=match_case),
+        _index_query(None, None, text, text_match), sort=False)
 
     results = format_results(matches, concordancing, context_length)
     results['collection'] = directory
@@ -1435,16 +1584,17 @@ def search_entity(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
 
-    matches = search_anns_for_textbound(ann_objs, text,
-                                        restrict_types=restrict_types,
-                                        text_match=text_match,
-                                        match_case=match_case)
+    matches = __doc_or_dir_search(
+        directory, document, scope,
+        partial(search_anns_for_textbound, text=text,
+                restrict_types=restrict_types,
+                text_match=text_match,
+                match_case=match_case),
+        _index_query(('entity', ), restrict_types, text, text_match))
 
     results = format_results(matches, concordancing, context_length)
     results['collection'] = directory
@@ -1463,16 +1613,17 @@ def search_note(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
 
-    matches = search_anns_for_note(ann_objs, text, category,
-                                   restrict_types=restrict_types,
-                                   text_match=text_match,
-                                   match_case=match_case)
+    matches = __doc_or_dir_search(
+        directory, document, scope,
+        partial(search_anns_for_note, text=text, category=category,
+                restrict_types=restrict_types,
+                text_match=text_match,
+                match_case=match_case),
+        _index_query(('note', ), restrict_types, text, text_match))
 
     results = format_results(matches, concordancing, context_length)
     results['collection'] = directory
@@ -1491,8 +1642,6 @@ def search_event(collection, document, scope="collection",
     concordancing = _to_bool(concordancing)
     match_case = _to_bool(match_case)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
@@ -1504,10 +1653,13 @@ def search_event(collection, document, scope="collection",
     from jsonwrap import loads
     args = loads(args)
 
-    matches = search_anns_for_event(ann_objs, trigger, args,
-                                    restrict_types=restrict_types,
-                                    text_match=text_match,
-                                    match_case=match_case)
+    matches = __doc_or_dir_search(
+        directory, document, scope,
+        partial(search_anns_for_event, trigger_text=trigger, args=args,
+                restrict_types=restrict_types,
+                text_match=text_match,
+                match_case=match_case),
+        _index_query(('event', ), restrict_types, trigger, text_match))
 
     results = format_results(matches, concordancing, context_length)
     results['collection'] = directory
@@ -1530,17 +1682,18 @@ def search_relation(collection, document, scope="collection",
     show_text = _to_bool(show_text)
     show_type = _to_bool(show_type)
 
-    ann_objs = __doc_or_dir_to_annotations(directory, document, scope)
-
     restrict_types = []
     if type is not None and type != "":
         restrict_types.append(type)
 
-    matches = search_anns_for_relation(ann_objs, arg1, arg1type,
-                                       arg2, arg2type,
-                                       restrict_types=restrict_types,
-                                       text_match=text_match,
-                                       match_case=match_case)
+    matches = __doc_or_dir_search(
+        directory, document, scope,
+        partial(search_anns_for_relation, arg1=arg1, arg1type=arg1type,
+                arg2=arg2, arg2type=arg2type,
+                restrict_types=restrict_types,
+                text_match=text_match,
+                match_case=match_case),
+        _index_query(('relation', ), restrict_types, None, text_match))
 
     results = format_results(matches, concordancing, context_length,
                              show_text, show_type)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+"""Persistent per-collection index for narrowing down collection searches.
+
+Searching a collection otherwise means parsing every document in it. The
+index, an SQLite database for each collection in the work directory, holds
+a postings list of the word tokens of each document text (token ->
+documents) and a table of the textbounds, events, relations and
+notes of each document by type, with their text. It is brought up to date
+incrementally before each use, re-indexing only documents whose files have
+changed, for at most SEARCH_INDEX_UPDATE_TIME seconds; the documents left
+over are candidates for any search until a later search indexes them.
+
+The index only selects the documents that may contain matches, the
+searches themselves are still run over the (parsed) candidates, so the
+results are the same as for a full scan. Queries that can't be narrowed
+down (e.g. regular expressions) select every document.
+"""
+
+import re
+import sqlite3 as sqlite
+from hashlib import sha1
+from logging import info as log_info
+from os import makedirs
+from os.path import abspath
+from os.path import join as path_join
+from time import time
+from unicodedata import normalize
+
+from anncache import document_signature
+from annotation import JOINED_ANN_FILE_SUFF, TextAnnotations
+
+# Directory for the collection indices (disabled if None)
+try:
+    from config import SEARCH_INDEX_DIR
+except ImportError:
+    try:
+        from config import WORK_DIR
+        SEARCH_INDEX_DIR = path_join(WORK_DIR, 'search')
+    except ImportError:
+        SEARCH_INDEX_DIR = None
+
+# Constants
+# Bump when the schema or the contents change to force a rebuild
+SEARCH_INDEX_VERSION = 3
+# Seconds to wait for another process updating the index
+SEARCH_INDEX_TIMEOUT = 60
+# Seconds a search may spend (re-)indexing documents
+SEARCH_INDEX_UPDATE_TIME = 5
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+###
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    signature TEXT NOT NULL,
+    indexed INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term_id INTEGER NOT NULL,
+    doc_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS postings_term ON postings (term_id);
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+CREATE TABLE IF NOT EXISTS annotations (
+    doc_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    type TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS annotations_kind ON annotations (kind, type);
+CREATE INDEX IF NOT EXISTS annotations_doc ON annotations (doc_id);
+"""
+
+
+class _FoldTable(dict):
+    """str.translate() table mapping every character to one that all the
+    characters it matches case-insensitively in a regular expression map
+    to, e.g. "I", "i", "\u0131" and "\u0130" to "i". Unlike casefold(),
+    this never changes the length of a string (e.g. "\u00df" stays as it
+    is, as in regular expressions)."""
+
+    def __missing__(self, code):
+        c = chr(code)
+        folded = c.upper().lower()
+        if len(folded) != 1:
+            # Characters without a single character upper case (e.g.
+            # "\u00df", ligatures) and dotted capital I
+            folded = normalize('NFKC', c).lower()[:1] or c
+        self[code] = folded
+        return folded
+
+
+_FOLD_TABLE = _FoldTable()
+
+
+def _term(token):
+    # Folding case the way regular expressions do makes the terms match
+    # at least whatever a case-insensitive search would
+    return token.translate(_FOLD_TABLE)
+
+
+def _text_terms(text):
+    """Returns the set of terms in the text."""
+    return set(_term(token) for token in TOKEN_RE.findall(text))
+
+
+def _query_terms(text, text_match, whole_match):
+    """Returns a list of (term, exact) pairs that any text matching the
+    query must contain, exact being True if the term must be a whole
+    token, or None if the query can't be narrowed down this way.
+
+    whole_match is True if the match can only start and end at token
+    boundaries of the searched text, as is the case for "word" matches in
+    document texts but not in annotation texts.
+    """
+    if text is None or text_match not in ('word', 'substring'):
+        return None
+    tokens = list(TOKEN_RE.finditer(text))
+    if not tokens:
+        return None
+    terms = []
+    for m in tokens:
+        # Tokens followed or preceded by something in the query are
+        # bounded by it in the matched text as well
+        bounded_left = m.start() > 0 or whole_match
+        bounded_right = m.end() < len(text) or whole_match
+        terms.append((_term(m.group()), bounded_left and bounded_right))
+    return terms
+
+
+def _annotation_rows(ann_obj):
+    """Yields a (kind, type, text) row for each searchable annotation."""
+    entities = set(t.id for t in ann_obj.get_entities())
+    for t in ann_obj.get_textbounds():
+        kind = 'entity' if t.id in entities else 'trigger'
+        yield kind, t.type, t.get_text()
+    for e in ann_obj.get_events():
+        try:
+            text = ann_obj.get_ann_by_id(e.trigger).get_text()
+        except Exception:
+            text = ''
+        yield 'event', e.type, text
+    for r in ann_obj.get_relations():
+        yield 'relation', r.type, ''
+    for r in ann_obj.get_equivs():
+        yield 'relation', r.type, ''
+    for n in ann_obj.get_oneline_comments():
+        try:
+            target_type = ann_obj.get_ann_by_id(n.target).type
+        except Exception:
+            target_type = ''
+        yield 'note', target_type, n.get_text()
+
+
+def _index_path(directory):
+    key = sha1(abspath(directory).encode('utf-8', 'surrogatepass')).hexdigest()
+    return path_join(SEARCH_INDEX_DIR, key + '.sqlite')
+
+
+class SearchIndex(object):
+    def __init__(self, directory):
+        self.directory = directory
+        makedirs(SEARCH_INDEX_DIR, exist_ok=True)
+        self.db_path = _index_path(directory)
+        self.connection = sqlite.connect(self.db_path,
+                                         timeout=SEARCH_INDEX_TIMEOUT)
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != SEARCH_INDEX_VERSION:
+            with self.connection:
+                for table in ('documents', 'terms', 'postings', 'annotations'):
+                    self.connection.execute('DROP TABLE IF EXISTS %s' % table)
+                self.connection.executescript(_SCHEMA)
+                self.connection.execute(
+                    'PRAGMA user_version = %d' % SEARCH_INDEX_VERSION)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _term_id(self, term):
+        cursor = self.connection.execute(
+            'SELECT id FROM terms WHERE term = ?', (term, ))
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+        return self.connection.execute(
+            'INSERT INTO terms (term) VALUES (?)', (term, )).lastrowid
+
+    def _remove_document(self, doc_id):
+        for table in ('postings', 'annotations'):
+            self.connection.execute(
+                'DELETE FROM %s WHERE doc_id = ?' % table, (doc_id, ))
+        self.connection.execute('DELETE FROM documents WHERE id = ?',
+                                (doc_id, ))
+
+    def _add_document(self, name, signature):
+        if signature is None:
+            # Left for later, a candidate for any search until then
+            self.connection.execute(
+                'INSERT INTO documents (name, signature, indexed) '
+                'VALUES (?, ?, 0)', (name, ''))
+            return
+
+        document = path_join(self.directory, name)
+        try:
+            ann_obj = TextAnnotations(document, read_only=True)
+            # Partial annotation files aren't covered by the signature
+            indexed = ann_obj._input_files == [
+                document + '.' + JOINED_ANN_FILE_SUFF]
+        except Exception as e:
+            log_info('Not indexing "%s" for search: %s' % (document, e))
+            ann_obj, indexed = None, False
+
+        # Documents that are not indexed are candidates for any search
+        doc_id = self.connection.execute(
+            'INSERT INTO documents (name, signature, indexed) VALUES (?, ?, ?)',
+            (name, signature, int(indexed))).lastrowid
+        if not indexed:
+            return
+
+        self.connection.executemany(
+            'INSERT INTO postings (term_id, doc_id) VALUES (?, ?)',
+            ((self._term_id(term), doc_id)
+             for term in _text_terms(ann_obj.get_document_text())))
+        self.connection.executemany(
+            'INSERT INTO annotations (doc_id, kind, type, text) '
+            'VALUES (?, ?, ?, ?)',
+            ((doc_id, kind, type, _term(text))
+             for kind, type, text in _annotation_rows(ann_obj)))
+
+    def update(self, base_names, max_time=SEARCH_INDEX_UPDATE_TIME):
+        """Re-index the documents that have changed since they were last
+        indexed and drop the ones no longer among base_names. Documents
+        still to be re-indexed after max_time seconds are left unindexed."""
+        indexed = dict((name, (doc_id, signature)) for doc_id, name, signature
+                       in self.connection.execute(
+                           'SELECT id, name, signature FROM documents'))
+        deadline = time() + max_time
+        with self.connection:
+            for name in base_names:
+                signature = repr(document_signature(
+                    path_join(self.directory, name)))
+                doc_id, old_signature = indexed.pop(name, (None, None))
+                if signature == old_signature:
+                    continue
+                if doc_id is not None:
+                    if old_signature == '' and time() > deadline:
+                        continue
+                    self._remove_document(doc_id)
+                self._add_document(name, signature if time() <= deadline
+                                   else None)
+            for doc_id, _ in indexed.values():
+                self._remove_document(doc_id)
+
+    def _doc_ids(self, query, params):
+        return set(row[0] for row in self.connection.execute(query, params))
+
+    def text_candidates(self, text, text_match):
+        """Returns the ids of the documents whose text may match the given
+        search_anns_for_text() query, or None if all may."""
+        terms = _query_terms(text, text_match, text_match == 'word')
+        if terms is None:
+            return None
+        doc_ids = None
+        for term, exact in terms:
+            if exact:
+                condition = 't.term = ?'
+            else:
+                condition = 'instr(t.term, ?) > 0'
+            term_doc_ids = self._doc_ids(
+                'SELECT DISTINCT p.doc_id FROM terms t '
+                'JOIN postings p ON p.term_id = t.id WHERE ' + condition,
+                (term, ))
+            if doc_ids is None:
+                doc_ids = term_doc_ids
+            else:
+                doc_ids &= term_doc_ids
+        return doc_ids
+
+    def annotation_candidates(self, kinds, types=None, text=None,
+                              text_match='word'):
+        """Returns the ids of the documents with annotations of the given
+        kinds ('entity', 'trigger', 'event', 'relation' or 'note') and types
+        (all if None) whose text may match the given query."""
+        conditions = ['kind IN (%s)' % ', '.join('?' for _ in kinds)]
+        params = list(kinds)
+        if types:
+            conditions.append('type IN (%s)' % ', '.join('?' for _ in types))
+            params.extend(types)
+        # The annotation text is matched as a whole, so the terms can be
+        # anywhere in it
+        terms = _query_terms(text, text_match, False)
+        if terms is not None:
+            for term, _ in terms:
+                conditions.append('instr(text, ?) > 0')
+                params.append(term)
+        return self._doc_ids(
+            'SELECT DISTINCT doc_id FROM annotations WHERE ' +
+            ' AND '.join(conditions), params)
+
+    def filter_documents(self, base_names, doc_ids):
+        """Returns the base_names that are among doc_ids or not indexed, in
+        the given order."""
+        if doc_ids is None:
+            return base_names
+        selected = set(name for doc_id, name, indexed in self.connection.execute(
+            'SELECT id, name, indexed FROM documents')
+            if doc_id in doc_ids or not indexed)
+        return [name for name in base_names if name in selected]
+
+
+def filter_documents(directory, base_names, kinds=None, types=None,
+                     text=None, text_match='word'):
+    """Returns the subset of the documents in the directory (as base names)
+    that may contain matches to a search, in the given order.
+
+    If kinds is None, the search is for text in the documents texts,
+    otherwise for annotations of the given kinds (see
+    SearchIndex.annotation_candidates). text is None if the search has no
+    text constraint. Returns all the documents if the index can't be used.
+    """
+    if SEARCH_INDEX_DIR is None:
+        return base_names
+    try:
+        with SearchIndex(directory) as index:
+            index.update(base_names)
+            if kinds is None:
+                doc_ids = index.text_candidates(text, text_match)
+            else:
+                doc_ids = index.annotation_candidates(kinds, types, text,
+                                                      text_match)
+            return index.filter_documents(base_names, doc_ids)
+    except (sqlite.Error, OSError) as e:
+        # Most likely a work directory we can't write to
+        log_info('Search index for "%s" unavailable, searching all documents: %s'
+                 % (directory, e))
+        return base_names
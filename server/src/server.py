@@ -19,8 +19,6 @@ from os.path import abspath
 from sys import stderr, version_info
 from time import time
 
-from _thread import allocate_lock
-
 # Constants
 # This handling of version_info is strictly for backwards compatibility
 PY_VER_STR = '%d.%d.%d-%s-%d' % tuple(version_info)
@@ -29,7 +27,6 @@ REQUIRED_PY_VERSION_STR = '%d.%d.%d-%s-%d' % tuple(REQUIRED_PY_VERSION)
 JSON_HDR = ('Content-Type', 'application/json')
 CONF_FNAME = 'config.py'
 CONF_TEMPLATE_FNAME = 'config_template.py'
-CONFIG_CHECK_LOCK = allocate_lock()
 ###
 
 
@@ -85,49 +82,34 @@ def _miss_config_msg():
 def _config_check():
     from message import Messager
 
-    from sys import path
-    from copy import deepcopy
-    from os.path import dirname
-    # Reset the path to force config.py to be in the root (could be hacked
-    #       using __init__.py, but we can be monkey-patched anyway)
-    orig_path = deepcopy(path)
-
-    try:
-        # Can't you empty in O(1) instead of O(N)?
-        while path:
-            path.pop()
-        path.append(path_join(abspath(dirname(__file__)), '../..'))
-        # Check if we have a config, otherwise whine
-        try:
-            import config
-            del config
-        except ImportError as e:
-            path.extend(orig_path)
-            # "Prettiest" way to check specific failure
-            if e.message == 'No module named config':
-                Messager.error(_miss_config_msg(), duration=-1)
-            else:
-                Messager.error(_get_stack_trace(), duration=-1)
+    from sys import modules
+    from os.path import dirname, isfile
+    from importlib.util import module_from_spec, spec_from_file_location
+
+    # Load config.py from the root explicitly rather than resetting the
+    # import path to it, as that is shared by all threads
+    if 'config' not in modules:
+        config_path = path_join(abspath(dirname(__file__)), '../..',
+                                CONF_FNAME)
+        if not isfile(config_path):
+            Messager.error(_miss_config_msg(), duration=-1)
             raise ConfigurationError
-        # Try importing the config entries we need
         try:
-            from config import DEBUG
-        except ImportError:
-            path.extend(orig_path)
-            Messager.error(_miss_var_msg('DEBUG'), duration=-1)
+            spec = spec_from_file_location('config', config_path)
+            config = module_from_spec(spec)
+            spec.loader.exec_module(config)
+        except Exception:
+            Messager.error(_get_stack_trace(), duration=-1)
             raise ConfigurationError
-        try:
-            from config import ADMIN_CONTACT_EMAIL
-        except ImportError:
-            path.extend(orig_path)
-            Messager.error(_miss_var_msg('ADMIN_CONTACT_EMAIL'), duration=-1)
+        # Another thread may have beaten us to it
+        modules.setdefault('config', config)
+
+    # Check the config entries we need
+    config = modules['config']
+    for var in ('DEBUG', 'ADMIN_CONTACT_EMAIL'):
+        if not hasattr(config, var):
+            Messager.error(_miss_var_msg(var), duration=-1)
             raise ConfigurationError
-    finally:
-        # Remove our entry to the path
-        while path:
-            path.pop()
-        # Then restore it
-        path.extend(orig_path)
 
 # Convert internal log level to `logging` log level
 
@@ -154,7 +136,7 @@ class DefaultNoneDict(dict):
         return None
 
 
-def _safe_serve(params, client_ip, client_hostname, cookie_data):
+def _begin_request(client_ip, cookie_data):
     # Note: Only logging imports here
     from config import WORK_DIR
     from logging import basicConfig as log_basic_config
@@ -171,11 +153,11 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
 
     # Do the necessary imports after enabling the logging, order critical
     try:
-        from common import ProtocolError, ProtocolArgumentError, NoPrintJSONError
-        from dispatch import dispatch
-        from jsonwrap import dumps
-        from message import Messager
-        from session import get_session, init_session, close_session, NoSessionError, SessionStoreError
+        import common
+        import dispatch
+        import jsonwrap
+        import message
+        import session
     except ImportError:
         # Note: Heisenbug trap for #612, remove after resolved
         from logging import critical as log_critical
@@ -183,39 +165,52 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
         log_critical('Heisenbug trap reports: ' + str(sys_path))
         raise
 
-    init_session(client_ip, cookie_data=cookie_data)
-    response_is_JSON = True
-    try:
-        # Unpack the arguments into something less obscure than the
-        #   Python FieldStorage object (part dictonary, part list, part FUBAR)
-        http_args = DefaultNoneDict()
-        for k in params:
-            # Also take the opportunity to convert Strings into Unicode,
-            #   according to HTTP they should be UTF-8
-            try:
-                http_args[k] = params.getvalue(k)
-            except TypeError as e:
-                # Messager.error(e)
-                Messager.error(
-                    'protocol argument error: expected string argument %s, got %s' %
-                    (k, type(
-                        params.getvalue(k))))
-                raise ProtocolArgumentError
+    session.init_session(client_ip, cookie_data=cookie_data)
 
-        # Dispatch the request
-        json_dic = dispatch(http_args, client_ip, client_hostname)
-    except ProtocolError as e:
+
+def _http_args(params):
+    from common import ProtocolArgumentError
+    from message import Messager
+
+    # Unpack the arguments into something less obscure than the
+    #   Python FieldStorage object (part dictonary, part list, part FUBAR)
+    http_args = DefaultNoneDict()
+    for k in params:
+        # Also take the opportunity to convert Strings into Unicode,
+        #   according to HTTP they should be UTF-8
+        try:
+            http_args[k] = params.getvalue(k)
+        except TypeError as e:
+            # Messager.error(e)
+            Messager.error(
+                'protocol argument error: expected string argument %s, got %s' %
+                (k, type(
+                    params.getvalue(k))))
+            raise ProtocolArgumentError
+    return http_args
+
+
+def _end_request(json_dic, error=None):
+    # Turns the result of dispatching the request, or the error (if any)
+    # that it raised, into the response
+    from common import ProtocolError, NoPrintJSONError
+    from jsonwrap import dumps
+    from message import Messager
+    from session import get_session, close_session, NoSessionError, SessionStoreError
+
+    response_is_JSON = True
+    if isinstance(error, ProtocolError):
         # Internal error, only reported to client not to log
         json_dic = {}
-        e.json(json_dic)
+        error.json(json_dic)
 
         # Add a human-readable version of the error
-        err_str = str(e)
+        err_str = str(error)
         if err_str != '':
             Messager.error(err_str, duration=-1)
-    except NoPrintJSONError as e:
+    elif isinstance(error, NoPrintJSONError):
         # Terrible hack to serve other things than JSON
-        response_data = (e.hdrs, e.data)
+        response_data = (error.hdrs, error.data)
         response_is_JSON = False
 
     # Get the potential cookie headers and close the session (if any)
@@ -233,6 +228,33 @@ def _safe_serve(params, client_ip, client_hostname, cookie_data):
 
     return (cookie_hdrs, response_data)
 
+
+def _safe_serve(params, client_ip, client_hostname, cookie_data):
+    _begin_request(client_ip, cookie_data)
+
+    from common import ProtocolError, NoPrintJSONError
+    from dispatch import dispatch
+    try:
+        # Dispatch the request
+        json_dic = dispatch(_http_args(params), client_ip, client_hostname)
+    except (ProtocolError, NoPrintJSONError) as e:
+        return _end_request(None, e)
+    return _end_request(json_dic)
+
+
+async def _safe_serve_async(params, client_ip, client_hostname, cookie_data):
+    _begin_request(client_ip, cookie_data)
+
+    from common import ProtocolError, NoPrintJSONError
+    from dispatch import dispatch_async
+    try:
+        # Dispatch the request
+        json_dic = await dispatch_async(_http_args(params), client_ip,
+                                        client_hostname)
+    except (ProtocolError, NoPrintJSONError) as e:
+        return _end_request(None, e)
+    return _end_request(json_dic)
+
 # Programmatically access the stack-trace
 
 
@@ -282,11 +304,8 @@ def _server_crash(cookie_hdrs, e):
     }
     return (cookie_hdrs, ((JSON_HDR, ), dumps(Messager.output_json(json_dic))))
 
-# Serve the client request
-
-
-def serve(params, client_ip, client_hostname, cookie_data):
-    # The session relies on the config, wait-for-it
+def _check_installation():
+    # Returns the response to send if the server can't serve requests
     cookie_hdrs = None
 
     # Do we have a Python version compatibly with our libs?
@@ -310,13 +329,7 @@ def serve(params, client_ip, client_hostname, cookie_data):
     from message import Messager
 
     try:
-        # We need to lock here since flup uses threads for each request and
-        # can thus manipulate each other's global variables
-        try:
-            CONFIG_CHECK_LOCK.acquire()
-            _config_check()
-        finally:
-            CONFIG_CHECK_LOCK.release()
+        _config_check()
     except ConfigurationError as e:
         json_dic = {}
         e.json(json_dic)
@@ -333,9 +346,39 @@ def serve(params, client_ip, client_hostname, cookie_data):
         return cookie_hdrs, ((JSON_HDR, ), dumps(
             Messager.output_json(json_dic)))
 
+    return None
+
+# Serve the client request
+
+
+def serve(params, client_ip, client_hostname, cookie_data):
+    # The session relies on the config, wait-for-it
+    cookie_hdrs = None
+
+    response = _check_installation()
+    if response is not None:
+        return response
+
     try:
         # Safe region, can throw any exception, has verified installation
         return _safe_serve(params, client_ip, client_hostname, cookie_data)
     except BaseException as e:
         # Handle the server crash
         return _server_crash(cookie_hdrs, e)
+
+
+async def serve_async(params, client_ip, client_hostname, cookie_data):
+    """Coroutine version of serve() for asyncio front ends, see
+    dispatch.dispatch_async()."""
+    cookie_hdrs = None
+
+    response = _check_installation()
+    if response is not None:
+        return response
+
+    try:
+        return await _safe_serve_async(params, client_ip, client_hostname,
+                                       cookie_data)
+    except Exception as e:
+        # Handle the server crash (but let cancellation through)
+        return _server_crash(cookie_hdrs, e)
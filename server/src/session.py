@@ -14,6 +14,7 @@ Version:    2011-03-11
 
 
 from atexit import register as atexit_register
+from contextvars import ContextVar
 from datetime import datetime, timedelta
 from hashlib import sha224
 from http.cookies import CookieError, SimpleCookie
@@ -31,7 +32,9 @@ except ImportError:
 
 
 # Constants
-CURRENT_SESSION = None
+# The session of the request being served, each request (see
+# wsgiapp.BratApplication) is served in a context of its own
+CURRENT_SESSION = ContextVar('brat_session', default=None)
 SESSION_COOKIE_KEY = 'sid'
 # Where we store our session data files
 SESSIONS_DIR = path_join(WORK_DIR, 'sessions')
@@ -137,44 +140,46 @@ def init_session(remote_address, cookie_data=None, cookie=None):
             # For some reason the cookie did not contain a SID, set to default
             cookie.set_sid(sid)
 
-    # Set the session singleton (there can be only one!)
-    global CURRENT_SESSION
+    # Set the session of the current request (there can be only one!)
     ppath = get_session_pickle_path(cookie.get_sid())
     if isfile(ppath):
         # Load our old session data and initialise the cookie
         try:
             with open(ppath, 'rb') as session_pickle:
-                CURRENT_SESSION = pickle_load(session_pickle)
-            CURRENT_SESSION.init_cookie(CURRENT_SESSION.get_sid())
+                session = pickle_load(session_pickle)
+            session.init_cookie(session.get_sid())
         except Exception as e:
             # On any error, just create a new session
-            CURRENT_SESSION = Session(cookie)
+            session = Session(cookie)
     else:
         # Create a new session
-        CURRENT_SESSION = Session(cookie)
+        session = Session(cookie)
+    CURRENT_SESSION.set(session)
 
 
 def get_session():
-    if CURRENT_SESSION is None:
+    session = CURRENT_SESSION.get()
+    if session is None:
         raise NoSessionError
-    return CURRENT_SESSION
+    return session
 
 
 def invalidate_session():
-    global CURRENT_SESSION
-    if CURRENT_SESSION is None:
+    session = CURRENT_SESSION.get()
+    if session is None:
         return
 
     # Set expired and remove from disk
-    CURRENT_SESSION.cookie.set_expired()
-    ppath = get_session_pickle_path(CURRENT_SESSION.get_sid())
+    session.cookie.set_expired()
+    ppath = get_session_pickle_path(session.get_sid())
     if isfile(ppath):
         remove(ppath)
 
 
 def close_session():
     # Do we have a session to save in the first place?
-    if CURRENT_SESSION is None:
+    session = CURRENT_SESSION.get()
+    if session is None:
         return
 
     try:
@@ -202,8 +207,8 @@ def close_session():
         os_close(tmp_file_fh)
 
         with open(tmp_file_path, 'wb') as tmp_file:
-            pickle_dump(CURRENT_SESSION, tmp_file)
-        real_file_path = get_session_pickle_path(CURRENT_SESSION.get_sid())
+            pickle_dump(session, tmp_file)
+        real_file_path = get_session_pickle_path(session.get_sid())
         rename(tmp_file_path, real_file_path)
     except IOError:
         # failed store: no permissions?
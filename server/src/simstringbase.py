@@ -61,8 +61,8 @@ class SimstringBase:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    @staticmethod
-    def find_db(db, missing_ok=False):
+    @classmethod
+    def find_db(cls, db, missing_ok=False):
         """Given a simstring DB name/path, returns the path for the file that is
         expected to contain the simstring DB."""
         # Assume we have a path relative to the brat root if the value
@@ -73,9 +73,9 @@ class SimstringBase:
             base = BASE_DIR
         else:
             base = WORK_DIR
-        fname = path_join(base, db + '.' + SimstringBase.SS_DB_FILENAME_EXTENSION)
+        fname = path_join(base, db + '.' + cls.SS_DB_FILENAME_EXTENSION)
         if not (missing_ok or isfile(fname)):
-            raise SimstringBase.ssdbNotFoundError(fname)
+            raise cls.ssdbNotFoundError(fname)
         return fname
 
     def supstring_lookup(self, s, score=False):
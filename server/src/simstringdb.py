@@ -3,6 +3,10 @@
 # Please install simstring (and optionally its Python bindings) from
 # http://www.chokkan.org/software/simstring/'''
 
+import atexit
+from contextlib import contextmanager
+from os import stat
+from threading import Lock
 
 Simstring = None
 try:
@@ -15,11 +19,107 @@ except ImportError:
     pass
 
 if not Simstring:
-    # Use the simstring executable
     import simstringexec
-    Simstring = simstringexec.SimstringExec
+    if simstringexec.simstring_found:
+        # Use the simstring executable
+        Simstring = simstringexec.SimstringExec
+    else:
+        # Use the n-gram index of our own (see simstringpy)
+        import simstringpy
+        Simstring = simstringpy.SimstringPy
 
 # Usage:
 #
 # with Simstring('my_database', unicode=False, threshold=1.0) as ss:
 #     print(ss.lookup('my_test_word'))
+#
+# For lookups, simstring_reader() does the same with an instance (for the
+# executable: a running simstring process) kept for reuse by later lookups
+# with the same settings in this process:
+#
+# with simstring_reader('my_database', threshold=0.5) as ss:
+#     print(ss.lookup('my_test_word'))
+
+# Maximum number of idle readers kept per DB and settings
+MAX_IDLE_READERS = 4
+
+__readers = {}
+__readers_lock = Lock()
+
+
+class _ReaderPool(object):
+    def __init__(self, signature):
+        self.signature = signature
+        self._idle = []
+        self._closed = False
+        self._lock = Lock()
+
+    def acquire(self):
+        with self._lock:
+            while self._idle:
+                ss = self._idle.pop()
+                if ss.alive():
+                    return ss
+                ss.close()
+        return None
+
+    def release(self, ss):
+        with self._lock:
+            if (not self._closed and ss.alive() and
+                    len(self._idle) < MAX_IDLE_READERS):
+                self._idle.append(ss)
+                return
+        ss.close()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for ss in idle:
+            ss.close()
+
+
+def __reader_pool(dbname, threshold, similarity_measure, unicode):
+    dbfn = Simstring.find_db(dbname)
+    try:
+        st = stat(dbfn)
+    except OSError:
+        raise Simstring.ssdbNotFoundError(dbfn)
+    key = (dbfn, threshold, similarity_measure, unicode)
+    # a rebuilt DB gets readers of its own
+    signature = (st.st_ino, st.st_size, st.st_mtime)
+
+    with __readers_lock:
+        pool = __readers.get(key)
+        if pool is None or pool.signature != signature:
+            if pool is not None:
+                pool.close()
+            pool = _ReaderPool(signature)
+            __readers[key] = pool
+        return pool
+
+
+@contextmanager
+def simstring_reader(dbname, threshold=Simstring.DEFAULT_THRESHOLD,
+                     similarity_measure=Simstring.DEFAULT_SIMILARITY_MEASURE,
+                     unicode=Simstring.DEFAULT_UNICODE):
+    pool = __reader_pool(dbname, threshold, similarity_measure, unicode)
+    ss = pool.acquire()
+    if ss is None:
+        ss = Simstring(dbname, threshold=threshold,
+                       similarity_measure=similarity_measure,
+                       unicode=unicode)
+    try:
+        yield ss
+    finally:
+        pool.release(ss)
+
+
+@atexit.register
+def close_readers():
+    """Closes the idle readers for all DBs."""
+    with __readers_lock:
+        pools = list(__readers.values())
+        __readers.clear()
+    for pool in pools:
+        pool.close()
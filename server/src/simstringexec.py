@@ -44,19 +44,24 @@ class SimstringExec(SimstringBase):
             Messager.error("Error: simstring not found (Hint: set SIMSTRING_EXECUTABLE in config.py")
             return
 
-        cmd = [SIMSTRING_EXECUTABLE,
+        self.cmd = [SIMSTRING_EXECUTABLE,
                 "-d", self.dbfn,
                 "-n", str(ngram_length),
                 "-s", similarity_measure,
                 "-t", str(threshold),
                 ]
         if self.is_build:
-            cmd.append("-b")
+            self.cmd.append("-b")
         if unicode:
-            cmd.append("-u")
+            self.cmd.append("-u")
 
-        self.proc = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, encoding="utf-8")
-        # TODO use `self.proc.poll()` to check if the process ran into trouble
+        self._start()
+
+    def _start(self):
+        self.proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE, encoding="utf-8")
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
 
     def _check_error(self, errs=None):
         if self.proc.returncode:
@@ -78,27 +83,45 @@ class SimstringExec(SimstringBase):
         self.proc.stdin.write(s + "\n")
         self._check_error()
 
+    def _lookup(self, s):
+        self.proc.stdin.write(s + "\n")
+        self.proc.stdin.flush()
+        response = []
+        while True:
+            line = self.proc.stdout.readline()
+            if not line:
+                # the process exited before answering
+                raise BrokenPipeError
+            if not line.startswith("\t"):
+                break
+            response.append(line.strip())
+        return response
+
     def lookup(self, s):
         if not self.proc:
             return []
         try:
-            self.proc.stdin.write(s + "\n")
-            self.proc.stdin.flush()
-            response = []
-            while True:
-                line = self.proc.stdout.readline()
-                if not line.startswith("\t"):
-                    break
-                response.append(line.strip())
+            return self._lookup(s)
+        except BrokenPipeError:
+            pass
+        # long-lived processes may be gone (killed, out of memory);
+        # lookups have no side effects, so try once more with a new one
+        self.close()
+        self._start()
+        try:
+            return self._lookup(s)
         except BrokenPipeError:
             message = self.proc.stderr.read()
             self.close()
             raise SimstringExecException(message) from None
-        return response
 
     def close(self):
         if self.proc:
-            outs, errs = self.proc.communicate('')
+            try:
+                outs, errs = self.proc.communicate('')
+            except (BrokenPipeError, ValueError):
+                self.proc.kill()
+                self.proc.wait()
             self.proc = None
 
 
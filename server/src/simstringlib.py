@@ -32,7 +32,7 @@ class SimstringLib(SimstringBase):
         else:
             self.db = simstring.reader(self.dbfn)
 
-        self.db.measure = SIMILARITY_MEASURES[similarity_measure]
+        self.db.measure = self.SIMILARITY_MEASURES[similarity_measure]
         self.db.threshold = threshold
 
     def build(self, strs):
@@ -41,13 +41,16 @@ class SimstringLib(SimstringBase):
         self.close()
 
     def insert(self, s):
-        assert self.build, "Error: build on non-build simstring"
+        assert self.is_build, "Error: build on non-build simstring"
         self.db.insert(s)
 
     def lookup(self, s):
-        assert not self.build, "Error: lookup on build simstring"
+        assert not self.is_build, "Error: lookup on build simstring"
         return self.db.retrieve(s)
 
+    def alive(self):
+        return self.db is not None
+
     def close(self):
         if self.db:
             self.db.close()
@@ -0,0 +1,360 @@
+"""Approximate string matching without simstring.
+
+An inverted index from the n-grams of strings (see simstringbase.ngrams())
+to the strings containing them, stored in a single file that is
+memory-mapped for lookups, so that opening a DB costs next to nothing and
+the processes using it share its pages. Strings are ordered by their number
+of n-grams, so that the sizes that can meet the similarity threshold map to
+a range of string ids. Candidates are counted from the shortest posting
+lists and then looked up in the others, as in simstring (CPMerge). Uses
+NumPy for the counting if available.
+"""
+
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from math import ceil, floor, sqrt
+from os.path import dirname
+from tempfile import mkstemp
+
+from simstringbase import SimstringBase, ngrams, test
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'BRATSSPY'
+FORMAT_VERSION = 1
+
+# Arrays are stored in native byte order, which the mark identifies
+BYTE_ORDER_MARK = 0x01020304
+
+# Magic, format version, byte order mark, n-gram length, begin/end marks,
+# numbers of strings, features and postings, sizes of the string and
+# feature data
+HEADER = struct.Struct('=8sIIIIIIIII')
+
+# Relative cost of a binary search for a candidate in a posting list, over
+# a scan of the list
+SEARCH_COST = 16
+
+# Tolerance for rounding the bounds of the similarity measures
+EPSILON = 1e-9
+
+
+def _ceil(v):
+    return int(ceil(v - EPSILON))
+
+
+def _floor(v):
+    return int(floor(v + EPSILON))
+
+
+# For each measure, given the number of n-grams x of the query and
+# threshold t, the range of sizes y of matching strings and the number of
+# n-grams they must share with the query (see measure.h in simstring)
+MEASURES = {
+    'exact': (
+        lambda x, t: (x, x),
+        lambda x, y, t: x),
+    'dice': (
+        lambda x, t: (_ceil(t / (2 - t) * x), _floor((2 - t) / t * x)),
+        lambda x, y, t: _ceil(0.5 * t * (x + y))),
+    'cosine': (
+        lambda x, t: (_ceil(t * t * x), _floor(x / (t * t))),
+        lambda x, y, t: _ceil(t * sqrt(x * y))),
+    'jaccard': (
+        lambda x, t: (_ceil(t * x), _floor(x / t)),
+        lambda x, y, t: _ceil(t * (x + y) / (1 + t))),
+    'overlap': (
+        lambda x, t: (1, None),
+        lambda x, y, t: _ceil(t * min(x, y))),
+}
+
+
+class SimstringPyException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return 'Simstring error: %s' % self.message
+
+
+class _Table(object):
+    # Sequence of the byte strings stored in data between offsets
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+
+class SimstringPy(SimstringBase):
+    # Not the format of simstring, which can't read these DBs (and v.v.)
+    SS_DB_FILENAME_EXTENSION = "ngrams.db"
+
+    def __init__(self, dbfn,
+            ngram_length=SimstringBase.DEFAULT_NGRAM_LENGTH,
+            include_marks=SimstringBase.DEFAULT_INCLUDE_MARKS,
+            threshold=SimstringBase.DEFAULT_THRESHOLD,
+            similarity_measure=SimstringBase.DEFAULT_SIMILARITY_MEASURE,
+            unicode=SimstringBase.DEFAULT_UNICODE,
+            build=False):
+
+        if similarity_measure not in MEASURES:
+            raise SimstringPyException('unknown similarity measure "%s"' %
+                                       similarity_measure)
+
+        # Strings are always compared as Unicode characters
+        super().__init__(dbfn,
+                ngram_length=ngram_length,
+                include_marks=include_marks,
+                threshold=threshold,
+                similarity_measure=similarity_measure,
+                unicode=unicode,
+                build=build)
+
+        self.size_range, self.min_overlap = MEASURES[similarity_measure]
+        self.ngram_length = ngram_length
+        self.include_marks = include_marks
+        self.mm = None
+        if build:
+            self.strs = set()
+        else:
+            self._open()
+
+    def _open(self):
+        with open(self.dbfn, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SimstringPyException('empty DB file %s' % self.dbfn)
+        try:
+            (magic, version, bom, self.ngram_length, include_marks,
+             num_strings, num_features, num_postings, string_data_size,
+             feature_data_size) = HEADER.unpack_from(self.mm)
+        except struct.error:
+            magic = None
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self.close()
+            raise SimstringPyException(
+                '%s is not a DB of this version (rebuild with '
+                'tools/norm_db_init.py)' % self.dbfn)
+        if bom != BYTE_ORDER_MARK:
+            self.close()
+            raise SimstringPyException(
+                '%s was built on a machine of different byte order' %
+                self.dbfn)
+        self.include_marks = bool(include_marks)
+
+        view = memoryview(self.mm)
+        offset = HEADER.size
+
+        def section(length, typecode=None):
+            nonlocal offset
+            if typecode is None:
+                data = view[offset:offset + length]
+            else:
+                data = view[offset:offset + 4 * length].cast(typecode)
+                length *= 4
+            offset += length
+            return data
+
+        self.sizes = section(num_strings, 'I')
+        string_offsets = section(num_strings + 1, 'I')
+        feature_offsets = section(num_features + 1, 'I')
+        self.posting_offsets = section(num_features + 1, 'I')
+        self.postings = section(num_postings, 'I')
+        self.features = _Table(section(feature_data_size), feature_offsets)
+        self.strings = _Table(section(string_data_size), string_offsets)
+
+        if numpy is not None:
+            self.np_sizes = numpy.frombuffer(
+                self.mm, numpy.uint32, num_strings, HEADER.size)
+            self.np_postings = numpy.frombuffer(
+                self.mm, numpy.uint32, num_postings,
+                HEADER.size + 4 * (2 * num_strings + 2 * num_features + 3))
+
+    def build(self, strs):
+        for s in strs:
+            self.insert(s)
+        self.close()
+
+    def insert(self, s):
+        assert self.is_build, "Error: build on non-build simstring"
+        self.strs.add(s)
+
+    def _write(self):
+        by_size = sorted(
+            (len(ngrams(s, n=self.ngram_length, be=self.include_marks)), s)
+            for s in self.strs)
+
+        sizes = array('I')
+        string_offsets = array('I', [0])
+        string_data = bytearray()
+        postings_by_feature = {}
+        for id_, (size, s) in enumerate(by_size):
+            sizes.append(size)
+            string_data.extend(s.encode('utf-8'))
+            string_offsets.append(len(string_data))
+            for f in ngrams(s, n=self.ngram_length, be=self.include_marks):
+                postings_by_feature.setdefault(f.encode('utf-8'),
+                                               array('I')).append(id_)
+
+        feature_offsets = array('I', [0])
+        posting_offsets = array('I', [0])
+        feature_data = bytearray()
+        postings = array('I')
+        for f in sorted(postings_by_feature):
+            feature_data.extend(f)
+            feature_offsets.append(len(feature_data))
+            postings.extend(postings_by_feature[f])
+            posting_offsets.append(len(postings))
+
+        header = HEADER.pack(MAGIC, FORMAT_VERSION, BYTE_ORDER_MARK,
+                             self.ngram_length, int(self.include_marks),
+                             len(sizes), len(postings_by_feature),
+                             len(postings), len(string_data),
+                             len(feature_data))
+
+        # Replace any earlier DB at once; readers keep the old one open
+        fd, tmp_path = mkstemp(dir=dirname(self.dbfn) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                for a in (sizes, string_offsets, feature_offsets,
+                          posting_offsets, postings):
+                    a.tofile(f)
+                f.write(feature_data)
+                f.write(string_data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.dbfn)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _posting_ranges(self, features, start, end):
+        # Ranges of the posting lists of the features (in postings),
+        # restricted to string ids in [start, end)
+        ranges = []
+        for f in features:
+            f = f.encode('utf-8')
+            i = bisect_left(self.features, f)
+            if i == len(self.features) or self.features[i] != f:
+                continue
+            first = bisect_left(self.postings, start,
+                                self.posting_offsets[i],
+                                self.posting_offsets[i + 1])
+            last = bisect_left(self.postings, end, first,
+                               self.posting_offsets[i + 1])
+            if first < last:
+                ranges.append((first, last))
+        return ranges
+
+    def _count(self, scanned, checked, min_overlap):
+        # Pure Python: returns (id, overlap) of the candidates reaching
+        # their min_overlap(id)
+        postings = self.postings
+        counts = Counter()
+        for first, last in scanned:
+            counts.update(postings[first:last])
+        for first, last in checked:
+            if len(counts) * SEARCH_COST < last - first:
+                found = []
+                for id_ in counts:
+                    j = bisect_left(postings, id_, first, last)
+                    if j < last and postings[j] == id_:
+                        found.append(id_)
+            else:
+                found = counts.keys() & set(postings[first:last])
+            counts.update(found)
+        return [(i, n) for i, n in counts.items() if n >= min_overlap(i)]
+
+    def _count_numpy(self, scanned, checked, overlap_by_size, min_size):
+        postings = self.np_postings
+        ids, counts = numpy.unique(
+            numpy.concatenate([postings[first:last]
+                               for first, last in scanned]),
+            return_counts=True)
+        for first, last in checked:
+            posting_list = postings[first:last]
+            j = numpy.searchsorted(posting_list, ids)
+            j[j == len(posting_list)] = 0
+            counts += posting_list[j] == ids
+        needed = numpy.asarray(overlap_by_size)[
+            self.np_sizes[ids].astype(numpy.int64) - min_size]
+        matching = counts >= needed
+        return zip(ids[matching].tolist(), counts[matching].tolist())
+
+    def lookup(self, s):
+        assert not self.is_build, "Error: lookup on build simstring"
+        features = ngrams(s, n=self.ngram_length, be=self.include_marks)
+        x, t = len(features), self.threshold
+        if x == 0:
+            return []
+
+        min_size, max_size = self.size_range(x, t) if t > 0 else (1, None)
+        min_size = max(min_size, 1)
+        if max_size is None:
+            max_size = self.sizes[-1] if len(self.sizes) else 0
+        if min_size > max_size:
+            return []
+        start = bisect_left(self.sizes, min_size)
+        end = bisect_right(self.sizes, max_size)
+        if start == end:
+            return []
+
+        overlap_by_size = [max(self.min_overlap(x, y, t), 1)
+                           for y in range(min_size, max_size + 1)]
+
+        # Any match shares some n-gram in all but (least overlap - 1)
+        # of the query n-grams; n-grams not in the DB count as shortest
+        ranges = self._posting_ranges(features, start, end)
+        ranges.sort(key=lambda r: r[1] - r[0])
+        scan = x - min(overlap_by_size) + 1 - (x - len(ranges))
+        if scan <= 0:
+            return []
+        scanned, checked = ranges[:scan], ranges[scan:]
+
+        if numpy is not None:
+            matches = self._count_numpy(scanned, checked, overlap_by_size,
+                                        min_size)
+        else:
+            sizes = self.sizes
+            matches = self._count(
+                scanned, checked,
+                lambda i: overlap_by_size[sizes[i] - min_size])
+        return [self.strings[i].decode('utf-8') for i, n in matches]
+
+    def alive(self):
+        return self.mm is not None
+
+    def close(self):
+        if self.is_build:
+            if self.strs is not None:
+                self._write()
+                self.strs = None
+            return
+        if self.mm is not None:
+            self.sizes = self.postings = self.posting_offsets = None
+            self.features = self.strings = None
+            self.np_sizes = self.np_postings = None
+            try:
+                self.mm.close()
+            except BufferError:
+                # still in use elsewhere, closed once collected
+                pass
+            self.mm = None
+
+
+
+if __name__ == "__main__":
+    test(SimstringPy)
@@ -33,3 +33,15 @@ class SosMessager:
 
     def debug(msg, duration=3, escaped=False): pass
     debug = staticmethod(debug)
+
+    def prepare_context(): pass
+    prepare_context = staticmethod(prepare_context)
+
+    def mark(): return 0
+    mark = staticmethod(mark)
+
+    def messages_since(mark, remove=False): return []
+    messages_since = staticmethod(messages_since)
+
+    def add_messages(messages): pass
+    add_messages = staticmethod(add_messages)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+"""Interval index over text spans.
+
+A static centered interval tree: each node holds the intervals containing
+its center point, sorted by start and by end, with the intervals entirely
+before and after the center in its left and right subtrees. Point and
+overlap queries take O(log n + k) time for k results, against O(n) for
+checking every span.
+"""
+
+from operator import itemgetter
+
+_start = itemgetter(0)
+_end = itemgetter(1)
+
+
+class _Node(object):
+    def __init__(self, intervals):
+        endpoints = sorted(p for i in intervals for p in i[:2])
+        self.center = endpoints[len(endpoints) // 2]
+
+        here, before, after = [], [], []
+        for interval in intervals:
+            if interval[1] < self.center:
+                before.append(interval)
+            elif interval[0] > self.center:
+                after.append(interval)
+            else:
+                here.append(interval)
+
+        self.by_start = sorted(here, key=_start)
+        self.by_end = sorted(here, key=_end, reverse=True)
+        self.left = _Node(before) if before else None
+        self.right = _Node(after) if after else None
+
+
+class SpanIndex(object):
+    """Index of (start, end, value) intervals, where start <= end."""
+
+    def __init__(self, intervals=()):
+        intervals = [tuple(i) for i in intervals]
+        self._root = _Node(intervals) if intervals else None
+        self._size = len(intervals)
+
+    def __len__(self):
+        return self._size
+
+    def stabbing(self, point):
+        """Return the (start, end, value) intervals with
+        start <= point <= end."""
+        found = []
+        node = self._root
+        while node is not None:
+            if point < node.center:
+                for interval in node.by_start:
+                    if interval[0] > point:
+                        break
+                    found.append(interval)
+                node = node.left
+            elif point > node.center:
+                for interval in node.by_end:
+                    if interval[1] < point:
+                        break
+                    found.append(interval)
+                node = node.right
+            else:
+                found.extend(node.by_start)
+                break
+        return found
+
+    def overlapping(self, start, end):
+        """Return the (start, end, value) intervals that overlap the given
+        one, i.e. with i_start < end and i_end > start."""
+        found = []
+        pending = [self._root] if self._root is not None else []
+        while pending:
+            node = pending.pop()
+            if end <= node.center:
+                for interval in node.by_start:
+                    if interval[0] >= end:
+                        break
+                    # (only fails for empty queries at the center)
+                    if interval[1] > start:
+                        found.append(interval)
+                if node.left is not None:
+                    pending.append(node.left)
+            elif start >= node.center:
+                for interval in node.by_end:
+                    if interval[1] <= start:
+                        break
+                    if interval[0] < end:
+                        found.append(interval)
+                if node.right is not None:
+                    pending.append(node.right)
+            else:
+                found.extend(node.by_start)
+                if node.left is not None:
+                    pending.append(node.left)
+                if node.right is not None:
+                    pending.append(node.right)
+        return found
+
+
+class TextBoundIndex(object):
+    """Index of the spans of TextBoundAnnotations, each span of a
+    discontinuous annotation indexed separately."""
+
+    def __init__(self, textbounds):
+        self._spans = SpanIndex((start, end, t)
+                                for t in textbounds
+                                for start, end in t.spans)
+
+    def containing(self, start, end):
+        """Return the annotations with a span containing (or equal to) the
+        given one, as TextBoundAnnotation.contains() for a single span."""
+        return _unique(t for s_start, s_end, t in self._spans.stabbing(start)
+                       if s_end >= end)
+
+    def spanning(self, offset):
+        """Return the annotations with a span covering the character at
+        the given offset."""
+        return _unique(t for s_start, s_end, t in self._spans.stabbing(offset)
+                       if s_end > offset)
+
+    def within(self, start, end):
+        """Return the annotations with a span inside (or equal to) the given
+        one."""
+        # widened by one so that empty spans at either end are included
+        return _unique(t for s_start, s_end, t
+                       in self._spans.overlapping(start - 1, end + 1)
+                       if s_start >= start and s_end <= end)
+
+    def overlapping(self, start, end):
+        """Return the annotations with a span overlapping the given one."""
+        return _unique(t for s_start, s_end, t
+                       in self._spans.overlapping(start, end))
+
+
+def _unique(values):
+    # Annotation objects hash by identity; keep a stable order
+    return list(dict.fromkeys(values))
@@ -130,6 +130,35 @@ def newline_sentence_boundary_gen(text):
         yield o
 
 
+def merge_spanned_sentences(sentence_offsets, spans):
+    """Returns the (start, end) offsets of the sentences with each one that
+    ends inside any of the (start, end) spans (e.g. of annotations) joined
+    with those after it, so that no span crosses a sentence end.
+
+    The sentences are expected in order. Non-adjacent sentences are joined
+    over the text between them (S_1: [0, 10], S_2: [15, 20] -> [0, 20]).
+    """
+    # Sweep over the sentence ends, with the furthest end reached by the
+    # spans starting before each
+    spans = sorted(spans)
+    merged = []
+    i, reach, start = 0, None, None
+    for s_start, s_end in sentence_offsets:
+        if start is None:
+            start = s_start
+        while i < len(spans) and spans[i][0] < s_end:
+            if reach is None or spans[i][1] > reach:
+                reach = spans[i][1]
+            i += 1
+        if reach is None or reach <= s_end:
+            merged.append((start, s_end))
+            start = None
+    if start is not None:
+        # spans past the end of the last sentence
+        merged.append((start, s_end))
+    return merged
+
+
 if __name__ == '__main__':
     from sys import argv
 
@@ -10,22 +10,25 @@ Author:     Pontus Stenetorp    <pontus is s u-tokyo ac jp>
 Version:    2011-04-21
 """
 
+from functools import partial
 from logging import info as log_info
-from os import listdir
 from os.path import join as path_join
-from os.path import getmtime, isfile
 from pickle import dump as pickle_dump
 from pickle import load as pickle_load
 from pickle import UnpicklingError
 
 from config import BASE_DIR, DATA_DIR
 
-from annotation import Annotations, open_textfile
+from anncache import document_signature, file_signature
+from annotation import PARTIAL_ANN_FILE_SUFF, Annotations, open_textfile
+from docpool import map_documents
 from message import Messager
 from projectconfig import get_config_path, options_get_validation
 
 # Constants
 STATS_CACHE_FILE_NAME = '.stats_cache'
+# Bump when the cache format or the statistics change
+STATS_CACHE_VERSION = 2
 ###
 
 
@@ -38,107 +41,134 @@ def get_stat_cache_by_dir(directory):
 def get_config_py_path():
     return path_join(BASE_DIR, 'config.py')
 
+
+def _document_statistics(directory, stat_count, docname):
+    """Returns the statistics for the given document, see get_statistics."""
+    try:
+        with Annotations(path_join(directory, docname),
+                         read_only=True) as ann_obj:
+            tb_count = len([a for a in ann_obj.get_entities()])
+            rel_count = (len([a for a in ann_obj.get_relations()]) +
+                         len([a for a in ann_obj.get_equivs()]))
+            event_count = len([a for a in ann_obj.get_events()])
+
+            if options_get_validation(directory) == 'none':
+                return [tb_count, rel_count, event_count]
+            else:
+                # verify and include verification issue count
+                try:
+                    from projectconfig import ProjectConfiguration
+                    projectconf = ProjectConfiguration(directory)
+                    from verify_annotations import verify_annotation
+                    issues = verify_annotation(ann_obj, projectconf)
+                    issue_count = len(issues)
+                except BaseException:
+                    # TODO: error reporting
+                    issue_count = -1
+                return [tb_count, rel_count, event_count, issue_count]
+    except Exception as e:
+        log_info('Received "%s" when trying to generate stats' % e)
+        # Pass exceptions silently, just marking stats missing
+        return [-1] * stat_count
+
+
+def _document_signature(document):
+    """Returns a value that changes whenever any of the files that the
+    annotations of the given document may be read from change, including
+    partial annotation files (e.g. ".a1" and ".a2")."""
+    return document_signature(document) + tuple(
+        file_signature(document + '.' + suff)
+        for suff in PARTIAL_ANN_FILE_SUFF)
+
+
 # TODO: Quick hack, prettify and use some sort of csv format
 
 
-def get_statistics(directory, base_names, use_cache=True):
-    # Check if we have a cache of the costly satistics generation
-    # Also, only use it if no file is newer than the cache itself
-    cache_file_path = get_stat_cache_by_dir(directory)
+def _config_fingerprint(directory, stat_types):
+    """Returns a value that changes whenever the configuration affecting
+    the statistics of the documents in the directory changes."""
+    config_path = get_config_path(directory)
+    return (STATS_CACHE_VERSION,
+            tuple(stat_types),
+            file_signature(get_config_py_path()),
+            config_path,
+            file_signature(config_path) if config_path is not None else None)
 
-    try:
-        cache_mtime = getmtime(cache_file_path)
-    except OSError as e:
-        if e.errno == 2:
-            cache_mtime = -1
-        else:
-            raise
 
+def _load_stats_cache(cache_file_path, fingerprint):
+    """Returns the cached (signature, statistics) pairs by document name, or
+    an empty dict if there is no usable cache."""
     try:
-        if (not isfile(cache_file_path)
-                # Has config.py been changed?
-                or getmtime(get_config_py_path()) > cache_mtime
-                # Any file has changed in the dir since the cache was generated
-                or any(True for f in listdir(directory)
-                       if (getmtime(path_join(directory, f)) > cache_mtime
-                           # Ignore hidden files
-                           and not f.startswith('.')))
-                # The configuration is newer than the cache
-                or getmtime(get_config_path(directory)) > cache_mtime):
-            generate = True
-            docstats = []
-        else:
-            generate = False
-            try:
-                with open(cache_file_path, 'rb') as cache_file:
-                    docstats = pickle_load(cache_file)
-                if len(docstats) != len(base_names):
-                    Messager.warning(
-                        'Stats cache %s was incomplete; regenerating' %
-                        cache_file_path)
-                    generate = True
-                    docstats = []
-            except UnpicklingError:
-                # Corrupt data, re-generate
-                Messager.warning(
-                    'Stats cache %s was corrupted; regenerating' %
-                    cache_file_path, -1)
-                generate = True
-            except EOFError:
-                # Corrupt data, re-generate
-                generate = True
-    except OSError as e:
+        with open(cache_file_path, 'rb') as cache_file:
+            cache = pickle_load(cache_file)
+    except (IOError, OSError):
+        return {}
+    except UnpicklingError:
+        # Corrupt data, re-generate
         Messager.warning(
-            'Failed checking file modification times for stats cache check; regenerating')
-        generate = True
+            'Stats cache %s was corrupted; regenerating' %
+            cache_file_path, -1)
+        return {}
+    except EOFError:
+        # Corrupt data, re-generate
+        return {}
+
+    # Caches of other versions or configurations are discarded as a whole
+    if (not isinstance(cache, dict) or
+            cache.get('fingerprint') != fingerprint):
+        return {}
+    return cache['documents']
 
-    if not use_cache:
-        generate = True
 
+def get_statistics(directory, base_names, use_cache=True):
+    """Returns the statistic types and a list of the statistics of each of
+    the given documents in the directory.
+
+    The statistics are cached per document, keyed by the modification time
+    and size of its files, so only the documents that changed since the
+    previous call (or all of them if the configuration changed) are parsed.
+    """
     # "header" and types
     stat_types = [("Entities", "int"), ("Relations", "int"), ("Events", "int")]
 
     if options_get_validation(directory) != 'none':
         stat_types.append(("Issues", "int"))
 
-    if generate:
-        # Generate the document statistics from scratch
-        from annotation import JOINED_ANN_FILE_SUFF
-        log_info('generating statistics for "%s"' % directory)
-        docstats = []
-        for docname in base_names:
-            try:
-                with Annotations(path_join(directory, docname),
-                                 read_only=True) as ann_obj:
-                    tb_count = len([a for a in ann_obj.get_entities()])
-                    rel_count = (len([a for a in ann_obj.get_relations()]) +
-                                 len([a for a in ann_obj.get_equivs()]))
-                    event_count = len([a for a in ann_obj.get_events()])
-
-                    if options_get_validation(directory) == 'none':
-                        docstats.append([tb_count, rel_count, event_count])
-                    else:
-                        # verify and include verification issue count
-                        try:
-                            from projectconfig import ProjectConfiguration
-                            projectconf = ProjectConfiguration(directory)
-                            from verify_annotations import verify_annotation
-                            issues = verify_annotation(ann_obj, projectconf)
-                            issue_count = len(issues)
-                        except BaseException:
-                            # TODO: error reporting
-                            issue_count = -1
-                        docstats.append(
-                            [tb_count, rel_count, event_count, issue_count])
-            except Exception as e:
-                log_info('Received "%s" when trying to generate stats' % e)
-                # Pass exceptions silently, just marking stats missing
-                docstats.append([-1] * len(stat_types))
-
-        # Cache the statistics
+    cache_file_path = get_stat_cache_by_dir(directory)
+    fingerprint = _config_fingerprint(directory, stat_types)
+    if use_cache:
+        cached = _load_stats_cache(cache_file_path, fingerprint)
+    else:
+        cached = {}
+
+    # Taken before parsing, so that documents changing meanwhile are
+    # recounted on the next call
+    signatures = [_document_signature(path_join(directory, docname))
+                  for docname in base_names]
+    stale = [docname for docname, signature in zip(base_names, signatures)
+             if cached.get(docname, (None, ))[0] != signature]
+
+    if stale:
+        log_info('generating statistics for %d documents in "%s"' %
+                 (len(stale), directory))
+        for docname, stats in zip(stale, map_documents(
+                partial(_document_statistics, directory, len(stat_types)),
+                stale)):
+            cached[docname] = (None, stats)
+
+    documents = {}
+    docstats = []
+    for docname, signature in zip(base_names, signatures):
+        _, stats = cached[docname]
+        documents[docname] = (signature, stats)
+        docstats.append(stats)
+
+    # Cache the statistics, dropping documents no longer around
+    if stale or len(documents) != len(cached):
         try:
             with open(cache_file_path, 'wb') as cache_file:
-                pickle_dump(docstats, cache_file)
+                pickle_dump({'fingerprint': fingerprint,
+                             'documents': documents}, cache_file)
         except IOError as e:
             Messager.warning(
                 "Could not write statistics cache file to directory %s: %s" %
@@ -10,14 +10,16 @@ Version:    2011-04-22
 
 
 
+import asyncio
 from http.client import HTTPConnection
 from os.path import join as path_join
 from socket import error as SocketError
 from urllib.parse import urlparse
 
-from annotation import (NormalizationAnnotation, TextAnnotations,
-                        TextBoundAnnotationWithText)
-from annotator import ModificationTracker, _json_from_ann
+from anncache import cached_annotations
+from annotation import NormalizationAnnotation, TextBoundAnnotationWithText
+from annotator import ModificationTracker, _add_annotations_json
+from asyncsupport import http_request, run_blocking
 from common import ProtocolError
 from document import real_directory
 from jsonwrap import loads
@@ -89,7 +91,7 @@ def _is_normalization(ann):
     return 'target' in ann
 
 
-def tag(collection, document, tagger):
+def _tagger_service(collection, tagger):
     pconf = ProjectConfiguration(real_directory(collection))
     for tagger_token, _, _, tagger_service_url in pconf.get_annotator_config():
         if tagger == tagger_token:
@@ -97,66 +99,27 @@ def tag(collection, document, tagger):
     else:
         raise UnknownTaggerError(tagger)
 
-    path_join(real_directory(collection), document)
+    url_soup = urlparse(tagger_service_url)
+    if url_soup.scheme not in ('http', 'https'):
+        raise InvalidConnectionSchemeError(tagger_token, url_soup.scheme)
+    return tagger_token, tagger_service_url
 
-    with TextAnnotations(path_join(real_directory(collection),
-                                   document)) as ann_obj:
 
-        url_soup = urlparse(tagger_service_url)
+def _document_text(collection, document):
+    with cached_annotations(path_join(real_directory(collection), document),
+                            read_only=True) as ann_obj:
+        return ann_obj.get_document_text()
 
-        if url_soup.scheme == 'http':
-            Connection = HTTPConnection
-        elif url_soup.scheme == 'https':
-            # Delayed HTTPS import since it relies on SSL which is commonly
-            #   missing if you roll your own Python, for once we should not
-            #   fail early since tagging is currently an edge case and we
-            #   can't allow it to bring down the whole server.
-            from http.client import HTTPSConnection
-            Connection = HTTPSConnection
-        else:
-            raise InvalidConnectionSchemeError(tagger_token, url_soup.scheme)
 
-        conn = None
-        try:
-            conn = Connection(url_soup.netloc)
-            req_headers = {
-                'Content-type': 'text/plain; charset=utf-8',
-                'Accept': 'application/json',
-            }
-            # Build a new service URL since the request method doesn't accept
-            #   a parameters argument
-            service_url = url_soup.path + (
-                '?' + url_soup.query if url_soup.query else '')
-            try:
-                data = ann_obj.get_document_text().encode('utf-8')
-                req_headers['Content-length'] = len(data)
-                # Note: Trout slapping for anyone sending Unicode objects here
-                conn.request('POST',
-                             # As per: http://bugs.python.org/issue11898
-                             # Force the url to be an ascii string
-                             str(service_url),
-                             data,
-                             headers=req_headers)
-            except SocketError as e:
-                raise TaggerConnectionError(tagger_token, e)
-            resp = conn.getresponse()
-
-            # Did the request succeed?
-            if resp.status != 200:
-                raise TaggerConnectionError(
-                    tagger_token, '%s %s' %
-                    (resp.status, resp.reason))
-            # Finally, we can read the response data
-            resp_data = resp.read()
-        finally:
-            if conn is not None:
-                conn.close()
-
-        try:
-            json_resp = loads(resp_data)
-        except ValueError:
-            raise InvalidTaggerResponseError(tagger_token, resp_data)
+def _apply_tagger_response(collection, document, tagger_token, resp_data,
+                           document_version=None):
+    try:
+        json_resp = loads(resp_data)
+    except ValueError:
+        raise InvalidTaggerResponseError(tagger_token, resp_data)
 
+    with cached_annotations(path_join(real_directory(collection),
+                                      document)) as ann_obj:
         mods = ModificationTracker()
         cidmap = {}
 
@@ -205,8 +168,87 @@ def tag(collection, document, tagger):
             ann_obj.add_annotation(na)
 
         mod_resp = mods.json_response()
-        mod_resp['annotations'] = _json_from_ann(ann_obj)
-        return mod_resp
+        return _add_annotations_json(mod_resp, ann_obj, mods,
+                                     document_version)
+
+
+def tag(collection, document, tagger, document_version=None):
+    tagger_token, tagger_service_url = _tagger_service(collection, tagger)
+    data = _document_text(collection, document).encode('utf-8')
+
+    url_soup = urlparse(tagger_service_url)
+    if url_soup.scheme == 'http':
+        Connection = HTTPConnection
+    else:
+        # Delayed HTTPS import since it relies on SSL which is commonly
+        #   missing if you roll your own Python, for once we should not
+        #   fail early since tagging is currently an edge case and we
+        #   can't allow it to bring down the whole server.
+        from http.client import HTTPSConnection
+        Connection = HTTPSConnection
+
+    conn = None
+    try:
+        conn = Connection(url_soup.netloc, timeout=QUERY_TIMEOUT)
+        req_headers = {
+            'Content-type': 'text/plain; charset=utf-8',
+            'Accept': 'application/json',
+        }
+        # Build a new service URL since the request method doesn't accept
+        #   a parameters argument
+        service_url = url_soup.path + (
+            '?' + url_soup.query if url_soup.query else '')
+        try:
+            req_headers['Content-length'] = len(data)
+            # Note: Trout slapping for anyone sending Unicode objects here
+            conn.request('POST',
+                         # As per: http://bugs.python.org/issue11898
+                         # Force the url to be an ascii string
+                         str(service_url),
+                         data,
+                         headers=req_headers)
+            resp = conn.getresponse()
+        except SocketError as e:
+            raise TaggerConnectionError(tagger_token, e)
+
+        # Did the request succeed?
+        if resp.status != 200:
+            raise TaggerConnectionError(
+                tagger_token, '%s %s' %
+                (resp.status, resp.reason))
+        # Finally, we can read the response data
+        resp_data = resp.read()
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return _apply_tagger_response(collection, document, tagger_token,
+                                  resp_data, document_version)
+
+
+async def tag_async(collection, document, tagger, document_version=None):
+    """Coroutine version of tag(), which doesn't hold up the server (or the
+    document) while the tagger is at work."""
+    tagger_token, tagger_service_url = _tagger_service(collection, tagger)
+    text = await run_blocking(_document_text, collection, document)
+
+    try:
+        resp = await http_request('POST', tagger_service_url,
+                                  text.encode('utf-8'), {
+                                      'Content-type': 'text/plain; charset=utf-8',
+                                      'Accept': 'application/json',
+                                  }, QUERY_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:
+        raise TaggerConnectionError(tagger_token, e)
+
+    # Did the request succeed?
+    if resp.status != 200:
+        raise TaggerConnectionError(
+            tagger_token, '%s %s' %
+            (resp.status, resp.reason))
+
+    return await run_blocking(_apply_tagger_response, collection, document,
+                              tagger_token, resp.data, document_version)
 
 
 if __name__ == '__main__':
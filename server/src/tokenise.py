@@ -36,9 +36,8 @@ def jp_token_boundary_gen(text):
 
 
 def gtb_token_boundary_gen(text):
-    from gtbtokenize import tokenize
-    tokens = tokenize(text).split()
-    for o in _token_boundaries_by_alignment(tokens, text):
+    from gtbtokenize import token_offsets
+    for o in token_offsets(text):
         yield o
 
 
@@ -42,7 +42,7 @@ class NonUndoableActionError(ProtocolError):
         json_dic['exception'] = 'nonUndoableActionError'
 
 
-def undo(collection, document, token):
+def undo(collection, document, token, document_version=None):
     try:
         token = json_loads(token)
     except ValueError:
@@ -54,7 +54,8 @@ def undo(collection, document, token):
 
     if action == 'add_tb':
         # Undo an addition
-        return delete_span(collection, document, token['id'])
+        return delete_span(collection, document, token['id'],
+                           document_version=document_version)
     if action == 'mod_tb':
         # Undo a modification
         # TODO: We do not handle attributes and comments
@@ -66,7 +67,8 @@ def undo(collection, document, token):
             token['type'],
             id=token['id'],
             attributes=token['attributes'],
-            comment=token['comment'] if 'comment' in token else None)
+            comment=token['comment'] if 'comment' in token else None,
+            document_version=document_version)
     else:
         raise NonUndoableActionError
     assert False, 'should have returned prior to this point'
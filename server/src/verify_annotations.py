@@ -6,8 +6,11 @@
 
 
 
+from operator import itemgetter
+
 import annotation
 from projectconfig import ProjectConfiguration
+from spanindex import SpanIndex
 
 # Issue types. Values should match with annotation interface.
 AnnotationError = "AnnotationError"
@@ -73,13 +76,14 @@ def check_textbound_overlap(anns):
     """
     overlapping = []
 
-    for a1 in anns:
-        for a2 in anns:
-            if a1 is a2:
-                continue
-            if (a2.first_start() < a1.last_end() and
-                    a2.last_end() > a1.first_start()):
-                overlapping.append((a1, a2))
+    index = SpanIndex((a.first_start(), a.last_end(), i)
+                      for i, a in enumerate(anns))
+    for i, a1 in enumerate(anns):
+        for _, _, j in sorted(index.overlapping(a1.first_start(),
+                                                a1.last_end()),
+                              key=itemgetter(2)):
+            if j != i:
+                overlapping.append((a1, anns[j]))
 
     return overlapping
 
@@ -538,7 +542,8 @@ def main(argv=None):
                 "").replace(
                 ".ann",
                 "")
-            with annotation.TextAnnotations(nosuff_fn) as ann_obj:
+            with annotation.TextAnnotations(nosuff_fn,
+                                            read_only=True) as ann_obj:
                 issues = verify_annotation(ann_obj, projectconf)
                 for i in issues:
                     print("%s:\t%s" % (fn, i.human_readable_str()))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4; indent-tabs-mode: nil; coding: utf-8; -*-
+# vim:set ft=python ts=4 sw=4 sts=4 autoindent:
+
+"""WSGI application for the brat server.
+
+The state of a request (its session, the messages for the client and, via
+the session, the user) is kept in context variables, and every request is
+served in a fresh context. Any threaded WSGI server (mod_wsgi, FastCGI
+through flup, wsgiref, ...) can thus serve many requests concurrently in
+one process without them seeing each other's state. The caches shared by
+the requests (parsed documents, configurations) are thread-safe.
+
+Use e.g. as
+
+    from wsgiapp import application
+
+or wrap another implementation of the server.serve() contract, such as
+appserver.AppServer.serve(), in a BratApplication.
+"""
+
+from cgi import FieldStorage
+from contextvars import Context
+
+# Not returning 200 OK is a breach of protocol with the client
+RESPONSE_STATUS = '200 OK'
+
+
+class BratApplication(object):
+    def __init__(self, serve=None):
+        if serve is None:
+            from server import serve
+        self.serve = serve
+
+    def __call__(self, environ, start_response):
+        # Get the data required by the server
+        remote_addr = environ.get('REMOTE_ADDR')
+        remote_host = environ.get('REMOTE_HOST')
+        cookie_data = environ.get('HTTP_COOKIE')
+        params = FieldStorage(fp=environ['wsgi.input'], environ=environ)
+
+        # Call main server, in a context of the request's own
+        cookie_hdrs, response_data = Context().run(
+            self.serve, params, remote_addr, remote_host, cookie_data)
+
+        # Then package and send response
+        if cookie_hdrs is not None:
+            response_hdrs = [hdr for hdr in cookie_hdrs]
+        else:
+            response_hdrs = []
+        response_hdrs.extend(response_data[0])
+
+        # Hack to support binary data and general Unicode for SVGs and JSON
+        body = response_data[1]
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        start_response(RESPONSE_STATUS, response_hdrs)
+        return [body]
+
+
+application = BratApplication()
@@ -13,13 +13,13 @@ import sys
 from cgi import FieldStorage
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from posixpath import normpath
-from socketserver import ForkingMixIn
+from socketserver import ThreadingMixIn
 from urllib.parse import unquote
 
 
 # brat imports
 sys.path.append(os.path.join(os.path.dirname(__file__), 'server/src'))
-from server import serve
+from appserver import AppServer
 
 
 _VERBOSE_HANDLER = False
@@ -161,10 +161,8 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
         if i != -1:
             query_string = self.path[i + 1:]
 
-        saved = sys.stdin, sys.stdout, sys.stderr
-        sys.stdin, sys.stdout = self.rfile, self.wfile
-
-        # set env to get FieldStorage to read params
+        # set env to get FieldStorage to read params, without touching
+        # os.environ as other threads are doing the same
         env = {}
         env['REQUEST_METHOD'] = self.command
         content_length = self.headers.get('content-length')
@@ -172,14 +170,12 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
             env['CONTENT_LENGTH'] = content_length
         if query_string:
             env['QUERY_STRING'] = query_string
-        os.environ.update(env)
-        params = FieldStorage(fp=self.rfile)
+        params = FieldStorage(fp=self.rfile, headers=self.headers,
+                              environ=env)
 
         # Call main server
-        cookie_hdrs, response_data = serve(params, remote_addr, remote_host,
-                                           cookie_data)
-
-        sys.stdin, sys.stdout, sys.stderr = saved
+        cookie_hdrs, response_data = self.server.app_server.serve(
+            params, remote_addr, remote_host, cookie_data)
 
         # Package and send response
         if cookie_hdrs is not None:
@@ -250,9 +246,14 @@ class BratHTTPRequestHandler(SimpleHTTPRequestHandler):
             SimpleHTTPRequestHandler.do_HEAD(self)
 
 
-class BratServer(ForkingMixIn, HTTPServer):
-    def __init__(self, server_address):
+class BratServer(ThreadingMixIn, HTTPServer):
+    # Requests are handled by the persistent workers of the app server, the
+    # threads only wait for them
+    daemon_threads = True
+
+    def __init__(self, server_address, app_server):
         HTTPServer.__init__(self, server_address, BratHTTPRequestHandler)
+        self.app_server = app_server
 
 
 def main(argv):
@@ -273,6 +274,10 @@ Warning: could not determine user. Note that the brat standalone
 server is experimental and should not be run as administrator.
 """, file=sys.stderr)
 
+    # --async serves from an asyncio event loop instead of the worker pool
+    use_async = '--async' in argv[1:]
+    argv = [a for a in argv if a != '--async']
+
     if len(argv) > 1:
         try:
             port = int(argv[1])
@@ -282,18 +287,49 @@ server is experimental and should not be run as administrator.
     else:
         port = _DEFAULT_SERVER_PORT
 
+    if use_async:
+        return main_async(port)
+
+    app_server = AppServer()
     try:
-        server = BratServer((_DEFAULT_SERVER_ADDR, port))
+        server = BratServer((_DEFAULT_SERVER_ADDR, port), app_server)
+        app_server.start()
+        # kill -HUP reloads the workers, e.g. after updating brat
+        app_server.install_signal_handlers()
         print("Serving brat at http://%s:%d" % server.server_address, file=sys.stderr)
         server.serve_forever()
     except KeyboardInterrupt:
         # normal exit
         pass
     except socket.error as why:
-        print("Error binding to port", port, ":", why[1], file=sys.stderr)
+        print("Error binding to port", port, ":", why, file=sys.stderr)
     except Exception as e:
         print("Server error", e, file=sys.stderr)
         raise
+    finally:
+        app_server.close()
+    return 0
+
+
+def main_async(port):
+    import asyncio
+    from asyncserver import AsyncBratServer
+
+    permissions = BratHTTPRequestHandler.permissions
+    server = AsyncBratServer(os.path.dirname(os.path.abspath(__file__)),
+                             permissions.allow)
+
+    def ready(listener):
+        address = listener.sockets[0].getsockname()
+        print("Serving brat at http://%s:%d" % address[:2], file=sys.stderr)
+
+    try:
+        asyncio.run(server.serve_forever(_DEFAULT_SERVER_ADDR, port, ready))
+    except KeyboardInterrupt:
+        # normal exit
+        pass
+    except socket.error as why:
+        print("Error binding to port", port, ":", why, file=sys.stderr)
     return 0
 
 
@@ -17,6 +17,8 @@ from sentencesplit import sentencebreaks_to_newlines
 sys.path.append(os.path.join(os.path.dirname(__file__), '../server/src'))
 sys.path.append('.')
 
+from ssplit import merge_spanned_sentences
+
 options = None
 
 EMPTY_LINE_RE = re.compile(r'^\s*$')
@@ -131,12 +133,25 @@ def text_to_conll(f):
             l = sentencebreaks_to_newlines(l)
             sentences.extend([s for s in NEWLINE_TERM_REGEX.split(l) if s])
 
-    lines = []
+    if options.annsuffix:
+        textbounds = get_annotations(f.name)
+    else:
+        textbounds = []
 
+    # don't end sentences inside annotations
+    sentence_offsets = []
     offset = 0
     for s in sentences:
-        nonspace_token_seen = False
+        sentence_offsets.append((offset, offset + len(s)))
+        offset += len(s)
+    sentence_ends = set(end for start, end in merge_spanned_sentences(
+        sentence_offsets, [(tb.start, tb.end) for tb in textbounds]))
 
+    lines = []
+
+    offset = 0
+    nonspace_token_seen = False
+    for s in sentences:
         tokens = [t for t in TOKENIZATION_REGEX.split(s) if t]
 
         for t in tokens:
@@ -146,12 +161,13 @@ def text_to_conll(f):
             offset += len(t)
 
         # sentences delimited by empty lines
-        if nonspace_token_seen:
+        if nonspace_token_seen and offset in sentence_ends:
             lines.append([])
+            nonspace_token_seen = False
 
     # add labels (other than 'O') from standoff annotation if specified
     if options.annsuffix:
-        lines = relabel(lines, get_annotations(f.name))
+        lines = relabel(lines, textbounds)
 
     lines = [[l[0], str(l[1]), str(l[2]), l[3]] if l else l for l in lines]
     return StringIO('\n'.join(('\t'.join(l) for l in lines)))
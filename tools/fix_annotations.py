@@ -60,6 +60,7 @@ def correct_annotations(orig_fn, ann_fn, change_fn):
             if isinstance(tb, annotation.TextBoundAnnotationWithText):
                 tb.text = annotation.DISCONT_SEP.join(
                     (changed_text[start:end] for start, end in tb.spans))
+            anns.update_annotation(tb)
     copy(change_fn, orig_fn)
 # }}}
 
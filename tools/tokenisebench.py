@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Benchmark of the token offsets of the GTB-like tokenizer: compares
+gtbtokenize.token_offsets() with aligning the tokens of
+gtbtokenize.tokenize() to the text, for speed and for giving the same
+offsets."""
+
+import sys
+from glob import glob
+from os.path import dirname, isdir
+from os.path import join as path_join
+from sys import path as sys_path
+from time import perf_counter
+
+sys_path.append(path_join(dirname(__file__), '../server/src'))
+
+from gtbtokenize import token_offsets, tokenize
+from tokenise import _token_boundaries_by_alignment
+
+DEFAULT_DATA_DIR = path_join(dirname(__file__), '../example-data')
+
+
+def argparser():
+    import argparse
+
+    ap = argparse.ArgumentParser(
+        description="Compare the speed and output of the GTB-like tokenizer "
+        "offsets with those of aligning its tokens to the text.")
+    ap.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="Times to tokenize each text (best time is reported).")
+    ap.add_argument(
+        "files",
+        metavar="FILE",
+        nargs="*",
+        help="Text files or directories of them (default: example-data).")
+    return ap
+
+
+def _text_files(paths):
+    for path in paths:
+        if isdir(path):
+            yield from sorted(glob(path_join(path, '**', '*.txt'),
+                                   recursive=True))
+        else:
+            yield path
+
+
+def _aligned_offsets(text):
+    return list(_token_boundaries_by_alignment(tokenize(text).split(), text))
+
+
+def _best_time(function, texts, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        for text in texts:
+            function(text)
+        elapsed = perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv):
+    args = argparser().parse_args(argv[1:])
+
+    texts = []
+    for fn in _text_files(args.files or [DEFAULT_DATA_DIR]):
+        with open(fn, 'r', encoding='utf-8') as txt_file:
+            text = txt_file.read()
+        if token_offsets(text) != _aligned_offsets(text):
+            print('Offsets differ for', fn, file=sys.stderr)
+            return 1
+        texts.append(text)
+
+    aligned = _best_time(_aligned_offsets, texts, args.repeat)
+    direct = _best_time(token_offsets, texts, args.repeat)
+    print('%d texts, %d characters, same offsets' % (
+        len(texts), sum(len(t) for t in texts)))
+    print('tokenize() and alignment: %.3fs' % aligned)
+    print('token_offsets():          %.3fs (%.1fx)' % (
+        direct, aligned / direct if direct else float('inf')))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))